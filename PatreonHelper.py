@@ -1,10 +1,99 @@
+import hashlib
+import hmac
 import logging
-import requests
 import urllib.parse
 
+import http_session
+from token_vault import TokenRefreshError
+
 PLATFORM = 'platform-patreon'
 PLATFORM_NAME = 'Patreon'
 
+# Webhook triggers, see https://docs.patreon.com/#webhooks
+TRIGGERS_MEMBER_DELETED = ('members:delete', 'members:pledge:delete')
+TRIGGERS_MEMBER_UPDATED = ('members:update', 'members:pledge:update')
+PATRON_STATUS_ACTIVE = ('active_patron', 'declined_patron')    # A declined payment is still within the grace period
+
+CREATOR_TOKEN = 'patreon-creator'   # Name of the creator token in the token vault
+
+""" Tier a member is entitled to """
+class Tier():
+    __slots__ = ('id', 'amount_cents')
+
+    def __init__(self, id, amount_cents):
+        self.id = id
+        self.amount_cents = amount_cents
+
+""" Campaign and the creator running it """
+class Campaign():
+    __slots__ = ('id', 'creator_id', 'creator_full_name', 'creator_vanity')
+
+    def __init__(self, id, creator_id, creator_full_name=None, creator_vanity=None):
+        self.id = id
+        self.creator_id = creator_id
+        self.creator_full_name = creator_full_name
+        self.creator_vanity = creator_vanity
+
+""" Membership of a user to a campaign """
+class Membership():
+    __slots__ = ('id', 'campaign', 'tiers')
+
+    def __init__(self, id, campaign, tiers):
+        self.id = id
+        self.campaign = campaign
+        self.tiers = tiers
+
+    """ Total pledged to the entitled tiers """
+    def amount_cents(self):
+        return sum(tier.amount_cents or 0 for tier in self.tiers)
+
+""" Parse an identity response. Return (patron_user_id, memberships), memberships being a generator of Membership:
+the `included` resources are indexed in a single pass, and each membership is only built when it is reached. """
+def parse_identity(data):
+    patron_user_id = data.get('data', {}).get('id', None)
+
+    # One pass over the included resources: index them by (type, id), keeping the members in order
+    included = {}
+    members = []
+    for item in data.get('included', []):
+        included[(item.get('type'), item.get('id'))] = item
+        if item.get('type') == 'member':
+            members.append(item)
+
+    return patron_user_id, _iter_memberships(members, included)
+
+def _iter_memberships(members, included):
+    campaigns = {}
+    tiers = {}
+    for member in members:
+        relationships = member.get('relationships', {})
+        campaign_id = relationships.get('campaign', {}).get('data', {}).get('id', None)
+        campaign = campaigns.get(campaign_id)
+        if campaign is None:
+            campaign = _build_campaign(campaign_id, included)
+            if campaign is None:
+                continue
+            campaigns[campaign_id] = campaign
+
+        member_tiers = []
+        for tier_data in relationships.get('currently_entitled_tiers', {}).get('data', []):
+            tier_id = tier_data.get('id', None)
+            tier = tiers.get(tier_id)
+            if tier is None:
+                tier = Tier(tier_id, included.get(('tier', tier_id), {}).get('attributes', {}).get('amount_cents', None))
+                tiers[tier_id] = tier
+            member_tiers.append(tier)
+
+        yield Membership(member.get('id'), campaign, member_tiers)
+
+def _build_campaign(campaign_id, included):
+    item = included.get(('campaign', campaign_id))
+    if item is None:
+        return None
+    creator_id = item.get('relationships', {}).get('creator', {}).get('data', {}).get('id', None)
+    creator = included.get(('user', creator_id), {}).get('attributes', {})
+    return Campaign(campaign_id, creator_id, creator.get('full_name', None), creator.get('vanity', None))
+
 class PatreonInfo():
 
     __verify_subscription_link = 'https://patreon.com/oauth2/authorize' \
@@ -16,24 +105,25 @@ class PatreonInfo():
     
     __auth_scopes = 'identity identity.memberships campaigns campaigns.members campaigns.webhook'
 
-    def __init__(self, client_id, client_secret, creator_id, creator_token, creator_refresh_token):
+    def __init__(self, client_id, client_secret, creator_id, creator_token, creator_refresh_token, campaign_id=None, token_vault=None, webhook_secret=None, session=None):
         self._client_id = client_id
         self._client_secret = client_secret
         self._creator_id = creator_id
+        # With the campaign ID known, memberships are matched on it and identities are requested in minimal mode
+        self._campaign_id = campaign_id
         self._creator_token = creator_token
         self._creator_refresh_token = creator_refresh_token
+        # With a token vault, the creator token is read from it and refreshed when Patreon rejects it
+        self._token_vault = token_vault
+        # Secret Patreon signs the webhook requests with, returned when the webhook is registered
+        self._webhook_secret = webhook_secret
+
+        # Pooled keep-alive session with timeouts and retries, shared by every call to the provider
+        self._session = session or http_session.create_session(provider='patreon')
 
-        logging.basicConfig(
-            filename='/home/communikeintest/logs/pigliamoschebot.log', 
-            encoding='utf-8', 
-            filemode='a', 
-            style="{", 
-            datefmt="%Y-%m-%d %H:%M", 
-            format="{asctime}# {levelname} - {name}.{funcName} - {message}",
-            level = logging.DEBUG)
         self.__logger = logging.getLogger(__name__)
 
-    """ Get user access token """
+    """ Get user access token, as (access_token, refresh_token, expires_in) """
     def get_access_token(self, user_code, webhook_refresh_token, debug=False):
         
         # Get the auth (and refresh) token for this user
@@ -48,112 +138,129 @@ class PatreonInfo():
         }
         if debug: self.__logger.debug(data)
 
-        response = requests.post(url, data=data, headers=headers)
+        response = self._session.post(url, data=data, headers=headers)
         response_code = response.status_code
         response_data = response.json()
 
         if response_data and all(field in response_data.keys() for field in ['access_token', 'refresh_token']):
-            return response_data['access_token'], response_data['refresh_token']
+            return response_data['access_token'], response_data['refresh_token'], response_data.get('expires_in', None)
         else:
             self.__logger.error('Error fetching user access and refresh tokens.')
-            if debug: self.__logger.debug(f'Details: {response_code} - {response_data}')
-            return None, None
-    
-    """ Check if user is a currently paying patron """
-    def is_user_paid_patron(self, access_token, debug=False):
-        is_paid_patron = False
+            if debug: self.__logger.debug('Details: %s - %s', response_code, response_data)
+            return None, None, None
 
-        patron_user_id, pledges = self.get_user_pledges(access_token, debug)
-        for pledge_id in pledges:
-            amount_cents_total = sum([tier['amount_cents'] for tier in pledges[pledge_id]['tier']])
-            if pledges[pledge_id]['creator']['id'] == self._creator_id and amount_cents_total > 0:
-                is_paid_patron = True
-        
-        return patron_user_id, is_paid_patron
+    """ Get a new access token from a refresh token, as (access_token, refresh_token, expires_in) """
+    def refresh_access_token(self, refresh_token, debug=False):
+        url = 'https://www.patreon.com/api/oauth2/token'
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        data = {
+            'client_id': self._client_id,
+            'client_secret': self._client_secret,
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token'
+        }
+
+        response = self._session.post(url, data=data, headers=headers)
+        response_data = response.json()
 
-    """ Get all pledges for a user """
+        if response_data and 'access_token' in response_data:
+            return response_data['access_token'], response_data.get('refresh_token', refresh_token), response_data.get('expires_in', None)
+        else:
+            self.__logger.error('Error refreshing access token.')
+            if debug: self.__logger.debug('Details: %s - %s', response.status_code, response_data)
+            return None, None, None
+
+    """ Get the creator token, from the token vault if there is one """
+    def get_creator_token(self):
+        token = self._token_vault.get(CREATOR_TOKEN) if self._token_vault else None
+        return token or self._creator_token
+
+    """ Send a request with the given token, or with the creator token refreshed and sent again if Patreon rejects it """
+    def _creator_request(self, method, url, token=None, **kwargs):
+        if token:
+            return http_session.send_authorized(self._session, method, url, token, lambda rejected_token: None, **kwargs)
+        return http_session.send_authorized(self._session, method, url, self.get_creator_token(), self._refresh_creator_token, **kwargs)
+
+    def _refresh_creator_token(self, rejected_token):
+        if not self._token_vault:
+            return None
+        self.__logger.warning('Creator token rejected, refreshing it')
+        try:
+            token = self._token_vault.refresh(CREATOR_TOKEN, stale_token=rejected_token)
+        except TokenRefreshError as e:
+            self.__logger.error('Could not refresh the creator token: %s', e)
+            return None
+        # The same token again means it was refreshed moments ago, sending it again would not help
+        return token if token != rejected_token else None
+    
+    """ Check if user is a currently paying patron. Stop at the first paid membership of the creator.
+    The identity is requested in minimal mode if possible, in full mode otherwise. """
+    def is_user_paid_patron(self, access_token, debug=False):
+        data = None
+        if self._campaign_id:
+            data = self.get_identity(access_token, minimal=True, debug=debug)
+            if 'data' not in data:
+                self.__logger.warning('Minimal identity request failed, falling back to the full one')
+                data = None
+        if data is None:
+            data = self.get_identity(access_token, debug=debug)
+
+        patron_user_id, memberships = parse_identity(data)
+        for membership in memberships:
+            if self._is_creator_campaign(membership.campaign) and membership.amount_cents() > 0:
+                return patron_user_id, True
+        return patron_user_id, False
+
+    def _is_creator_campaign(self, campaign):
+        if self._campaign_id:
+            return campaign.id == self._campaign_id
+        return campaign.creator_id == self._creator_id
+
+    """ Get all pledges for a user, as (patron_user_id, list of Membership) """
     def get_user_pledges(self, access_token, debug=False):
-        # Get the auth (and refresh) token for this user
+        patron_user_id, memberships = parse_identity(self.get_identity(access_token, debug=debug))
+        memberships = list(memberships)
+        if debug: self.__logger.debug('Patron %s has %s memberships', patron_user_id, len(memberships))
+        return patron_user_id, memberships
+
+    """ Get the identity of a user with their memberships, campaigns, creators and tiers.
+    In minimal mode, only the campaign IDs and the tier amounts come along: no creator and no attribute we don't use. """
+    def get_identity(self, access_token, minimal=False, debug=False):
         url = 'https://www.patreon.com/api/oauth2/v2/identity'
         headers = {
         "Authorization": f"Bearer {access_token}"
         }
-        params_pledge = {
-            "include": "memberships.campaign.creator,memberships.currently_entitled_tiers",
-            "fields[user]": "full_name,vanity",
-            "fields[tier]": "amount_cents",
-        }
-        response = requests.get(url, headers=headers, params=params_pledge)
-        data = response.json()
-
-        # Parse patron user id
-        patron_user_id = data.get("data", {}).get("id", None)
-        if debug: self.__logger.debug(f'Patron user ID: {patron_user_id}')
-
-        # Parse creators info
-        creators_raw = [item for item in data.get("included", []) if item["type"] == "user"]
-        creators = {}
-        for item in creators_raw:
-            creators[item.get('id')] = item.get("attributes", {})
-        if debug: self.__logger.debug(f'Creators info: {creators}')
-        
-        # Parse campaigns info
-        campaigns_raw = [item for item in data.get("included", []) if item["type"] == "campaign"]
-        campaigns = {}
-        for item in campaigns_raw:
-            campaign_id = item.get('id')
-            creator_id = item.get("relationships", {}).get("creator", {}).get("data", {}).get("id", None)
-            campaigns[campaign_id] = {
-                'creator_id': creator_id,
-                'creator_info': creators[creator_id]
+        if minimal:
+            params_pledge = {
+                "include": "memberships.campaign,memberships.currently_entitled_tiers",
+                "fields[tier]": "amount_cents",
             }
-        if debug: self.__logger.debug(f'Campaigns info: {campaigns}')
-
-        # Parse memberships info
-        memberships_raw = [item for item in data.get("included", []) if item["type"] == "member"]
-        memberships = {}
-        for membership in memberships_raw:
-            member_id = membership.get("id")
-            campaign_id = membership.get("relationships", {}).get("campaign", {}).get("data", {}).get("id", None)
-            tiers_id_raw = membership.get("relationships", {}).get("currently_entitled_tiers", {}).get("data", [])
-
-            if campaign_id in campaigns:
-                memberships[member_id] = {
-                    'campaign': {
-                        'id': campaign_id,
-                    },
-                    'creator': {
-                        'id': campaigns[campaign_id]['creator_id'],
-                        'full_name': campaigns[campaign_id]['creator_info']['full_name'],
-                        'vanity': campaigns[campaign_id]['creator_info']['vanity'],
-                    },
-                    'tier': [{
-                        'id': tier.get('id', None),
-                        'amount_cents': None
-                    } for tier in tiers_id_raw]
-                }
-        if debug: self.__logger.debug(f'Memberships info: {memberships}')
-
-        # Parse tiers info
-        tiers_raw = [item for item in data.get("included", []) if item["type"] == "tier"]
-        tiers = {}
-        for tier in tiers_raw:
-            tier_id = tier.get("id")
-            tier_amount_cents = tier.get("attributes", {}).get("amount_cents", None)
-
-            tiers[tier_id] = {
-                'amount_cents': tier_amount_cents
+        else:
+            params_pledge = {
+                "include": "memberships.campaign.creator,memberships.currently_entitled_tiers",
+                "fields[user]": "full_name,vanity",
+                "fields[tier]": "amount_cents",
             }
-        if debug: self.__logger.debug(f'Tiers info: {tiers}')
-        
-        # Combine all info
-        for membership_id in memberships:
-            for tier in memberships[membership_id]['tier']:
-                tier_selected = tiers[tier['id']]
-                tier['amount_cents'] = tier_selected['amount_cents']
-        self.__logger.info(f'Pledges information: {memberships}')
-        
-        return patron_user_id, memberships
+        response = self._session.get(url, headers=headers, params=params_pledge)
+        data = response.json()
+        if debug: self.__logger.debug('Identity response: %s - %s bytes', response.status_code, len(response.content))
+        return data
+
+    """ Parse a member webhook. Return (patreon_user_id, full_name, lapsed), lapsed being True if the member lost access. """
+    def parse_member_webhook(self, trigger, data):
+        member = data.get('data', {})
+        attributes = member.get('attributes', {})
+        patreon_user_id = member.get('relationships', {}).get('user', {}).get('data', {}).get('id', None)
+        full_name = attributes.get('full_name', None)
+
+        if trigger in TRIGGERS_MEMBER_DELETED:
+            lapsed = True
+        elif trigger in TRIGGERS_MEMBER_UPDATED:
+            lapsed = attributes.get('patron_status', None) not in PATRON_STATUS_ACTIVE
+        else:
+            lapsed = False
+
+        return patreon_user_id, full_name, lapsed
 
     """ Return the link to verify if a user is subscribed """
     def get_verify_subscription_link(self, callback_webhook, state_csrf):
@@ -166,51 +273,73 @@ class PatreonInfo():
 
 
 
+    """ Stream the members of a campaign as (patreon_user_id, patron_status), one page in memory at a time """
+    def iter_campaign_members(self, campaign_id, token=None, page_size=1000, debug=False):
+
+        url = f'https://www.patreon.com/api/oauth2/v2/campaigns/{campaign_id}/members'
+        # Only the fields needed: the member status and the ID of its user
+        params = {
+            'include': 'user',
+            'fields[member]': 'patron_status',
+            'fields[user]': 'vanity',
+            'page[count]': page_size,
+        }
+
+        while True:
+            response = self._creator_request('GET', url, token, params=params)
+            data = response.json()
+            if 'data' not in data:
+                # Raise rather than stop, so a partial listing is never mistaken for the full one
+                self.__logger.error('Error fetching campaign members.')
+                if debug: self.__logger.debug('Details: %s - %s', response.status_code, data)
+                raise RuntimeError(f'Error fetching campaign members: {response.status_code}')
+
+            for member in data['data']:
+                patreon_user_id = member.get('relationships', {}).get('user', {}).get('data', {}).get('id', None)
+                yield patreon_user_id, member.get('attributes', {}).get('patron_status', None)
+
+            cursor = data.get('meta', {}).get('pagination', {}).get('cursors', {}).get('next', None)
+            if not cursor:
+                return
+            params['page[cursor]'] = cursor
+
     """ Get list of events with webhook subscribed """
     def get_events_subscribed(self, token=None, debug=False):
 
-        if not token: token = self._creator_token
-
         url = 'https://www.patreon.com/api/oauth2/v2/webhooks'
-        headers = {'Authorization': f'Bearer {token}'}
         params = {
             "fields[webhook]": "last_attempted_at,num_consecutive_times_failed,paused,secret,triggers,uri",
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        response = self._creator_request('GET', url, token, params=params)
         data = response.json()
 
         if data and 'data' in data:
             if len(data['data']) > 0:
                 events_subscribed = data['data']
-                self.__logger.info(f'Found {len(events_subscribed)} events.')
-                if debug: self.__logger.debug(f'Details: {events_subscribed}')
+                self.__logger.info('Found %s events.', len(events_subscribed))
+                if debug: self.__logger.debug('Details: %s', events_subscribed)
                 return events_subscribed
             else:
                 self.__logger.info('Found 0 events.')
                 return []
         else:
             self.__logger.error('Error fetching event subscription details.')
-            if debug: self.__logger.debug(f'Details: {data}')
+            if debug: self.__logger.debug('Details: %s', data)
             return None
 
     """ Register a webhook for channel subscription end. """
     def register_unsubscribe_webhook(self, callback_webhook, campaign_id, token=None, debug=False):
 
-        # If no token is provided, use the creator token
-        if not token: token = self._creator_token
-
-        # If webhook already registered, do not register a new one
+        # If webhook already registered, do not register a new one, return it (with its secret) instead
         events_subscribed = self.get_events_subscribed(token=token)
-        if debug: self.__logger.debug(f"Already registered webhooks: {events_subscribed}")
-        if events_subscribed and [e for e in events_subscribed if e['attributes']['uri'] == callback_webhook]:
-            return 409, None
+        if debug: self.__logger.debug("Already registered webhooks: %s", events_subscribed)
+        registered = [e for e in events_subscribed or [] if e['attributes']['uri'] == callback_webhook]
+        if registered:
+            return 409, {'data': registered[0]}
 
         # Otherwise, register the webhook
         url = 'https://www.patreon.com/api/oauth2/v2/webhooks'
-        headers = {
-            'Authorization': f'Bearer {token}'
-        }
         triggers = ['members:pledge:delete', 'members:pledge:update', 'members:delete', 'members:update']
         data = {
             "data": {
@@ -226,32 +355,45 @@ class PatreonInfo():
                 },
             },
         }
-        response = requests.post(url, json=data, headers=headers)
+        # If no token is provided, use the creator token
+        response = self._creator_request('POST', url, token, json=data)
         response_json = response.json()
         response_code = response.status_code
-        self.__logger.info(f"Registering the user unsubscribed event: {response_code} - {response_json}")
+        self.__logger.info("Registering the user unsubscribed event: %s - %s", response_code, response_json)
 
         return response_code, response_json
     
+    """ Secret of a registered webhook, from the data returned by register_unsubscribe_webhook() """
+    def webhook_secret(self, webhook_data):
+        return ((webhook_data or {}).get('data') or {}).get('attributes', {}).get('secret', None)
+
+    def set_webhook_secret(self, secret):
+        self._webhook_secret = secret
+
+    """ Check the signature of a webhook request: X-Patreon-Signature is the HMAC-MD5 of the raw body with the webhook secret """
+    def verify_webhook_signature(self, headers, body):
+        signature = headers.get('X-Patreon-Signature')
+        if not (self._webhook_secret and signature):
+            return False
+        expected = hmac.new(self._webhook_secret.encode('utf-8'), body, hashlib.md5).hexdigest()
+        return hmac.compare_digest(expected, signature.lower())
+
     """ Delete a webhook by ID. """
     # curl -H 'Authorization: Bearer {TOKEN}' -X DELETE https://www.patreon.com/api/oauth2/v2/webhooks/{ID}
     def delete_webhook(self, webhook_id, token=None, debug=False):
-        self.__logger.info(f'Deleting webhook id {webhook_id}.')
-
-        if not token: token = self._creator_token
+        self.__logger.info('Deleting webhook id %s.', webhook_id)
 
         url = f'https://www.patreon.com/api/oauth2/v2/webhooks/{webhook_id}'
-        headers = {'Authorization': f'Bearer {token}'}
 
-        response = requests.delete(url, headers=headers)
+        response = self._creator_request('DELETE', url, token)
         response_code = response.status_code
 
         if response_code == 204:
-            self.__logger.info(f'Deleted webhook id {webhook_id}.')
+            self.__logger.info('Deleted webhook id %s.', webhook_id)
             return True
         else:
-            self.__logger.error(f'Error deleting webhook id {webhook_id}.')
-            if debug: self.__logger.debug(f'Details: {response_code} - {response.json()}')
+            self.__logger.error('Error deleting webhook id %s.', webhook_id)
+            if debug: self.__logger.debug('Details: %s - %s', response_code, response.json())
             return False
     
     """ Delete all webhooks. """
@@ -1,10 +1,23 @@
+import hashlib
+import hmac
 import logging
-import requests
+import threading
+import time
+import datetime
 import urllib.parse
 
+import http_session
+from token_vault import TokenRefreshError
+
 PLATFORM = 'platform-twitch'
 PLATFORM_NAME = 'Twitch'
 
+APP_TOKEN_REFRESH_MARGIN = 60 * 5   # Refresh the app access token this many seconds before it expires
+EVENTSUB_MAX_MESSAGE_AGE = 60 * 10  # EventSub messages older than this are rejected, as recommended by Twitch
+SUBSCRIPTIONS_PAGE_SIZE = 100       # Maximum page size of helix/subscriptions
+
+BROADCASTER_TOKEN = 'twitch-broadcaster'    # Name of the broadcaster token in the token vault
+
 class TwitchInfo():
 
     #TODO: Fix 400 Error "Missing Response Type": https://discuss.dev.twitch.com/t/how-to-resolve-missing-response-type/37674
@@ -17,25 +30,33 @@ class TwitchInfo():
         '&redirect_uri={redirect_uri}' \
         '&state={state_csrf}'
 
-    def __init__(self, client_id, client_secret, twitch_secret, channel_id, channel_username):
+    def __init__(self, client_id, client_secret, twitch_secret, channel_id, channel_username, broadcaster_token=None, token_vault=None, session=None):
         self._client_id = client_id
         self._client_secret = client_secret
         self._twitch_secret = twitch_secret
         self._channel_id = channel_id
         self._channel_username = channel_username
 
-        logging.basicConfig(
-            filename='/home/communikeintest/logs/pigliamoschebot.log', 
-            encoding='utf-8', 
-            filemode='a', 
-            style="{", 
-            datefmt="%Y-%m-%d %H:%M", 
-            format="{asctime}# {levelname} - {name}.{funcName} - {message}",
-            level = logging.DEBUG)
+        # Pooled keep-alive session with timeouts and retries, shared by every call to the provider
+        self._session = session or http_session.create_session(provider='twitch')
+
+        # Cached app access token. The lock makes concurrent refreshes wait for a single request.
+        self._app_token = None
+        self._app_token_expires_at = 0
+        self._app_token_lock = threading.Lock()
+
+        # Channel metadata never changes at runtime, so it is fetched at most once
+        self._channel_data = None
+
+        # User token of the broadcaster (scope channel:read:subscriptions), needed to list the channel subscribers.
+        # With a token vault, it is stored there and refreshed when Twitch rejects it.
+        self._broadcaster_token = broadcaster_token
+        self._token_vault = token_vault
+
         self.__logger = logging.getLogger(__name__)
 
 
-    """ Get user token """
+    """ Get user token, as (access_token, refresh_token, expires_in) """
     def get_user_access_token(self, code, callback_webhook, debug=False):
         url = 'https://id.twitch.tv/oauth2/token'
         params = {
@@ -45,41 +66,102 @@ class TwitchInfo():
             'grant_type': 'authorization_code',
             'redirect_uri': callback_webhook
         }
-        print('TEST - TwitchInfo - ', params)
-
-        response = requests.post(url, params=params)
+        response = self._session.post(url, params=params)
         data = response.json()
         if debug: self.__logger.debug(data)
 
         if data and all(field in data.keys() for field in ['access_token', 'refresh_token']):
-            return data['access_token'], data['refresh_token']
+            return data['access_token'], data['refresh_token'], data.get('expires_in', None)
         else:
             self.__logger.error('Error fetching user access and refresh tokens.')
-            if debug: self.__logger.debug(f'Details: {data}')
-            return None, None
+            if debug: self.__logger.debug('Details: %s', data)
+            return None, None, None
 
-    """ Get app token """
-    def get_app_access_token(self, debug=False):
+    """ Get a new user token from a refresh token, as (access_token, refresh_token, expires_in) """
+    def refresh_access_token(self, refresh_token, debug=False):
         url = 'https://id.twitch.tv/oauth2/token'
         data = {
             'client_id': self._client_id,
             'client_secret': self._client_secret,
-            'grant_type': 'client_credentials'
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token'
         }
 
-        response = requests.post(url, data=data)
+        response = self._session.post(url, data=data)
         data = response.json()
-        if debug: self.__logger.debug(data)
 
         if data and 'access_token' in data:
-            return data['access_token']
+            return data['access_token'], data.get('refresh_token', refresh_token), data.get('expires_in', None)
         else:
-            self.__logger.error('Error fetching app access token.')
-            if debug: self.__logger.debug(f'Details: {data}')
-            return None
-
-    """ Get channel ID and username """
+            self.__logger.error('Error refreshing user access token.')
+            if debug: self.__logger.debug('Details: %s - %s', response.status_code, data)
+            return None, None, None
+
+    """ Get app token, from the cache unless it is about to expire """
+    def get_app_access_token(self, debug=False, force_refresh=False):
+        if not force_refresh and self._is_app_token_valid():
+            return self._app_token
+
+        with self._app_token_lock:
+            # Another thread may have refreshed the token while this one was waiting
+            if not force_refresh and self._is_app_token_valid():
+                return self._app_token
+
+            url = 'https://id.twitch.tv/oauth2/token'
+            data = {
+                'client_id': self._client_id,
+                'client_secret': self._client_secret,
+                'grant_type': 'client_credentials'
+            }
+
+            response = self._session.post(url, data=data)
+            data = response.json()
+            if debug: self.__logger.debug(data)
+
+            if data and 'access_token' in data:
+                self._app_token = data['access_token']
+                self._app_token_expires_at = time.monotonic() + data.get('expires_in', 0) - APP_TOKEN_REFRESH_MARGIN
+                return self._app_token
+            else:
+                self.__logger.error('Error fetching app access token.')
+                if debug: self.__logger.debug('Details: %s', data)
+                return None
+
+    """ Drop the cached app token, e.g. after Twitch rejected it """
+    def invalidate_app_access_token(self):
+        with self._app_token_lock:
+            self._app_token = None
+            self._app_token_expires_at = 0
+
+    """ Send a request with the given token, or with the app token fetched again and sent again if Twitch rejects it """
+    def _app_request(self, method, url, token=None, headers=None, **kwargs):
+        headers = {'Client-ID': self._client_id, **(headers or {})}
+        if token:
+            return http_session.send_authorized(self._session, method, url, token, lambda rejected_token: None, headers=headers, **kwargs)
+        return http_session.send_authorized(self._session, method, url, self.get_app_access_token(), self._refresh_app_token, headers=headers, **kwargs)
+
+    def _refresh_app_token(self, rejected_token):
+        with self._app_token_lock:
+            # Another thread may have fetched a new token already
+            if self._app_token != rejected_token and self._is_app_token_valid():
+                return self._app_token
+            self._app_token = None
+            self._app_token_expires_at = 0
+        self.__logger.warning('App token rejected, fetching a new one')
+        return self.get_app_access_token()
+
+    def _is_app_token_valid(self):
+        return self._app_token is not None and time.monotonic() < self._app_token_expires_at
+
+    """ Get channel ID (known from the configuration, no network call needed) """
+    def get_channel_id(self):
+        return self._channel_id
+
+    """ Get channel ID and username (cached after the first successful call) """
     def get_channel_data(self, access_token, debug=False):
+        if self._channel_data:
+            return self._channel_data
+
         headers = {
             'Client-ID': self._client_id,
             'Authorization': f'Bearer {access_token}'
@@ -87,16 +169,17 @@ class TwitchInfo():
 
         url = 'https://api.twitch.tv/helix/users'
         params = {'login': self._channel_username}
-        response = requests.get(url, headers=headers, params=params)
+        response = self._session.get(url, headers=headers, params=params)
         data = response.json()
         if debug: self.__logger.debug(data)
 
         if 'data' in data and 'id' in data['data'][0]:
             id = data['data'][0]['id']
-            return self._channel_username, id
+            self._channel_data = (self._channel_username, id)
+            return self._channel_data
         else:
             self.__logger.error('Error fetching channel ID.')
-            if debug: self.__logger.debug(f'Details: {data}')
+            if debug: self.__logger.debug('Details: %s', data)
             return None, None
 
     """ Get user ID and username """
@@ -109,7 +192,7 @@ class TwitchInfo():
         url = 'https://id.twitch.tv/oauth2/validate'
         params = {}
 
-        response = requests.get(url, headers=headers, params=params)
+        response = self._session.get(url, headers=headers, params=params)
         data = response.json()
         if debug: self.__logger.debug(data)
 
@@ -119,7 +202,7 @@ class TwitchInfo():
             return username, id
         else:
             self.__logger.error('Error fetching user ID.')
-            if debug: self.__logger.debug(f'Details: {data}')
+            if debug: self.__logger.debug('Details: %s', data)
             return None, None
 
     """ Check if user is subscribed to channel """
@@ -134,7 +217,7 @@ class TwitchInfo():
             'Authorization': f'Bearer {access_token}'
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        response = self._session.get(url, headers=headers, params=params)
         data = response.json()
         if debug: self.__logger.debug(data)
 
@@ -143,21 +226,70 @@ class TwitchInfo():
             return subscription_details
         else:
             self.__logger.error('Error fetching subscription details.')
-            if debug: self.__logger.debug(f'Details: {data}')
+            if debug: self.__logger.debug('Details: %s', data)
             return None
 
+    """ Set the user token of the broadcaster, e.g. after the channel owner went through the OAuth flow """
+    def set_broadcaster_token(self, access_token, refresh_token=None, expires_in=None):
+        if self._token_vault:
+            self._token_vault.store(BROADCASTER_TOKEN, PLATFORM, access_token, refresh_token, expires_in, keep_fresh=True)
+        else:
+            self._broadcaster_token = access_token
+
+    """ Get the user token of the broadcaster, from the token vault if there is one """
+    def get_broadcaster_token(self):
+        token = self._token_vault.get(BROADCASTER_TOKEN) if self._token_vault else None
+        return token or self._broadcaster_token
+
+    def has_broadcaster_token(self):
+        return self.get_broadcaster_token() is not None
+
+    def _refresh_broadcaster_token(self, rejected_token):
+        if not self._token_vault:
+            return None
+        self.__logger.warning('Broadcaster token rejected, refreshing it')
+        try:
+            token = self._token_vault.refresh(BROADCASTER_TOKEN, stale_token=rejected_token)
+        except TokenRefreshError as e:
+            self.__logger.error('Could not refresh the broadcaster token: %s', e)
+            return None
+        # The same token again means it was refreshed moments ago, sending it again would not help
+        return token if token != rejected_token else None
+
+    """ Walk the channel subscribers page by page, starting after `cursor`.
+    Yield (subscriber_user_ids, next_cursor) for each page, next_cursor being None on the last one. """
+    def iter_subscription_pages(self, cursor=None, page_size=SUBSCRIPTIONS_PAGE_SIZE, debug=False):
+        url = 'https://api.twitch.tv/helix/subscriptions'
+        headers = {'Client-ID': self._client_id}
+        params = {
+            'broadcaster_id': self._channel_id,
+            'first': page_size
+        }
+
+        while True:
+            if cursor: params['after'] = cursor
+            response = http_session.send_authorized(self._session, 'GET', url, self.get_broadcaster_token(), self._refresh_broadcaster_token, headers=headers, params=params)
+            data = response.json()
+            if 'data' not in data:
+                # Raise rather than stop, so a partial listing is never mistaken for the full one
+                self.__logger.error('Error fetching channel subscriptions.')
+                if debug: self.__logger.debug('Details: %s - %s', response.status_code, data)
+                raise RuntimeError(f'Error fetching channel subscriptions: {response.status_code}')
+
+            cursor = data.get('pagination', {}).get('cursor', None)
+            # The last page may still carry a cursor, an empty page is the end too
+            if not data['data']: cursor = None
+            yield [subscription['user_id'] for subscription in data['data']], cursor
+            if not cursor:
+                return
+
     """ Get list of events with webhook subscribed """
     def get_events_subscribed(self, token=None, any_status=False, debug=False):
 
-        if not token: token = self.get_app_access_token()
-
         url = 'https://api.twitch.tv/helix/eventsub/subscriptions'
-        headers = {
-            'Client-ID': self._client_id,
-            'Authorization': f'Bearer {token}'
-        }
 
-        response = requests.get(url, headers=headers)
+        # If no token is provided, use the app token
+        response = self._app_request('GET', url, token)
         data = response.json()
         if debug: self.__logger.debug(data)
 
@@ -166,36 +298,35 @@ class TwitchInfo():
                 events_subscribed = data['data']
                 if not any_status:
                     events_subscribed = [event for event in data['data'] if event['status'] == 'enabled']
-                self.__logger.info(f'Found {len(events_subscribed)} events.')
-                if debug: self.__logger.debug(f'Details: {events_subscribed}')
+                self.__logger.info('Found %s events.', len(events_subscribed))
+                if debug: self.__logger.debug('Details: %s', events_subscribed)
                 return events_subscribed
             else:
                 self.__logger.info('Found 0 events.')
                 return []
         else:
             self.__logger.error('Error fetching event subscription details.')
-            if debug: self.__logger.debug(f'Details: {data}')
+            if debug: self.__logger.debug('Details: %s', data)
             return None
 
     """ Register a webhook for channel subscription end. """
-    def register_unsubscribe_webhook(self, callback_webhook, debug=False):
+    # With resubscribe=True, an existing subscription is deleted and created again, e.g. to change its secret.
+    def register_unsubscribe_webhook(self, callback_webhook, resubscribe=False, debug=False):
 
         event_type = "channel.subscription.end"
 
-        # Get the app access token
-        app_access_token = self.get_app_access_token()
-
         # If webhook already subscribed, return
-        events_subscribed = self.get_events_subscribed(token=app_access_token)
-        if events_subscribed and [e for e in events_subscribed if e['type'] == event_type and e['transport']['callback'] == callback_webhook]:
+        events_subscribed = self.get_events_subscribed()
+        registered = [e for e in events_subscribed or [] if e['type'] == event_type and e['transport']['callback'] == callback_webhook]
+        if registered and not resubscribe:
             self.__logger.info('Webhook already registered')
             return 202, None
+        for event in registered:
+            self.delete_event_subscription(event['id'], debug=debug)
 
         # If webhook not already subscribed, subscribe to webhook
         url = "https://api.twitch.tv/helix/eventsub/subscriptions"
         headers = {
-            "Client-ID": self._client_id,
-            "Authorization": f"Bearer {app_access_token}",
             "Content-Type": "application/json",
         }
         data = {
@@ -205,10 +336,10 @@ class TwitchInfo():
             "transport": {
                 "method": "webhook",
                 "callback": callback_webhook,
-                "secret": "your_webhook_secret",
+                "secret": self._twitch_secret,
             },
         }
-        response = requests.post(url, json=data, headers=headers)
+        response = self._app_request('POST', url, headers=headers, json=data)
         response_code = response.status_code
         response_data = response.json()
         self.__logger.info('Trying to register the user unsubscribed event')
@@ -216,6 +347,39 @@ class TwitchInfo():
 
         return response_code, response_data
 
+    """ Delete an EventSub subscription by ID """
+    def delete_event_subscription(self, subscription_id, debug=False):
+        url = 'https://api.twitch.tv/helix/eventsub/subscriptions'
+
+        response = self._app_request('DELETE', url, params={'id': subscription_id})
+        if response.status_code == 204:
+            self.__logger.info('Deleted EventSub subscription %s.', subscription_id)
+            return True
+        else:
+            self.__logger.error('Error deleting EventSub subscription %s.', subscription_id)
+            if debug: self.__logger.debug('Details: %s - %s', response.status_code, response.text)
+            return False
+
+    """ Check the HMAC-SHA256 signature of an EventSub message from its headers and raw body, without parsing it """
+    def verify_eventsub_signature(self, headers, body):
+        message_id = headers.get('Twitch-Eventsub-Message-Id')
+        timestamp = headers.get('Twitch-Eventsub-Message-Timestamp')
+        signature = headers.get('Twitch-Eventsub-Message-Signature')
+        if not (message_id and timestamp and signature):
+            return False
+
+        # Reject replays of old messages. The timestamp is RFC3339 with nanoseconds, keep it to the second.
+        try:
+            sent_at = datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            return False
+        if abs(time.time() - sent_at.timestamp()) > EVENTSUB_MAX_MESSAGE_AGE:
+            return False
+
+        message = message_id.encode('utf-8') + timestamp.encode('utf-8') + body
+        expected = 'sha256=' + hmac.new(self._twitch_secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
     """ Return the link to verify if a user is subscribed """
     def get_verify_subscription_link(self, callback_webhook, state_csrf):
         if self._client_id:
@@ -0,0 +1,43 @@
+import logging
+import threading
+
+""" Run a function periodically on a daemon thread until stopped """
+class PeriodicTask():
+
+    def __init__(self, name, interval, function, *args, **kwargs):
+        self.name = name
+        self.interval = interval
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.__logger = logging.getLogger(__name__)
+
+    """ Start the background thread (no-op if already running) """
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    """ Ask the background thread to stop and wait for it """
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    """ Run the function once right away, in the calling thread """
+    def run_once(self):
+        return self._function(*self._args, **self._kwargs)
+
+    def _run(self):
+        # Wait first, so starting the task never adds work to the startup path
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                # Keep the task alive: a failed run is retried at the next interval
+                self.__logger.exception('Periodic task %s failed: %s', self.name, e)
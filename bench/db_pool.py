@@ -0,0 +1,74 @@
+""" Microbenchmark of the database connection pool against opening a connection per call.
+
+Runs the same insert and lookup with database.py (pooled connections) and with the open-per-call
+pattern the helpers used before the pool, on the same database file in a temporary directory.
+
+    python bench/db_pool.py [--ops 3000] [--threads 1]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Open per call, as before the pool
+def store_link_per_call(db_name, telegram_user_id, invite_link):
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO LinkInfo (telegram_user_id, twitch_user_id, patreon_user_id, invite_link) VALUES (?, ?, ?, ?)", (telegram_user_id, None, None, invite_link))
+    conn.commit()
+    conn.close()
+
+def user_owns_link_per_call(db_name, telegram_user_id, invite_link):
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM LinkInfo WHERE telegram_user_id = ? AND invite_link = ?", (telegram_user_id, invite_link))
+    records = cursor.fetchall()
+    conn.close()
+    return len(records) > 0
+
+""" Run `call(i)` for i in range(ops), split over `threads` threads, and return the operations per second """
+def measure(call, ops, threads):
+    def work(start):
+        for i in range(start, ops, threads):
+            call(i)
+
+    workers = [threading.Thread(target=work, args=(start,)) for start in range(threads)]
+    started_at = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return ops / (time.perf_counter() - started_at)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ops', type=int, default=3000)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    # database.py uses a relative DB_NAME: import it from the temporary directory
+    directory = tempfile.TemporaryDirectory(prefix='bench-db-pool-')
+    os.chdir(directory.name)
+    import database
+    database.check_or_create_db()
+
+    results = [
+        ('insert', 'open per call', lambda i: store_link_per_call(database.DB_NAME, i, f'https://t.me/+a{i}')),
+        ('insert', 'pooled', lambda i: database.store_link(i, None, None, f'https://t.me/+b{i}')),
+        ('user_owns_link', 'open per call', lambda i: user_owns_link_per_call(database.DB_NAME, i, f'https://t.me/+a{i}')),
+        ('user_owns_link', 'pooled', lambda i: database.user_owns_link(i, f'https://t.me/+b{i}')),
+    ]
+    print(f'{args.ops} operations, {args.threads} thread(s), pool size {database.DB_POOL_SIZE}')
+    for operation, mode, call in results:
+        print(f'{operation:<16} {mode:<14} {measure(call, args.ops, args.threads):>10.0f} ops/s')
+    database.close_all_connections()
+    os.chdir('/')
+    directory.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+""" Benchmark of the Patreon identity parser on large synthetic identity payloads.
+
+Compares PatreonHelper.parse_identity() and the paid-membership match of is_user_paid_patron() with the
+parser it replaced (four passes over `included` into nested dicts, logged as a whole), on payloads of n
+memberships with our creator's membership first, last or absent. Reports the time and the peak memory of
+parsing and matching (the JSON is decoded beforehand).
+
+    python bench/patreon_identity.py [--sizes 1000 10000] [--runs 5]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import PatreonHelper
+import patreon_payloads
+
+# Parser of get_user_pledges() and match of is_user_paid_patron() before parse_identity()
+def is_paid_patron_before(data, creator_id):
+    creators = {}
+    for item in [item for item in data.get("included", []) if item["type"] == "user"]:
+        creators[item.get('id')] = item.get("attributes", {})
+
+    campaigns = {}
+    for item in [item for item in data.get("included", []) if item["type"] == "campaign"]:
+        campaign_creator_id = item.get("relationships", {}).get("creator", {}).get("data", {}).get("id", None)
+        campaigns[item.get('id')] = {'creator_id': campaign_creator_id, 'creator_info': creators[campaign_creator_id]}
+
+    memberships = {}
+    for membership in [item for item in data.get("included", []) if item["type"] == "member"]:
+        campaign_id = membership.get("relationships", {}).get("campaign", {}).get("data", {}).get("id", None)
+        tiers_id_raw = membership.get("relationships", {}).get("currently_entitled_tiers", {}).get("data", [])
+        if campaign_id in campaigns:
+            memberships[membership.get("id")] = {
+                'campaign': {'id': campaign_id},
+                'creator': {
+                    'id': campaigns[campaign_id]['creator_id'],
+                    'full_name': campaigns[campaign_id]['creator_info']['full_name'],
+                    'vanity': campaigns[campaign_id]['creator_info']['vanity'],
+                },
+                'tier': [{'id': tier.get('id', None), 'amount_cents': None} for tier in tiers_id_raw]
+            }
+
+    tiers = {}
+    for tier in [item for item in data.get("included", []) if item["type"] == "tier"]:
+        tiers[tier.get("id")] = {'amount_cents': tier.get("attributes", {}).get("amount_cents", None)}
+
+    for membership_id in memberships:
+        for tier in memberships[membership_id]['tier']:
+            tier['amount_cents'] = tiers[tier['id']]['amount_cents']
+    # The f-string of the INFO log was built on every call, whatever the log level
+    f'Pledges information: {memberships}'
+
+    is_paid_patron = False
+    for pledge_id in memberships:
+        amount_cents_total = sum([tier['amount_cents'] for tier in memberships[pledge_id]['tier']])
+        if memberships[pledge_id]['creator']['id'] == creator_id and amount_cents_total > 0:
+            is_paid_patron = True
+    return is_paid_patron
+
+# Same match as PatreonInfo.is_user_paid_patron() without a campaign ID
+def is_paid_patron_after(data, creator_id):
+    _, memberships = PatreonHelper.parse_identity(data)
+    for membership in memberships:
+        if membership.campaign.creator_id == creator_id and membership.amount_cents() > 0:
+            return True
+    return False
+
+""" Median time (ms) over `runs` runs, and peak memory (KiB) of one run """
+def measure(function, data, runs):
+    times = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        result = function(data, patreon_payloads.CREATOR_ID)
+        times.append((time.perf_counter() - started_at) * 1000)
+
+    tracemalloc.start()
+    function(data, patreon_payloads.CREATOR_ID)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, statistics.median(times), peak / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{"n":>7}  {"match":<6} {"before ms / peak KiB":>22} {"after ms / peak KiB":>22}')
+    for n in args.sizes:
+        for match in patreon_payloads.MATCHES:
+            data = patreon_payloads.identity(n, match)
+            paid_before, ms_before, kib_before = measure(is_paid_patron_before, data, args.runs)
+            paid_after, ms_after, kib_after = measure(is_paid_patron_after, data, args.runs)
+            assert paid_before == paid_after == (match != 'none')
+            print(f'{n:>7}  {match:<6} {ms_before:>12.1f} / {kib_before:<7.0f} {ms_after:>12.1f} / {kib_after:<7.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+""" Comparison of the full and the minimal Patreon identity requests: response bytes and parse time.
+
+Each response goes through PatreonInfo.is_user_paid_patron() from a stub session, so the time covers
+the JSON decoding, parse_identity() and the match: on the creator ID in full mode, on the campaign ID
+in minimal mode. The responses come from bench/fixtures/patreon_identity_<mode>_<n>.json, n being the
+number of memberships of the patron, or are generated with --sizes.
+
+The fixtures are synthetic (bench/patreon_payloads.py, our membership last): recording real identity
+responses takes a patron's OAuth token, and they would carry other people's data.
+
+    python bench/patreon_identity_modes.py [--sizes 200] [--runs 1000]
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import PatreonHelper
+import patreon_payloads
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+""" Session answering the identity request with the fixture of the requested mode """
+class StubSession():
+
+    def __init__(self, full, minimal):
+        self._full = full
+        self._minimal = minimal
+
+    def get(self, url, headers=None, params=None):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self._full if 'creator' in params['include'] else self._minimal
+        return response
+
+def fixtures():
+    sizes = set()
+    for path in glob.glob(os.path.join(FIXTURES, 'patreon_identity_full_*.json')):
+        sizes.add(int(re.search(r'_(\d+)\.json$', path).group(1)))
+    for n in sorted(sizes):
+        with open(os.path.join(FIXTURES, f'patreon_identity_full_{n}.json'), 'rb') as full, \
+                open(os.path.join(FIXTURES, f'patreon_identity_minimal_{n}.json'), 'rb') as minimal:
+            yield n, full.read(), minimal.read()
+
+def generated(sizes):
+    for n in sizes:
+        full = json.dumps(patreon_payloads.identity(n), separators=(',', ':')).encode()
+        minimal = json.dumps(patreon_payloads.identity(n, minimal=True), separators=(',', ':')).encode()
+        yield n, full, minimal
+
+""" Median time (us) of is_user_paid_patron() over `runs` runs """
+def measure(patreon_info, runs):
+    times = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        _, paid = patreon_info.is_user_paid_patron('token')
+        times.append((time.perf_counter() - started_at) * 1000000)
+    assert paid
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='*', default=[], help='also compare generated responses of these sizes')
+    parser.add_argument('--runs', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f'{"memberships":>11}  {"full bytes / us":>18}  {"minimal bytes / us":>18}')
+    for n, full, minimal in list(fixtures()) + list(generated(args.sizes)):
+        session = StubSession(full, minimal)
+        full_info = PatreonHelper.PatreonInfo('id', 'secret', patreon_payloads.CREATOR_ID, 'token', 'refresh', session=session)
+        minimal_info = PatreonHelper.PatreonInfo('id', 'secret', patreon_payloads.CREATOR_ID, 'token', 'refresh', campaign_id=patreon_payloads.CAMPAIGN_ID, session=session)
+        full_us = measure(full_info, args.runs)
+        minimal_us = measure(minimal_info, args.runs)
+        print(f'{n:>11}  {len(full):>8} / {full_us:<7.1f}  {len(minimal):>8} / {minimal_us:<7.1f}')
+
+if __name__ == '__main__':
+    main()
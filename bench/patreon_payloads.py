@@ -0,0 +1,73 @@
+""" Synthetic Patreon identity responses, in the JSON:API shape of GET /api/oauth2/v2/identity.
+
+Each of the n memberships belongs to its own campaign, run by its own creator, with one entitled tier.
+The membership of our campaign (CREATOR_ID / CAMPAIGN_ID) is placed first, last or nowhere.
+
+    python bench/patreon_payloads.py 20 last minimal > identity.json
+"""
+import json
+import sys
+
+CREATOR_ID = '1000'
+CAMPAIGN_ID = '2000'
+PATRON_ID = '9000'
+
+MATCHES = ('first', 'last', 'none')
+
+def _campaign_of(i, n, match):
+    ours = (match == 'first' and i == 0) or (match == 'last' and i == n - 1)
+    return (CAMPAIGN_ID, CREATOR_ID) if ours else (str(20000 + i), str(10000 + i))
+
+""" Identity response of a patron with n memberships. In minimal mode, only the campaign IDs and
+the tier amounts come along, as requested by PatreonInfo.get_identity(minimal=True). """
+def identity(n, match='last', minimal=False):
+    members, campaigns, creators, tiers = [], [], [], []
+    for i in range(n):
+        campaign_id, creator_id = _campaign_of(i, n, match)
+        tier_id = str(30000 + i)
+        members.append({
+            'type': 'member',
+            'id': f'00000000-0000-0000-0000-{i:012d}',
+            'attributes': {},
+            'relationships': {
+                'campaign': {
+                    'data': {'type': 'campaign', 'id': campaign_id},
+                    'links': {'related': f'https://www.patreon.com/api/oauth2/v2/campaigns/{campaign_id}'},
+                },
+                'currently_entitled_tiers': {'data': [{'type': 'tier', 'id': tier_id}]},
+            },
+        })
+        tiers.append({'type': 'tier', 'id': tier_id, 'attributes': {'amount_cents': 500 + i}})
+        if minimal:
+            campaigns.append({'type': 'campaign', 'id': campaign_id, 'attributes': {}})
+            continue
+        campaigns.append({
+            'type': 'campaign',
+            'id': campaign_id,
+            'attributes': {},
+            'relationships': {
+                'creator': {
+                    'data': {'type': 'user', 'id': creator_id},
+                    'links': {'related': f'https://www.patreon.com/api/oauth2/v2/user/{creator_id}'},
+                },
+            },
+        })
+        creators.append({'type': 'user', 'id': creator_id, 'attributes': {'full_name': f'Creator {creator_id}', 'vanity': f'creator{creator_id}'}})
+
+    return {
+        'data': {
+            'type': 'user',
+            'id': PATRON_ID,
+            'attributes': {},
+            'relationships': {'memberships': {'data': [{'type': 'member', 'id': member['id']} for member in members]}},
+        },
+        'included': members + campaigns + creators + tiers,
+        'links': {'self': f'https://www.patreon.com/api/oauth2/v2/user/{PATRON_ID}'},
+    }
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    match = sys.argv[2] if len(sys.argv) > 2 else 'last'
+    minimal = len(sys.argv) > 3 and sys.argv[3] == 'minimal'
+    json.dump(identity(n, match, minimal), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,122 @@
+""" Benchmark of the pooled provider session against a new connection per call, on a local TLS stub server.
+
+One verification is 4 sequential calls, like a Twitch OAuth callback (code exchange, user, channel,
+subscription check). "Before" uses requests.post/get, as the helpers did, so every call opens a new
+TCP + TLS connection. "After" uses http_session.create_session(), which keeps the connection alive.
+The stub waits --rtt seconds per request, and 2 * --rtt more per new connection for the TCP and TLS
+handshake round trips a real provider costs; localhost has no latency of its own.
+
+    python bench/provider_session.py [--runs 100] [--rtt 0.025]
+
+Needs the openssl command line, to create the stub's self-signed certificate.
+"""
+import argparse
+import http.server
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import http_session
+
+""" Stub provider answering every request with a small JSON body """
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # Keep-alive
+    disable_nagle_algorithm = True  # Headers and body are written apart: don't wait for the delayed ACK in between
+    rtt = 0
+
+    def setup(self):
+        super().setup()
+        self.connection.do_handshake()
+        time.sleep(2 * self.rtt)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.rtt)
+        body = b'{"data":[{"id":"1"}],"access_token":"a","expires_in":3600}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _answer
+    do_POST = _answer
+
+def start_server(directory, rtt):
+    certificate = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+         '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', certificate],
+        check=True, capture_output=True
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+
+    StubHandler.rtt = rtt
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    # The handshake runs on the handler thread (see StubHandler.setup), not on the accepting one
+    server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, certificate
+
+def verification(post, get, base_url):
+    post(f'{base_url}/oauth2/token', data={'code': 'c'})
+    get(f'{base_url}/helix/users')
+    get(f'{base_url}/helix/users', params={'login': 'channel'})
+    get(f'{base_url}/helix/subscriptions/user', params={'broadcaster_id': '1', 'user_id': '2'})
+
+""" Median and p95 time (ms) of a verification over `runs` runs """
+def measure(post, get, base_url, runs):
+    times = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        verification(post, get, base_url)
+        times.append((time.perf_counter() - started_at) * 1000)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.95) - 1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--rtt', type=float, default=0.025, help='simulated round trip time, in seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-http-session-') as directory:
+        server, certificate = start_server(directory, args.rtt)
+        base_url = f'https://127.0.0.1:{server.server_port}'
+
+        before = measure(
+            lambda url, **kwargs: requests.post(url, verify=certificate, **kwargs),
+            lambda url, **kwargs: requests.get(url, verify=certificate, **kwargs),
+            base_url, args.runs
+        )
+        # verify per request: a CA bundle set in the environment would override session.verify
+        session = http_session.create_session()
+        after = measure(
+            lambda url, **kwargs: session.post(url, verify=certificate, **kwargs),
+            lambda url, **kwargs: session.get(url, verify=certificate, **kwargs),
+            base_url, args.runs
+        )
+        server.shutdown()
+
+    print(f'{args.runs} verifications of 4 calls, simulated RTT {args.rtt * 1000:.0f} ms')
+    print(f'{"":<28} {"median ms":>10} {"p95 ms":>10}')
+    print(f'{"new connection per call":<28} {before[0]:>10.1f} {before[1]:>10.1f}')
+    print(f'{"pooled session":<28} {after[0]:>10.1f} {after[1]:>10.1f}')
+
+if __name__ == '__main__':
+    main()
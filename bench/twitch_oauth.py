@@ -0,0 +1,149 @@
+""" End-to-end latency of the Twitch OAuth callback against stubbed providers.
+
+Loads the bot with every HTTP call to Twitch, Patreon and Telegram answered by a stub after --latency
+seconds, then times GET /twitch-oauth through the Flask test client for a subscribed user holding
+--stale-links older invite links, a new user per run.
+
+--src points to the tree to measure, so one checkout of this script can time older revisions too:
+
+    git worktree add /tmp/before <revision>
+    python bench/twitch_oauth.py --src /tmp/before
+    python bench/twitch_oauth.py
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import requests
+
+ENVIRONMENT = {
+    'BOT_TOKEN': '1:stub',
+    'GROUP_CHAT_ID_DEV': '-1001',
+    'GROUP_CHAT_ID_PROD': '-1002',
+    'TWITCH_CLIENT_ID': 'stub',
+    'TWITCH_CLIENT_SECRET': 'stub',
+    'TWITCH_SECRET': 'stub-eventsub-secret',
+    'TWITCH_CHANNEL_USERNAME': 'channel',
+    'TWITCH_CHANNEL_ID': '1',
+    'PATREON_CLIENT_ID': 'stub',
+    'PATREON_CLIENT_SECRET': 'stub',
+    'PATREON_CREATOR_ID': '1',
+    'PATREON_CREATOR_TOKEN': 'stub',
+    'PATREON_CREATOR_REFRESH_TOKEN': 'stub',
+    'PATREON_CREATOR_CAMPAIGN_ID': '1',
+    'STATE_TOKEN_SECRET': 'stub-state-secret-stub-state-secret',
+    'LOG_LEVEL': 'WARNING',
+}
+
+_links = iter(range(1, 10 ** 9))
+_links_lock = threading.Lock()
+
+def _telegram_result(method, payload):
+    if method == 'getWebhookInfo':
+        return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+    if method in ('createChatInviteLink', 'revokeChatInviteLink'):
+        with _links_lock:
+            link = payload.get('invite_link') or f'https://t.me/+stub{next(_links)}'
+        return {'invite_link': link, 'creator': {'id': 1, 'is_bot': True, 'first_name': 'bot'}, 'creates_join_request': True,
+                'is_primary': False, 'is_revoked': method == 'revokeChatInviteLink'}
+    if method == 'sendMessage':
+        return {'message_id': 1, 'date': 0, 'chat': {'id': int(payload.get('chat_id', 1)), 'type': 'private'}}
+    return True
+
+""" Stub of every provider, answering after the configured latency """
+def stub_request(latency):
+    def request(session, method, url, params=None, data=None, **kwargs):
+        time.sleep(latency)
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        path = urllib.parse.urlsplit(url).path
+        if 'api.telegram.org' in url:
+            body = {'ok': True, 'result': _telegram_result(path.rsplit('/', 1)[-1], dict(data or params or kwargs.get('json') or {}))}
+        elif 'id.twitch.tv' in url:
+            body = {'access_token': 'stub', 'refresh_token': 'stub', 'expires_in': 3600, 'token_type': 'bearer'}
+        elif path.endswith('/eventsub/subscriptions'):
+            body = {'data': []}
+            if method == 'POST':
+                response.status_code = 202
+                body = {'data': [{'id': 'stub'}]}
+        elif path.endswith('/helix/users'):
+            body = {'data': [{'id': '42', 'login': 'user', 'display_name': 'user'}]}
+        elif path.endswith('/subscriptions/user'):
+            body = {'data': [{'broadcaster_id': '1', 'tier': '1000'}]}
+        elif 'patreon.com' in url:
+            body = {'data': []}
+            if method == 'POST':
+                response.status_code = 201
+                body = {'data': {'id': 'stub', 'attributes': {'secret': 'stub'}}}
+        else:
+            body = {}
+        response._content = json.dumps(body).encode()
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    return request
+
+""" Wait for the background startup of the bot, on the revisions that have one """
+def wait_started(bot_module, timeout=60):
+    if hasattr(bot_module, 'provider_registry'):
+        bot_module.provider_registry.wait(timeout)
+    pool = getattr(bot_module, 'invite_link_pool', None)
+    deadline = time.monotonic() + timeout
+    while pool and pool.size() < bot_module.INVITE_POOL_HIGH_WATERMARK and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--src', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per provider call')
+    parser.add_argument('--stale-links', type=int, default=2)
+    args = parser.parse_args()
+    src = os.path.abspath(args.src)
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    requests.Session.request = stub_request(args.latency)
+
+    # The bot reads bot-text.ini and creates its database in the working directory
+    directory = tempfile.mkdtemp(prefix='bench-twitch-oauth-')
+    shutil.copy(os.path.join(src, 'bot-text.ini'), directory)
+    os.chdir(directory)
+    sys.path.insert(0, src)
+    import custom_webhook_telegram_bot as bot_module
+    app = bot_module.create_app() if hasattr(bot_module, 'create_app') else bot_module.flask_app
+    wait_started(bot_module)
+    logging.disable(logging.WARNING)
+    client = app.test_client()
+
+    times = []
+    for run in range(args.runs):
+        telegram_user_id = 100000 + run
+        for i in range(args.stale_links):
+            bot_module.database.store_link(telegram_user_id, 42, None, f'https://t.me/+stale{run}x{i}')
+        verify_link = bot_module.get_platform_verify_link(bot_module.TwitchHelper.PLATFORM, telegram_user_id, telegram_user_id)
+        state = urllib.parse.parse_qs(urllib.parse.urlsplit(verify_link).query)['token'][0]
+
+        started_at = time.perf_counter()
+        response = client.get(bot_module.PATH_TWITCH_OAUTH, query_string={'code': 'stub', 'scope': 'user:read:subscriptions', 'state': state})
+        times.append((time.perf_counter() - started_at) * 1000)
+        assert response.status_code == 200 and 'NOT' not in response.get_data(as_text=True), response.get_data(as_text=True)
+
+    times.sort()
+    print(f'{src}: {args.runs} callbacks, {args.latency * 1000:.0f} ms per provider call, {args.stale_links} stale links')
+    print(f'median {statistics.median(times):.1f} ms, p95 {times[int(len(times) * 0.95) - 1]:.1f} ms')
+    # Background threads of the bot would keep the process alive
+    sys.stdout.flush()
+    shutil.rmtree(directory, ignore_errors=True)
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import collections
+import threading
+import time
+
+""" Bounded in-memory cache whose entries expire `ttl` seconds after being set """
+class TTLCache():
+
+    def __init__(self, maxsize=10000, ttl=600):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()   # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+
+    """ Get the value of a key, or `default` if missing or expired """
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return default
+            return entry[1]
+
+    """ Set the value of a key, resetting its expiry """
+    def set(self, key, value=True):
+        with self._lock:
+            self._set(key, value)
+
+    """ Set a key only if it is missing or expired. Return False if it was already there. """
+    def add(self, key, value=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                return False
+            self._set(key, value)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _set(self, key, value):
+        now = time.monotonic()
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self._ttl, value)
+
+        # Entries are ordered by expiry, so the expired ones are at the front
+        while self._entries:
+            oldest_key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at >= now and len(self._entries) <= self._maxsize:
+                break
+            del self._entries[oldest_key]
@@ -5,9 +5,13 @@ import toml
 import os
 import logging
 import time
+import threading
 import string
 import random
 import datetime
+import json
+import hmac
+import concurrent.futures
 
 import flask
 
@@ -18,6 +22,20 @@ import telebot.custom_filters as TelebotCustomFilters
 from telebot.apihelper import ApiTelegramException
 
 import database
+import logging_setup
+import metrics
+import background
+import signed_state
+import update_dispatcher
+import invite_pool
+import scheduler
+import reconciliation
+import outbox
+import rate_limiter
+import cache
+import token_vault
+import provider_registration
+import roster
 import TwitchHelper
 import PatreonHelper
 
@@ -35,18 +53,31 @@ class DataMatchFilter(TelebotCustomFilters.AdvancedCustomFilter):
 
         return False
 
+""" Log a failing handler instead of re-raising it, so the other updates of the batch are still processed """
+class LogHandlerErrors(telebot.ExceptionHandler):
+
+    def handle(self, exception):
+        # Called from TeleBot's except block: the traceback is still available
+        logger.exception('Error in a Telegram update handler: %s', exception)
+        handler_errors.inc()
+        return True
+
 class EnvVariableNotFound(Exception):
     def __init__(self, message):            
         super().__init__(message)
 
 DEVELOPMENT = True if os.getenv("BOT_MODE", "development") == "development" else False
-DEBUG = True
+# Debug logs (and the payloads logged with them) are only written at the DEBUG level
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+DEBUG = LOG_LEVEL == 'DEBUG'
 
 HOSTNAME = 'communikeintest.pythonanywhere.com'
 if DEVELOPMENT: HOSTNAME = 'humorous-bison-flowing.ngrok-free.app'
 URL_BASE = f"https://{HOSTNAME}"
 PATH_HOME = "/"
 PATH_TELEGRAM = "/telegram"
+PATH_TELEGRAM_QUEUE = "/telegram-queue"
+PATH_METRICS = "/metrics"
 PATH_TWITCH_OAUTH = "/twitch-oauth"
 PATH_TWITCH_VERIFY = "/twitch-verify"
 PATH_TWITCH_OAUTH_CHANNEL = "/twitch-channel-oauth"
@@ -64,19 +95,78 @@ WEBHOOK_PATREON_OAUTH = URL_BASE + PATH_PATREON_OAUTH
 WEBHOOK_PATREON_REFRESH_TOKEN = URL_BASE + PATH_PATREON_REFRESH_TOKEN
 WEBHOOK_PATREON_USER_UNSUBSCRIBED = URL_BASE + PATH_PATREON_USER_UNSUBSCRIBED
 
+SESSION_SWEEP_INTERVAL = 60 * 5     # Seconds between two passes deleting expired user sessions
+
+# If set, the OAuth state is an HMAC-signed token carrying the user context, and the
+# OAuth callbacks don't need the UserSession table. Otherwise, a random token stored in the DB is used.
+STATE_TOKEN_SECRET = os.getenv("STATE_TOKEN_SECRET", None)
+
+# Shared secret of the token refresh endpoints, sent as "Authorization: Bearer <secret>".
+# Without it they are disabled: the vault refreshes the tokens in the background anyway.
+TOKEN_REFRESH_SECRET = os.getenv("TOKEN_REFRESH_SECRET", None)
+
+# If greater than 0, Telegram updates are acknowledged right away and processed by this many worker threads.
+# Otherwise, they are processed inline, before answering Telegram.
+TELEGRAM_WORKERS = int(os.getenv("TELEGRAM_WORKERS", 0))
+TELEGRAM_QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", 1000))
+TELEGRAM_RETRY_AFTER = 1            # Seconds Telegram is asked to wait when the queue is full
+TELEGRAM_BATCH_SIZE = int(os.getenv("TELEGRAM_BATCH_SIZE", 1))
+TELEGRAM_BATCH_WINDOW = 0.05        # Seconds a worker waits for more updates to batch with the first one
+TELEGRAM_SEEN_UPDATES = 10000       # Number of recent update_id values remembered to drop redeliveries
+# Updates sent by Telegram to the webhook. chat_member keeps the group roster up to date (the bot must be an admin).
+TELEGRAM_ALLOWED_UPDATES = ['message', 'callback_query', 'chat_join_request', 'chat_member']
+
+# Threads running independent provider/Telegram calls of a request concurrently
+PROVIDER_WORKERS = int(os.getenv("PROVIDER_WORKERS", 8))
+
+# Pre-created invite links: refilled up to the high watermark when below the low one, rotated after max age
+INVITE_POOL_LOW_WATERMARK = int(os.getenv("INVITE_POOL_LOW_WATERMARK", 5))
+INVITE_POOL_HIGH_WATERMARK = int(os.getenv("INVITE_POOL_HIGH_WATERMARK", 20))
+INVITE_POOL_MAX_AGE = int(os.getenv("INVITE_POOL_MAX_AGE", 60 * 60 * 24))
+INVITE_POOL_INTERVAL = 60           # Seconds between two checks of the pool
+
+# EventSub message IDs remembered to drop Twitch redeliveries (older messages fail the signature check anyway)
+EVENTSUB_SEEN_MESSAGES = 10000
+EVENTSUB_SEEN_TTL = TwitchHelper.EVENTSUB_MAX_MESSAGE_AGE
+
+# Delay between banning a removed user and unbanning them, so they can join again later
+UNBAN_DELAY = 0.5
+
+# Worker threads sending the Telegram calls queued in the outbox
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 2))
+OUTBOX_SWEEP_INTERVAL = 60 * 60     # Seconds between two passes deleting old sent outbox messages
+
+# Seconds a cached webhook registration is trusted on restart before being checked with the provider again
+REGISTRATION_MAX_AGE = int(os.getenv("REGISTRATION_MAX_AGE", 60 * 60 * 24))
+
+# Seconds between two reconciliations of the group with the Patreon campaign members, in case a webhook was missed
+PATREON_RECONCILE_INTERVAL = int(os.getenv("PATREON_RECONCILE_INTERVAL", 60 * 60 * 6))
+# Same for the Twitch channel subscribers. A run walks at most TWITCH_RECONCILE_MAX_PAGES pages (0 = all of them),
+# the next one resumes from the last cursor.
+TWITCH_RECONCILE_INTERVAL = int(os.getenv("TWITCH_RECONCILE_INTERVAL", 60 * 60 * 6))
+TWITCH_RECONCILE_MAX_PAGES = int(os.getenv("TWITCH_RECONCILE_MAX_PAGES", 0))
+
+# Log files are rotated by size, or by time if LOG_ROTATE_WHEN is set (e.g. "midnight")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", logging_setup.LOG_MAX_BYTES))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", logging_setup.LOG_BACKUP_COUNT))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+# Share of the request payloads logged at the DEBUG level, and their maximum length
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", logging_setup.PAYLOAD_SAMPLE_RATE))
+LOG_PAYLOAD_MAX_LENGTH = int(os.getenv("LOG_PAYLOAD_MAX_LENGTH", logging_setup.PAYLOAD_MAX_LENGTH))
+
 logs_file_path = '/home/communikeintest/logs/pigliamoschebot.log'
 if DEVELOPMENT: logs_file_path = './pigliamoschebot.log'
-logging.basicConfig(
-    filename=logs_file_path, 
-    encoding='utf-8', 
-    filemode='a', 
-    style="{", 
-    datefmt="%Y-%m-%d %H:%M", 
-    format="{asctime}# {levelname} - {name}.{funcName} - {message}",
-    level = logging.DEBUG)
+# One setup for the whole process: the records are written to the file by a background thread
+logging_setup.configure(
+    logs_file_path,
+    level=LOG_LEVEL,
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT,
+    when=LOG_ROTATE_WHEN,
+    payload_sample_rate=LOG_PAYLOAD_SAMPLE_RATE,
+    payload_max_length=LOG_PAYLOAD_MAX_LENGTH)
 logger = logging.getLogger(__name__)
 
-# TODO: Update bot logger to use system logger
 def init_telegram():
 
     global BOT_MESSAGE_WELCOME, BOT_MESSAGE_PLATFORM_CHECK, BOT_PLATFORM_CHOICE, BOT_JOIN_TELEGRAM_GROUP
@@ -117,20 +207,33 @@ def init_telegram():
     GROUP_CHAT_ID_PROD = int(GROUP_CHAT_ID_PROD)
     group_chat_id = GROUP_CHAT_ID_DEV if DEVELOPMENT else GROUP_CHAT_ID_PROD
         
-    telebot_logger.setLevel(logging.DEBUG)
-    bot = telebot.TeleBot(bot_token, threaded=False) # type: ignore
+    # TeleBot also writes to stderr on the request thread: its records go through the process logging instead
+    telebot_logger.setLevel(LOG_LEVEL)
+    telebot_logger.handlers.clear()
+    # Every API call waits for Telegram's global and per-chat rate limits.
+    # With workers the updates are already acknowledged, so a handler error is logged rather than re-raised;
+    # inline, it is re-raised so that Telegram redelivers the update.
+    bot = rate_limiter.RateLimitedBot(
+        telebot.TeleBot(bot_token, threaded=False, exception_handler=LogHandlerErrors() if TELEGRAM_WORKERS > 0 else None), # type: ignore
+        group_chat_ids=[GROUP_CHAT_ID_DEV, GROUP_CHAT_ID_PROD]
+    )
     bot.add_custom_filter(DataMatchFilter())
-    
+
+    # The webhook is registered in the background, see register_telegram_webhook()
+    provider_registry.add('telegram', provider_registration.fingerprint(WEBHOOK_TELEGRAM, bot_token, *TELEGRAM_ALLOWED_UPDATES), lambda changed: register_telegram_webhook())
+
+    return bot, group_chat_id
+
+def register_telegram_webhook():
     # If no webhook, or the wrong one, has been registered, remove the current webhook and register the correct one
     webhook_info = bot.get_webhook_info()
-    if not webhook_info or webhook_info.url != WEBHOOK_TELEGRAM:
+    if not webhook_info or webhook_info.url != WEBHOOK_TELEGRAM or set(webhook_info.allowed_updates or []) != set(TELEGRAM_ALLOWED_UPDATES):
         # Remove webhook, it fails sometimes the set if there is a previous webhook
         bot.remove_webhook()
         time.sleep(1)
         # Set webhook
-        bot.set_webhook(url=WEBHOOK_TELEGRAM)
-
-    return bot, group_chat_id
+        return bot.set_webhook(url=WEBHOOK_TELEGRAM, allowed_updates=TELEGRAM_ALLOWED_UPDATES)
+    return True
 
 def init_twitch():
     twitch_client_id = os.getenv("TWITCH_CLIENT_ID", None)
@@ -143,25 +246,54 @@ def init_twitch():
     if not twitch_channel_username: raise EnvVariableNotFound('ERROR - init_twitch() - "TWITCH_CHANNEL_USERNAME" environment variable not found')
     twitch_channel_id = os.getenv("TWITCH_CHANNEL_ID", None)
     if not twitch_channel_id: raise EnvVariableNotFound('ERROR - init_twitch() - "TWITCH_CHANNEL_ID" environment variable not found')
+    # Optional: without it, the subscribers are not reconciled until the channel owner goes through the channel OAuth flow
+    twitch_broadcaster_token = os.getenv("TWITCH_BROADCASTER_TOKEN", None)
+    twitch_broadcaster_refresh_token = os.getenv("TWITCH_BROADCASTER_REFRESH_TOKEN", None)
 
     twitch_info = TwitchHelper.TwitchInfo( \
         client_id=twitch_client_id, \
         client_secret=twitch_client_secret, \
         twitch_secret=twitch_secret, \
         channel_username=twitch_channel_username, \
-        channel_id=int(twitch_channel_id) \
+        channel_id=int(twitch_channel_id), \
+        broadcaster_token=twitch_broadcaster_token, \
+        token_vault=oauth_token_vault \
+    )
+    oauth_token_vault.register(TwitchHelper.PLATFORM, twitch_info.refresh_access_token)
+    # A token already in the vault may have been refreshed since, and the one from the environment revoked
+    if twitch_broadcaster_token:
+        oauth_token_vault.seed(TwitchHelper.BROADCASTER_TOKEN, TwitchHelper.PLATFORM, twitch_broadcaster_token, twitch_broadcaster_refresh_token)
+
+    # An existing subscription keeps the secret it was created with: when the fingerprint (which hashes TWITCH_SECRET)
+    # is not the stored one, e.g. the first start after an upgrade or a new secret, it is created again.
+    # TWITCH_EVENTSUB_RESUBSCRIBE=1 forces it at every start.
+    resubscribe = os.getenv("TWITCH_EVENTSUB_RESUBSCRIBE", "0") == "1"
+    provider_registry.add(
+        'twitch',
+        provider_registration.fingerprint(WEBHOOK_TWITCH_USER_UNSUBSCRIBED, twitch_client_id, twitch_channel_id, twitch_secret),
+        lambda changed: register_twitch_webhook(resubscribe or changed),
+        force=resubscribe
+    )
+
+    return twitch_info
+
+def register_twitch_webhook(resubscribe=False):
+    webhook_registration_result_code, webhook_registration_result_data = twitch_info.register_unsubscribe_webhook(
+        WEBHOOK_TWITCH_USER_UNSUBSCRIBED,
+        resubscribe=resubscribe
     )
-    webhook_registration_result_code, webhook_registration_result_data = twitch_info.register_unsubscribe_webhook(WEBHOOK_TWITCH_USER_UNSUBSCRIBED)
     if webhook_registration_result_code == 202:
         logger.info('Subscribed to Twitch event \'user unsubscribed\'')
     elif webhook_registration_result_code == 409:
         logger.info('Already subscribed to Twitch event \'user unsubscribed\'')
     else:
-        logger.error(f'Unknown error: {webhook_registration_result_data}')
-
-    return twitch_info
+        logger.error('Unknown error: %s', webhook_registration_result_data)
+        return False
+    return True
 
 def init_patreon():
+    global PATREON_CAMPAIGN_ID
+
     patreon_client_id = os.getenv("PATREON_CLIENT_ID", None)
     if not patreon_client_id: raise EnvVariableNotFound('ERROR - init_patreon() - "PATREON_CLIENT_ID" environment variable not found')
     patreon_client_secret = os.getenv("PATREON_CLIENT_SECRET", None)
@@ -175,17 +307,35 @@ def init_patreon():
     if not patreon_creator_refresh_token: raise EnvVariableNotFound('ERROR - init_patreon() - "PATREON_CREATOR_REFRESH_TOKEN" environment variable not found')
     patreon_creator_campaign_id = os.getenv("PATREON_CREATOR_CAMPAIGN_ID", None)
     if not patreon_creator_campaign_id: raise EnvVariableNotFound('ERROR - init_patreon() - "PATREON_CREATOR_CAMPAIGN_ID" environment variable not found')
+    PATREON_CAMPAIGN_ID = patreon_creator_campaign_id
 
     patreon_info = PatreonHelper.PatreonInfo( \
         client_id=patreon_client_id, \
         client_secret=patreon_client_secret, \
         creator_id=patreon_creator_id, \
         creator_token=patreon_creator_token, \
-        creator_refresh_token=patreon_creator_refresh_token
+        creator_refresh_token=patreon_creator_refresh_token, \
+        campaign_id=patreon_creator_campaign_id, \
+        token_vault=oauth_token_vault, \
+        webhook_secret=database.get_webhook_secret('patreon')
+    )
+    oauth_token_vault.register(PatreonHelper.PLATFORM, patreon_info.refresh_access_token)
+    # A token already in the vault may have been refreshed since, and the one from the environment revoked
+    oauth_token_vault.seed(PatreonHelper.CREATOR_TOKEN, PatreonHelper.PLATFORM, patreon_creator_token, patreon_creator_refresh_token)
+    provider_registry.add(
+        'patreon',
+        provider_registration.fingerprint(WEBHOOK_PATREON_USER_UNSUBSCRIBED, patreon_client_id, patreon_creator_campaign_id),
+        lambda changed: register_patreon_webhook(),
+        # Without the secret the webhook requests can't be verified: ask Patreon for it again
+        force=not database.get_webhook_secret('patreon')
     )
+
+    return patreon_info
+
+def register_patreon_webhook():
     webhook_registration_result_code, webhook_registration_result_data = patreon_info.register_unsubscribe_webhook(
         callback_webhook=WEBHOOK_PATREON_USER_UNSUBSCRIBED, 
-        campaign_id=patreon_creator_campaign_id, 
+        campaign_id=PATREON_CAMPAIGN_ID, 
         debug=DEBUG
     )
     if webhook_registration_result_code == 201:
@@ -193,17 +343,80 @@ def init_patreon():
     elif webhook_registration_result_code == 409:
         logger.info('Already subscribed to Patreon event \'user unsubscribed\'')
     else:
-        logger.error(f'Unknown error: {webhook_registration_result_data}')
-
-    return patreon_info
+        logger.error('Unknown error: %s', webhook_registration_result_data)
+        return False
 
-twitch_info = init_twitch()
-patreon_info = init_patreon()
-database.check_or_create_db()
+    # Patreon signs the webhook requests with this secret, see webhook_patreon_user_unsubscribed()
+    webhook_secret = patreon_info.webhook_secret(webhook_registration_result_data)
+    if not webhook_secret:
+        logger.error('Patreon returned no secret for the webhook')
+        return False
+    database.store_webhook_secret('patreon', webhook_secret)
+    patreon_info.set_webhook_secret(webhook_secret)
+    return True
+
+# Built here, started by create_app(): importing this module touches neither the database nor the network
+oauth_token_vault = token_vault.TokenVault()
+provider_registry = provider_registration.ProviderRegistry(max_age=REGISTRATION_MAX_AGE)
+twitch_info = None                  # Set by create_app(), once the database is ready
+patreon_info = None                 # Set by create_app(), once the database is ready
+session_sweeper = background.PeriodicTask('session-sweeper', SESSION_SWEEP_INTERVAL, database.delete_expired_sessions)
 csrf_user_link_mapping = dict()
 bot, GROUP_CHAT_ID = init_telegram()
+group_roster = roster.GroupRoster(bot, GROUP_CHAT_ID)
+seen_telegram_updates = update_dispatcher.SeenWindow(TELEGRAM_SEEN_UPDATES)
+telegram_dispatcher = None
+if TELEGRAM_WORKERS > 0:
+    telegram_dispatcher = update_dispatcher.UpdateDispatcher(
+        bot.process_new_updates,
+        workers=TELEGRAM_WORKERS,
+        max_queue_size=TELEGRAM_QUEUE_SIZE,
+        batch_size=TELEGRAM_BATCH_SIZE,
+        batch_window=TELEGRAM_BATCH_WINDOW
+    )
+invite_link_pool = invite_pool.InvitePool(
+    bot,
+    GROUP_CHAT_ID,
+    low_watermark=INVITE_POOL_LOW_WATERMARK,
+    high_watermark=INVITE_POOL_HIGH_WATERMARK,
+    max_age=INVITE_POOL_MAX_AGE,
+    interval=INVITE_POOL_INTERVAL
+)
+seen_eventsub_messages = cache.TTLCache(maxsize=EVENTSUB_SEEN_MESSAGES, ttl=EVENTSUB_SEEN_TTL)
+member_scheduler = scheduler.Scheduler(name='member-scheduler')
+telegram_outbox = outbox.Outbox(bot, workers=OUTBOX_WORKERS)
+outbox_sweeper = background.PeriodicTask('outbox-sweeper', OUTBOX_SWEEP_INTERVAL, database.delete_done_outbox_messages)
+patreon_reconciler = None           # Set by create_app(), it needs patreon_info
+twitch_reconciler = None            # Set by create_app(), it needs twitch_info
+_app_started = False                # Set by create_app(), see require_started()
+_app_start_lock = threading.Lock()
+provider_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROVIDER_WORKERS, thread_name_prefix='provider')
 flask_app = flask.Flask(__name__)
 
+joins_approved = metrics.counter('telegram_joins_approved_total', 'Join requests approved, the user owning the invite link')
+joins_declined = metrics.counter('telegram_joins_declined_total', 'Join requests declined, the user not owning the invite link')
+members_removed = metrics.counter('telegram_members_removed_total', 'Users removed from the group')
+handler_errors = metrics.counter('telegram_handler_errors_total', 'Telegram update handlers that raised, see LogHandlerErrors')
+
+# Time every request, labelled by route (not by URL, so query strings and unknown paths don't add series)
+flask_app.wsgi_app = metrics.RequestTimer(flask_app.wsgi_app)
+
+# flask_app only works once create_app() has run. A WSGI entry point serving flask_app directly would answer
+# every OAuth and webhook route with errors from the missing clients: fail every request with the cause instead.
+@flask_app.before_request
+def require_started():
+    if not _app_started:
+        raise RuntimeError('create_app() has not been called: the WSGI entry point must serve create_app() (see wsgi.py), not flask_app')
+
+@flask_app.after_request
+def record_request_time(response):
+    request = flask.request._get_current_object()
+    started_at = request.environ.get(metrics.STARTED_AT_KEY)
+    if started_at is not None:
+        rule = request.url_rule
+        metrics.http_request_duration.observe(time.perf_counter() - started_at, rule.rule if rule else 'unknown', request.method, response.status_code)
+    return response
+
 # Empty webserver index, return nothing, just http 200
 @flask_app.route(PATH_HOME, methods=['GET', 'HEAD'])
 def index():
@@ -215,14 +428,86 @@ def index():
 def http_request_home():
     if flask.request.headers.get('content-type') == 'application/json':
         json_string = flask.request.get_data().decode('utf-8')
-        if DEBUG: logger.debug(f'Bot received message - {json_string}')
+        logging_setup.log_payload(logger, 'Bot received message', json_string)
         update = telebot.types.Update.de_json(json_string)
-        if update: bot.process_new_updates([update])
+
+        # Telegram redelivers updates when we answer slowly: acknowledge duplicates without processing them
+        if update and not seen_telegram_updates.add(update.update_id):
+            logger.info('Dropping duplicate update %s', update.update_id)
+            return ''
+
+        if update and telegram_dispatcher:
+            # Backpressure: a non-2xx answer makes Telegram retry the update later
+            if not telegram_dispatcher.submit(update):
+                seen_telegram_updates.discard(update.update_id)
+                logger.warning('Telegram update queue full, rejecting update %s', update.update_id)
+                return 'Too many updates', 429, {'Retry-After': str(TELEGRAM_RETRY_AFTER)}
+        elif update:
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                # Let Telegram's redelivery retry it
+                seen_telegram_updates.discard(update.update_id)
+                raise
 
         return ''
     else:
         flask.abort(403)
 
+# Telegram update queue depth and lag, and rate limiter waits, for monitoring
+@flask_app.route(PATH_TELEGRAM_QUEUE, methods=['GET'])
+def http_telegram_queue():
+    if telegram_dispatcher:
+        return flask.jsonify(mode='queued', rate_limiter=bot.stats(), **telegram_dispatcher.stats())
+    else:
+        return flask.jsonify(mode='inline', rate_limiter=bot.stats())
+
+# Request latencies, provider calls, database queries and join counters, in the Prometheus text format
+@flask_app.route(PATH_METRICS, methods=['GET'])
+def http_metrics():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+# Revoke the given invite links and remove them from the database.
+# The links that could not be revoked stay in the database, so they are retried on the next verification.
+def revoke_invite_links(invite_links):
+    if not invite_links:
+        return []
+
+    revoked, failed = invite_pool.revoke_invite_links(bot, GROUP_CHAT_ID, invite_links)
+    logger.info('Revoked and removed %s invite links', len(revoked))
+    if failed:
+        logger.error('Could not revoke invite links: %s', failed)
+    return failed
+
+# Give a user an invite link, from the pool if possible, and send it to them.
+# The message is queued in the transaction storing the link, so a stored link is never left unsent.
+def issue_invite_link(telegram_user_id, telegram_chat_id, twitch_user_id=None, patreon_user_id=None):
+    def invite_messages(invite_link):
+        return [outbox.message('send_message', f'invite:{invite_link}', chat_id=telegram_chat_id, text=BOT_JOIN_TELEGRAM_GROUP.format(invite_link))]
+
+    invite_link = invite_link_pool.claim(telegram_user_id, twitch_user_id=twitch_user_id, patreon_user_id=patreon_user_id, messages=invite_messages)
+    if invite_link:
+        telegram_outbox.notify()
+        return invite_link
+
+    # Pool empty: create the link inline
+    invite = bot.create_chat_invite_link(
+        chat_id = GROUP_CHAT_ID,
+        #name = telegram_user_id,      #
+        #expire_date = None,            # No expiry time, can be set if needed
+        #member_limit = 1,              # Valid for one user only (if set, creates_join_request must be False)
+        creates_join_request = True     # Requires approval by admin before being added (if True, member_limit must not be set)
+    )
+    # Store the newly created invite link in the DB
+    database.store_link(
+        telegram_user_id=telegram_user_id, 
+        twitch_user_id=twitch_user_id, 
+        patreon_user_id=patreon_user_id,
+        invite_link=invite.invite_link,
+        messages=invite_messages(invite.invite_link))
+    telegram_outbox.notify()
+    return invite.invite_link
+
 """ 
 ### Twitch SECTION 
 """
@@ -238,20 +523,29 @@ def webhook_twitch_user_oauth():
     csrf_token = params['state']
 
     # Get context information from CSRF token
-    user_info = database.find_user_info_from_session(csrf_token)
+    user_info = get_session_user_info(csrf_token)
+    if not user_info:
+        logger.info('Session not found or expired')
+        return 'Your verification link has expired, please request a new one.', 400
     telegram_user_id = user_info[0]
     telegram_chat_id = user_info[1]
     platform_chosen = user_info[2]
 
     # Log the incoming query parameters for demonstration
-    logger.debug(f"Received query parameters: {params}")
+    logger.debug("Received query parameters: %s", params)
+
+    # The calls below form a small dependency graph:
+    #   code -> access token -> user ID -> subscription check
+    #   telegram user ID -> stored invite links (independent, read while the code is exchanged)
+    # The channel ID is static (TWITCH_CHANNEL_ID), so it needs no call at all.
+    user_invite_links_future = provider_executor.submit(database.find_links_by_telegram_id, telegram_user_id)
 
     # Get the auth (and refresh) token for this user
-    access_token, _ = twitch_info.get_user_access_token(user_code, WEBHOOK_TWITCH_REFRESH_TOKEN, debug=True)
+    access_token, refresh_token, expires_in = twitch_info.get_user_access_token(user_code, WEBHOOK_TWITCH_REFRESH_TOKEN, debug=True)
 
-    # Get the Twitch username and ID for both the channel and the user
+    # Get the Twitch ID of the user
     _, twitch_user_id = twitch_info.get_user_data(access_token, debug=True)
-    _, twitch_channel_id = twitch_info.get_channel_data(access_token, debug=True)
+    twitch_channel_id = twitch_info.get_channel_id()
 
     # Check if the user is subscribed to the channel
     subscription_info = twitch_info.check_subscribed(access_token, twitch_user_id, twitch_channel_id)
@@ -260,41 +554,25 @@ def webhook_twitch_user_oauth():
     # If user is subscribed, add to Telegram group
     if subscribed:
 
-        # If user has already created invite links, revoke them before creating a new one
-        user_invite_links = database.find_links_by_telegram_id(telegram_user_id)
-        for link in user_invite_links or []:
-            result = bot.revoke_chat_invite_link(GROUP_CHAT_ID, link)
-            if result.is_revoked:
-                logger.info('Invite link revoked succesfully')
-                logger.info('Removing invite link from database')
-                if database.remove_link(link):
-                    logger.info('Invite link removed successfully from database')
-                else:
-                    logger.error('Could not remove invite link from database')
-            else:
-                logger.error(f'Could not revoke invite link: {link}')
-
-        # Create a single-use invite link
-        invite = bot.create_chat_invite_link(
-            chat_id = GROUP_CHAT_ID,
-            #name = telegram_user_id,      #
-            #expire_date = None,            # No expiry time, can be set if needed
-            #member_limit = 1,              # Valid for one user only (if set, creates_join_request must be False)
-            creates_join_request = True     # Requires approval by admin before being added (if True, member_limit must not be set)
-        )
-        # Store the newly created invite link in the DB
-        database.store_link(
-            telegram_user_id=telegram_user_id, 
-            twitch_user_id=twitch_user_id, 
-            patreon_user_id=None,
-            invite_link=invite.invite_link)
+        # If user has already created invite links, revoke them while the new one is created
+        revoke_future = provider_executor.submit(revoke_invite_links, user_invite_links_future.result())
+
+        database.store_member_identity(telegram_user_id, TwitchHelper.PLATFORM, twitch_user_id)
+        oauth_token_vault.store(token_vault.user_token_name(TwitchHelper.PLATFORM, twitch_user_id), TwitchHelper.PLATFORM, access_token, refresh_token, expires_in)
 
-        bot.send_message(telegram_chat_id, BOT_JOIN_TELEGRAM_GROUP.format(invite.invite_link))
+        # Get a single-use invite link, and send it
+        issue_invite_link(telegram_user_id, telegram_chat_id, twitch_user_id=twitch_user_id)
+        try:
+            revoke_future.result()
+        except Exception as e:
+            # The invite is already sent: the old links are revoked on the next verification
+            logger.error('Could not revoke the previous invite links of %s: %s', telegram_user_id, e)
 
         return 'Your membership has been verified :D', 200
 
     else:
-        bot.send_message(telegram_chat_id, BOT_SUBSCRIPTION_NOT_ACTIVE, parse_mode='HTML')
+        user_invite_links_future.cancel()
+        telegram_outbox.send('send_message', chat_id=telegram_chat_id, text=BOT_SUBSCRIPTION_NOT_ACTIVE, parse_mode='HTML')
 
         return 'Your membership has NOT been verified :(', 200
 
@@ -310,10 +588,13 @@ def webhook_twitch_verify():
     csrf_token = params['token']
 
     # Log the incoming parameters
-    if DEBUG: logger.debug(f"Received parameters: {params}")
+    if DEBUG: logger.debug("Received parameters: %s", params)
     
     # Get context information from CSRF token
-    user_info = database.find_user_info_from_session(csrf_token)
+    user_info = get_session_user_info(csrf_token)
+    if not user_info:
+        logger.info('Session not found or expired')
+        return 'Your verification link has expired, please request a new one.', 400
     platform_chosen = user_info[2]
 
     if platform_chosen == TwitchHelper.PLATFORM:
@@ -327,8 +608,8 @@ def webhook_twitch_verify():
             state_csrf = str(csrf_token)
         )
     
-    if DEBUG: logger.debug(f"Platform chosen: {platform_chosen}")
-    if DEBUG: logger.debug(f"Verify link: {verify_link}")
+    if DEBUG: logger.debug("Platform chosen: %s", platform_chosen)
+    if DEBUG: logger.debug("Verify link: %s", verify_link)
 
     return flask.redirect(verify_link), 302
 
@@ -343,10 +624,10 @@ def webhook_twitch_channel_oauth():
     scope = params['scope']
 
     # Log the incoming parameters
-    if DEBUG: logger.debug(f"Received parameters: {params}")
+    if DEBUG: logger.debug("Received parameters: %s", params)
 
     # Get the auth (and refresh) token for this user
-    access_token, refresh_token = twitch_info.get_user_access_token(user_code, WEBHOOK_TWITCH_REFRESH_TOKEN)
+    access_token, refresh_token, expires_in = twitch_info.get_user_access_token(user_code, WEBHOOK_TWITCH_REFRESH_TOKEN)
     # Get the app access token
     app_access_token = twitch_info.get_app_access_token()
 
@@ -354,18 +635,71 @@ def webhook_twitch_channel_oauth():
     user_username, user_id = twitch_info.get_user_data(access_token)
     channel_username, channel_id = twitch_info.get_channel_data(access_token)
 
+    # The channel owner's token can list the channel subscribers, used by the Twitch reconciliation
+    if str(user_id) == str(twitch_info.get_channel_id()):
+        twitch_info.set_broadcaster_token(access_token, refresh_token, expires_in)
+        logger.info('Twitch broadcaster token updated')
+
     # Return result
     return '', 200
 
-# 
-@flask_app.route(PATH_TWITCH_REFRESH_TOKEN, methods=['GET'])
+# Refresh a token of the vault, for callers holding TOKEN_REFRESH_SECRET only: a refresh rotates single-use
+# refresh tokens, and the vault lock doesn't span processes. A token refreshed moments ago is kept.
+def refresh_service_token(name):
+    if not TOKEN_REFRESH_SECRET:
+        return 'not found', 404
+    authorization = flask.request.headers.get('Authorization', '').encode('utf-8')
+    if not hmac.compare_digest(authorization, f'Bearer {TOKEN_REFRESH_SECRET}'.encode('utf-8')):
+        logger.warning('Rejected a token refresh request without the shared secret')
+        return 'unauthorized', 401
+
+    try:
+        oauth_token_vault.refresh(name)
+    except token_vault.TokenRefreshError as e:
+        logger.error('Could not refresh token %s: %s', name, e)
+        return 'refresh failed', 502
+    return 'refreshed', 200
+
+# Refresh the broadcaster token now, without waiting for it to expire (e.g. after revoking it)
+@flask_app.route(PATH_TWITCH_REFRESH_TOKEN, methods=['POST'])
 def webhook_twitch_refresh_token():
     if DEBUG: logger.debug('endpoint called')
 
-    # Get query parameters from the URL
-    params = flask.request.args
+    return refresh_service_token(TwitchHelper.BROADCASTER_TOKEN)
+
+# Remove a user from the group: ban them now, and schedule the unban
+def remove_member(telegram_user_id, username=None):
+    try:
+        # Remove the user (ban) from the group.
+        # until_date must be more than 30s, or it will be considered banned forever.
+        # remoke_messages set to False, we don't want to remove the messages sent by this user
+        until_date = datetime.datetime.now() + datetime.timedelta(0,60)
+        bot.ban_chat_member(GROUP_CHAT_ID, telegram_user_id, until_date, revoke_messages=False)
+        group_roster.update(telegram_user_id, 'kicked')
+        members_removed.inc()
+
+    except ApiTelegramException as e:
+        # Since this webhook gets triggered whether or not a user is part of the Telegram group, 
+        # we need to handle the case where the user is not part of the group
+        if 'PARTICIPANT_ID_INVALID' in e.description:
+            logger.info("%s was not part of the Telegram group.", username)
+            return
+        else:
+            raise e
 
-    return '', 200
+    # Unban the user shortly after, otherwise it will not be able to user invite links to join again.
+    # By default, this method guarantees that after the call the user is not a member of the chat,
+    # but will be able to join it. So if the user is a member of the chat they will also be removed
+    # from the chat. If you don't want this, use the parameter only_if_banned.
+    member_scheduler.schedule('unban_member', delay=UNBAN_DELAY, telegram_user_id=telegram_user_id)
+    logger.info("%s removed from the Telegram group.", username)
+
+# Lift the ban set by remove_member()
+def unban_member(telegram_user_id):
+    bot.unban_chat_member(GROUP_CHAT_ID, telegram_user_id, only_if_banned=True)
+
+member_scheduler.register('remove_member', remove_member)
+member_scheduler.register('unban_member', unban_member)
 
 # Handle user unsubscribed from channel (subscription expired or manually removed) 
 # More info on this webhook at https://dev.twitch.tv/docs/eventsub/eventsub-subscription-types/#channelsubscriptionend
@@ -373,7 +707,29 @@ def webhook_twitch_refresh_token():
 def webhook_twitch_user_unsubscribed():
     if DEBUG: logger.debug('endpoint called')
 
-    data = flask.request.json
+    # Check the signature on the raw body first, so forged requests are rejected before any parsing
+    body = flask.request.get_data()
+    if not twitch_info.verify_eventsub_signature(flask.request.headers, body):
+        logger.warning('Rejected a Twitch EventSub request with an invalid signature')
+        return 'invalid signature', 403
+
+    # Twitch redelivers a message until it gets a 2xx: acknowledge the ones already handled
+    message_id = flask.request.headers.get('Twitch-Eventsub-Message-Id')
+    if not seen_eventsub_messages.add(message_id):
+        logger.info('Dropping duplicate EventSub message %s', message_id)
+        return 'duplicate', 200
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        seen_eventsub_messages.discard(message_id)
+        return 'invalid body', 400
+
+    # Twitch revoked the subscription: register it again at the next start instead of trusting the cached state
+    if flask.request.headers.get('Twitch-Eventsub-Message-Type') == 'revocation':
+        logger.warning("Twitch revoked the EventSub subscription: %s", data['subscription']['status'])
+        provider_registry.invalidate('twitch')
+        return '', 204
 
     # If this is Twitch verifying the webhook, verify it and return
     if data and data['subscription']['status'] == 'webhook_callback_verification_pending':
@@ -386,30 +742,19 @@ def webhook_twitch_user_unsubscribed():
         unsubscribed_user_id = data['event']['user_id']
         unsubscribed_user_username = data['event']['user_login']
 
+        telegram_user_id = database.find_telegram_user_id(TwitchHelper.PLATFORM, unsubscribed_user_id)
+        if not telegram_user_id:
+            logger.info("%s unsubscribed from Twitch, but has no known Telegram user.", unsubscribed_user_username)
+            return 'ignored', 200
+
+        # Remove the user in the background, so Twitch gets its answer right away
         try:
-            # Remove the user (ban) from the group.
-            # until_date must be more than 30s, or it will be considered banned forever.
-            # remoke_messages set to False, we don't want to remove the messages sent by this user
-            until_date = datetime.datetime.now() + datetime.timedelta(0,60)
-            bot.ban_chat_member(GROUP_CHAT_ID, unsubscribed_user_id, until_date, revoke_messages=False)
-
-            # Unban the user right away, otherwise it will not be able to user invite links to join again.
-            # By default, this method guarantees that after the call the user is not a member of the chat,
-            # but will be able to join it. So if the user is a member of the chat they will also be removed
-            # from the chat. If you don't want this, use the parameter only_if_banned.
-            time.sleep(0.5)
-            bot.unban_chat_member(GROUP_CHAT_ID, unsubscribed_user_id, only_if_banned=True)
-
-            logger.info(f"{unsubscribed_user_username} unsubscribed from Twitch, removing it from the Telegram group.")
-
-        except ApiTelegramException as e:
-            # Since this webhook gets triggered whether or not a user is part of the Telegram group, 
-            # we need to handle the case where the user is not part of the group
-            if 'PARTICIPANT_ID_INVALID' in e.description:
-                logger.info(f"{unsubscribed_user_username} unsubscribed from Twitch, " \
-                    "but was not part of the Telegram group. More data available here:", data)
-            else:
-                raise e
+            member_scheduler.schedule('remove_member', telegram_user_id=telegram_user_id, username=unsubscribed_user_username)
+        except Exception:
+            # Let Twitch's redelivery retry it
+            seen_eventsub_messages.discard(message_id)
+            raise
+        logger.info("%s unsubscribed from Twitch, removing it from the Telegram group.", unsubscribed_user_username)
 
         return 'removed', 200
 
@@ -432,16 +777,19 @@ def webhook_patreon_user_oauth():
     params = flask.request.args
     user_code = params['code']
     csrf_token = params['state']
-    if DEBUG: logger.debug(f"Received query parameters: {params}")
+    if DEBUG: logger.debug("Received query parameters: %s", params)
 
     # Get context information from CSRF token
-    user_info = database.find_user_info_from_session(csrf_token)
+    user_info = get_session_user_info(csrf_token)
+    if not user_info:
+        logger.info('Session not found or expired')
+        return 'Your verification link has expired, please request a new one.', 400
     telegram_user_id = user_info[0]
     telegram_chat_id = user_info[1]
     platform_chosen = user_info[2]
 
-    # Get the auth token for this user
-    access_token, _ = patreon_info.get_access_token(
+    # Get the auth (and refresh) token for this user
+    access_token, refresh_token, expires_in = patreon_info.get_access_token(
         user_code=user_code, 
         webhook_refresh_token=WEBHOOK_PATREON_OAUTH,    # Must be the same as the one used by helper_platform_choice()
         debug=DEBUG
@@ -454,50 +802,25 @@ def webhook_patreon_user_oauth():
     if paying_patron:
 
         # If user has already created invite links, revoke them before creating a new one
-        user_invite_links = database.find_links_by_telegram_id(telegram_user_id)
-        for link in user_invite_links or []:
-            result = bot.revoke_chat_invite_link(GROUP_CHAT_ID, link)
-            if result.is_revoked:
-                logger.info('Invite link revoked succesfully')
-                logger.info('Removing invite link from database')
-                if database.remove_link(link):
-                    logger.info('Invite link removed successfully from database')
-                else:
-                    logger.error('Could not remove invite link from database')
-            else:
-                logger.error(f'Could not revoke invite link: {link}')
-
-        # Create a single-use invite link
-        invite = bot.create_chat_invite_link(
-            chat_id = GROUP_CHAT_ID,
-            #name = telegram_user_id,      #
-            #expire_date = None,            # No expiry time, can be set if needed
-            #member_limit = 1,              # Valid for one user only (if set, creates_join_request must be False)
-            creates_join_request = True     # Requires approval by admin before being added (if True, member_limit must not be set)
-        )
-        # Store the newly created invite link in the DB
-        database.store_link(
-            telegram_user_id=telegram_user_id, 
-            twitch_user_id=None, 
-            patreon_user_id=patron_user_id,
-            invite_link=invite.invite_link)
+        revoke_invite_links(database.find_links_by_telegram_id(telegram_user_id))
 
-        bot.send_message(telegram_chat_id, BOT_JOIN_TELEGRAM_GROUP.format(invite.invite_link))
+        database.store_member_identity(telegram_user_id, PatreonHelper.PLATFORM, patron_user_id)
+        oauth_token_vault.store(token_vault.user_token_name(PatreonHelper.PLATFORM, patron_user_id), PatreonHelper.PLATFORM, access_token, refresh_token, expires_in)
+
+        # Get a single-use invite link, and send it
+        issue_invite_link(telegram_user_id, telegram_chat_id, patreon_user_id=patron_user_id)
 
     else:
-        bot.send_message(telegram_chat_id, BOT_SUBSCRIPTION_NOT_ACTIVE, parse_mode='HTML')
+        telegram_outbox.send('send_message', chat_id=telegram_chat_id, text=BOT_SUBSCRIPTION_NOT_ACTIVE, parse_mode='HTML')
 
     return '', 200
 
-# 
-@flask_app.route(PATH_PATREON_REFRESH_TOKEN, methods=['GET'])
+# Refresh the creator token now, without waiting for it to expire (e.g. after revoking it)
+@flask_app.route(PATH_PATREON_REFRESH_TOKEN, methods=['POST'])
 def webhook_patreon_refresh_token():
     if DEBUG: logger.debug('endpoint called')
 
-    # Get query parameters from the URL
-    params = flask.request.args
-
-    return '', 200
+    return refresh_service_token(PatreonHelper.CREATOR_TOKEN)
 
 # Handle user unsubscribed from creator (subscription expired or manually removed) 
 # More info on this webhook at https://docs.patreon.com/#apiv2-webhook-endpoints
@@ -505,18 +828,37 @@ def webhook_patreon_refresh_token():
 def webhook_patreon_user_unsubscribed():
     if DEBUG: logger.debug('endpoint called')
 
-    data = flask.request.json
-    headers = flask.request.headers
+    # Check the signature on the raw body first: a forged request would get a patron removed from the group
+    body = flask.request.get_data()
+    if not patreon_info.verify_webhook_signature(flask.request.headers, body):
+        logger.warning('Rejected a Patreon webhook request with an invalid signature')
+        return 'invalid signature', 403
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return 'invalid body', 400
+    trigger = flask.request.headers.get('X-Patreon-Event')
+    if not data:
+        return 'got no reply', 400
+    logging_setup.log_payload(logger, 'Patreon webhook payload', data)
 
-    logger.info(f'Received a Patreon webhook: {headers}{data}')
+    patreon_user_id, patreon_user_name, lapsed = patreon_info.parse_member_webhook(trigger, data)
+    if not lapsed or not patreon_user_id:
+        if DEBUG: logger.debug('Ignoring Patreon webhook %s for user %s', trigger, patreon_user_id)
+        return 'ignored', 200
 
-    patreon_user_id = [info['id'] for info in data['data']['attributes'] if info['type'] == 'user'][0]
-    patreon_user_name = data['data']['attributes']['full_name']
-    patreon_user_email = data['data']['attributes']['email']
+    logger.info('Patreon user not paid subscriber anymore: %s - %s', patreon_user_id, patreon_user_name)
 
-    logger.info(f'Patreon user not paid subscriber anymore: {patreon_user_id} - {patreon_user_name} - {patreon_user_email}')
+    # Indexed lookup of the Telegram user, the removal itself happens in the background
+    telegram_user_id = database.find_telegram_user_id(PatreonHelper.PLATFORM, patreon_user_id)
+    if not telegram_user_id:
+        logger.info('Patreon user %s has no known Telegram user', patreon_user_id)
+        return 'ignored', 200
 
-    return 'ignored', 200
+    member_scheduler.schedule('remove_member', telegram_user_id=telegram_user_id, username=patreon_user_name)
+
+    return 'removed', 200
 
 
 
@@ -544,44 +886,37 @@ def handle_join_chat_request(message: telebot.types.ChatJoinRequest):
     user_id = message.from_user.id
     if user_id != bot.bot_id:
         used_invite_link = message.invite_link.invite_link if message.invite_link else None
-        logger.info(f'{message.from_user.username} is using {used_invite_link} to request to join the group.')
+        logger.info('%s is using %s to request to join the group.', message.from_user.username, used_invite_link)
 
         if used_invite_link and database.user_owns_link(user_id, used_invite_link):
-            logger.info(f'{message.from_user.username} owns {used_invite_link}.')
-            bot.approve_chat_join_request(GROUP_CHAT_ID, user_id)
-            bot.send_message(GROUP_CHAT_ID, BOT_WELCOME_TO_GROUP.format(message.from_user.username))
-
-            result = bot.revoke_chat_invite_link(GROUP_CHAT_ID, used_invite_link)
-            if result.is_revoked:
-                logger.info('Invite link revoked succesfully')
-                logger.info('Removing invite link from database')
-                if database.remove_link(used_invite_link):
-                    logger.info('Invite link removed from database')
-                else:
-                    logger.error('Could not remove invite link from database')
-                
-                if database.remove_user_session(user_id):
-                    logger.info('User session removed from database')
-                else:
-                    logger.error('Could not remove user session')
-            else:
-                logger.error(f'Could not revoke invite link: {used_invite_link}')
+            logger.info('%s owns %s.', message.from_user.username, used_invite_link)
+
+            # The link and the user session are removed in the same transaction that queues the Telegram calls,
+            # so either the whole join is recorded or none of it is. The invite link makes the keys unique.
+            database.complete_join(user_id, used_invite_link, [
+                outbox.message('approve_chat_join_request', f'approve:{used_invite_link}', chat_id=GROUP_CHAT_ID, user_id=user_id),
+                outbox.message('send_message', f'welcome:{used_invite_link}', chat_id=GROUP_CHAT_ID, text=BOT_WELCOME_TO_GROUP.format(message.from_user.username)),
+                outbox.message('revoke_chat_invite_link', f'revoke:{used_invite_link}', chat_id=GROUP_CHAT_ID, invite_link=used_invite_link),
+            ])
+            telegram_outbox.notify()
+            # The approval is only queued: the roster records the user as a member from the chat_member update
+            # Telegram sends once they are in, see on_chat_member_updated()
+            joins_approved.inc()
+            logger.info('Join approved, invite link and user session removed from database')
 
         else:
-            logger.info(f'{message.from_user.username} does NOT own {used_invite_link}.')
-            bot.decline_chat_join_request(GROUP_CHAT_ID, user_id)
-
-            try:
-                bot.send_message(user_id, BOT_USER_TRIED_CHEATING)
-            except ApiTelegramException as e:
-                logger.error(f"Sending message to user trying to sneak in failed with error: {e}")
+            logger.info('%s does NOT own %s.', message.from_user.username, used_invite_link)
+            telegram_outbox.send_all([
+                outbox.message('decline_chat_join_request', chat_id=GROUP_CHAT_ID, user_id=user_id),
+                outbox.message('send_message', chat_id=user_id, text=BOT_USER_TRIED_CHEATING),
+            ])
+            joins_declined.inc()
             return
 
 
 def helper_add_me(bot, requesting_user_id, chat_id):
     # Check if user requesting the invite link is already a member of the group
-    group_chat_member = bot.get_chat_member(GROUP_CHAT_ID, requesting_user_id) if requesting_user_id else None
-    if group_chat_member and group_chat_member.status in ['member', 'restricted', 'administrator', 'creator']:
+    if requesting_user_id and group_roster.is_member(requesting_user_id):
         bot.send_message(chat_id, BOT_ALREADY_JOINED_GROUP)
 
     else:
@@ -597,31 +932,45 @@ def helper_add_me(bot, requesting_user_id, chat_id):
 
 @bot.callback_query_handler(func=lambda call: True, data=['add_me'])
 def callback_query_add_me(call: telebot.types.CallbackQuery):
-    if DEBUG: logger.debug(f'"Lo sono" button pressed: {call.data}')
+    if DEBUG: logger.debug('"Lo sono" button pressed: %s', call.data)
     
     helper_add_me(bot, requesting_user_id=call.from_user.id, chat_id=call.message.chat.id)
 
 @bot.message_handler(commands=['add_me'])
 def command_add_me(message: telebot.types.Message):
-    if DEBUG: logger.debug(f'Command "add-me" received: {message}')
+    logging_setup.log_payload(logger, 'Command "add-me" received', message)
 
     requesting_user_id = message.from_user.id if message.from_user else None
     helper_add_me(bot, requesting_user_id=requesting_user_id, chat_id=message.chat.id)
 
 
 def get_platform_verify_link(platform, from_user_id, chat_id):
-    csrf_token = ''.join(random.choices(string.ascii_letters, k=32))
-    database.store_session(telegram_user_id=from_user_id, telegram_chat_from_id=chat_id, platform=platform, session_id=csrf_token)
+    if STATE_TOKEN_SECRET:
+        csrf_token = signed_state.encode(STATE_TOKEN_SECRET, from_user_id, chat_id, platform, ttl=database.SESSION_TTL)
+    else:
+        csrf_token = ''.join(random.choices(string.ascii_letters, k=32))
+        database.store_session(telegram_user_id=from_user_id, telegram_chat_from_id=chat_id, platform=platform, session_id=csrf_token)
     verify_link = f'{WEBHOOK_TWITCH_VERIFY}?token={csrf_token}'
 
-    logger.info(f'Storing verify link {verify_link} for user {from_user_id}')
+    logger.info('Storing verify link %s for user %s', verify_link, from_user_id)
 
     return verify_link
 
+# Get (telegram_user_id, telegram_chat_id, platform) from the OAuth state, None if unknown or expired
+def get_session_user_info(csrf_token):
+    if STATE_TOKEN_SECRET:
+        try:
+            return signed_state.decode(STATE_TOKEN_SECRET, csrf_token)
+        except signed_state.InvalidStateToken as e:
+            logger.info('Rejected OAuth state: %s', e)
+            return None
+
+    return database.find_user_info_from_session(csrf_token)
+
 # User requested to verify via TWITCH
 @bot.callback_query_handler(func=lambda call: True, data=['platform_twitch'])
 def callback_query_platform_twitch(call: telebot.types.CallbackQuery):
-    if DEBUG: logger.debug(f'"Twitch" button pressed: {call.data}')
+    if DEBUG: logger.debug('"Twitch" button pressed: %s', call.data)
 
     verify_link = get_platform_verify_link(TwitchHelper.PLATFORM, call.from_user.id, call.message.chat.id)
     message_html = BOT_PLATFORM_CHOICE.format(platform=TwitchHelper.PLATFORM_NAME, link=verify_link)
@@ -630,20 +979,16 @@ def callback_query_platform_twitch(call: telebot.types.CallbackQuery):
 # User requested to verify via TWITCH
 @bot.message_handler(commands=['add_me_twitch'])
 def command_platform_twitch(message: telebot.types.Message):
-    if DEBUG: logger.debug(f'Command "add_me_twitch" received: {message}')
+    logging_setup.log_payload(logger, 'Command "add_me_twitch" received', message)
 
     requesting_user_id = message.from_user.id if message.from_user else None
     message_html = None
     # Check if user requesting the invite link is already a member of the group
-    group_chat_member = bot.get_chat_member(GROUP_CHAT_ID, requesting_user_id) if requesting_user_id else None
-    if group_chat_member and group_chat_member.status in ['member', 'restricted', 'administrator', 'creator']:
+    if requesting_user_id and group_roster.is_member(requesting_user_id):
         message_html = BOT_ALREADY_JOINED_GROUP
 
     else:
-        csrf_token = ''.join(random.choices(string.ascii_letters, k=32))
-        database.store_session(telegram_user_id=requesting_user_id, telegram_chat_from_id=message.chat.id, platform=TwitchHelper.PLATFORM, session_id=csrf_token)
-
-        verify_link = f'{WEBHOOK_TWITCH_VERIFY}?token={csrf_token}'
+        verify_link = get_platform_verify_link(TwitchHelper.PLATFORM, requesting_user_id, message.chat.id)
         message_html = BOT_PLATFORM_CHOICE.format(platform=TwitchHelper.PLATFORM_NAME, link=verify_link)
 
     bot.send_message(message.chat.id, message_html, parse_mode='HTML')
@@ -651,7 +996,7 @@ def command_platform_twitch(message: telebot.types.Message):
 # User requested to verify via PATREON
 @bot.callback_query_handler(func=lambda call: True, data=['platform_patreon'])
 def callback_query_platform_patreon(call: telebot.types.CallbackQuery):
-    if DEBUG: logger.debug(f'"Patreon" button pressed: {call.data}')
+    if DEBUG: logger.debug('"Patreon" button pressed: %s', call.data)
 
     verify_link = get_platform_verify_link(PatreonHelper.PLATFORM, call.from_user.id, call.message.chat.id)
     message_html = BOT_PLATFORM_CHOICE.format(platform=PatreonHelper.PLATFORM_NAME, link=verify_link)
@@ -660,13 +1005,12 @@ def callback_query_platform_patreon(call: telebot.types.CallbackQuery):
 # User requested to verify via PATREON
 @bot.message_handler(commands=['add_me_patreon'])
 def command_platform_patreon(message: telebot.types.Message):
-    if DEBUG: logger.debug(f'Command "add_me_patreon" received: {message}')
+    logging_setup.log_payload(logger, 'Command "add_me_patreon" received', message)
 
     requesting_user_id = message.from_user.id if message.from_user else None
     # Check if user requesting the invite link is already a member of the group
-    group_chat_member = bot.get_chat_member(GROUP_CHAT_ID, requesting_user_id) if requesting_user_id else None
     message_html = None
-    if group_chat_member and group_chat_member.status in ['member', 'restricted', 'administrator', 'creator']:
+    if requesting_user_id and group_roster.is_member(requesting_user_id):
         message_html = BOT_ALREADY_JOINED_GROUP
 
     else:
@@ -678,7 +1022,7 @@ def command_platform_patreon(message: telebot.types.Message):
 # User requested to verify via YOUTUBE
 @bot.callback_query_handler(func=lambda call: True, data=['platform_youtube'])
 def callback_query_platform_youtube(call: telebot.types.CallbackQuery):
-    if DEBUG: logger.debug(f'"Youtube" button pressed: {call.data}')
+    if DEBUG: logger.debug('"Youtube" button pressed: %s', call.data)
 
     #message_html = BOT_PLATFORM_CHOICE.format(platform='Youtube', link=VERIFY_SUBSCRIPTION_LINK)
     message_html = "Il reame di <b>Youtube</b>non è ancora pronto per essere utilizzato."
@@ -687,7 +1031,7 @@ def callback_query_platform_youtube(call: telebot.types.CallbackQuery):
 
 @bot.callback_query_handler(func=lambda call: True, data=['finish'])
 def callback_query_finish(call: telebot.types.CallbackQuery):
-    if DEBUG: logger.debug(f'"Non lo sono" button pressed: {call.data}')
+    if DEBUG: logger.debug('"Non lo sono" button pressed: %s', call.data)
 
     bot.answer_callback_query(call.id, "Answer is No")
 
@@ -697,16 +1041,20 @@ def on_user_removed(message: telebot.types.Message):
 
     # Process updates only from the main chat
     if message.chat.id == GROUP_CHAT_ID and message.left_chat_member:
+        group_roster.update(message.left_chat_member.id, 'left')
 
         # Try sending a goodbye message to the user that left the chat
-        try:
-            bot.send_message(message.left_chat_member.id, BOT_REMOVED_FROM_CHAT)
-        except ApiTelegramException as e:
-            logger.error(f"Sending message to user kicked off of chat failed with error: {e}")
+        telegram_outbox.send('send_message', chat_id=message.left_chat_member.id, text=BOT_REMOVED_FROM_CHAT)
         return
 
     else:
-        logger.info(f"Ignoring request coming from chat {message.chat.id}")
+        logger.info("Ignoring request coming from chat %s", message.chat.id)
+
+# The membership of a user in the group changed (joined, left, banned, promoted...)
+@bot.chat_member_handler()
+def on_chat_member_updated(update: telebot.types.ChatMemberUpdated):
+    if update.chat.id == GROUP_CHAT_ID:
+        group_roster.update(update.new_chat_member.user.id, update.new_chat_member.status)
 
 # This handler removes all service messages
 @bot.message_handler(content_types=telebot.util.content_type_service)
@@ -725,6 +1073,47 @@ def echo_message(message):
         bot.reply_to(message, reply_text)
 
 
+# App factory, the WSGI entry point must serve `create_app()` (see wsgi.py), not flask_app.
+# Runs the database migrations, then starts the background work; later calls just return the app.
+# The webhook registrations run in the background, so the app can serve requests right away.
+def create_app():
+    global _app_started, twitch_info, patreon_info, patreon_reconciler, twitch_reconciler
+    with _app_start_lock:
+        if _app_started:
+            return flask_app
+
+        database.check_or_create_db()
+        twitch_info = init_twitch()
+        patreon_info = init_patreon()
+        oauth_token_vault.start()
+        session_sweeper.start()
+        group_roster.start()
+        if telegram_dispatcher:
+            telegram_dispatcher.start()
+        invite_link_pool.start()
+        member_scheduler.start()
+        telegram_outbox.start()
+        outbox_sweeper.start()
+        patreon_reconciler = background.PeriodicTask(
+            'patreon-reconciler',
+            PATREON_RECONCILE_INTERVAL,
+            reconciliation.reconcile_patreon,
+            patreon_info,
+            PATREON_CAMPAIGN_ID,
+            member_scheduler
+        ).start()
+        twitch_reconciler = background.PeriodicTask(
+            'twitch-reconciler',
+            TWITCH_RECONCILE_INTERVAL,
+            reconciliation.reconcile_twitch,
+            twitch_info,
+            member_scheduler,
+            max_pages=TWITCH_RECONCILE_MAX_PAGES or None
+        ).start()
+        provider_registry.start()
+        _app_started = True
+    return flask_app
+
 # pythonanywhere uses a WSGI interface, meaning this script must not run flask_app.run()
 # unless it gets executed explicitely run via command line.
 if __name__ == '__main__':
@@ -732,7 +1121,7 @@ if __name__ == '__main__':
     WEBHOOK_LISTEN = '127.0.0.1'  # In some VPS you may need to put here the IP addr
 
     # Start flask server
-    flask_app.run(
+    create_app().run(
         host=WEBHOOK_LISTEN, 
         port=WEBHOOK_PORT, 
         debug=DEBUG, 
@@ -1,8 +1,40 @@
 import sqlite3
 import os
+import queue
+import threading
+import contextlib
+import functools
+import inspect
+import time
+
+import metrics
 
 DB_NAME = "./invite_links_v6.db"
 
+# Connection pool settings. Connections are opened lazily and reused across calls,
+# so the file open, schema read and pragma setup are paid once per connection.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+DB_POOL_TIMEOUT = 10                # Seconds to wait for a free connection before giving up
+DB_CACHED_STATEMENTS = 128          # Prepared statements cached per connection
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",    # Readers don't block the writer and vice versa
+    "PRAGMA synchronous = NORMAL",  # Safe with WAL, skips the fsync on every commit
+    "PRAGMA cache_size = -8000",    # ~8MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# User sessions older than this are ignored by lookups and deleted by the sweeper
+SESSION_TTL = int(os.getenv("SESSION_TTL", 60 * 30))
+SESSION_SWEEP_BATCH_SIZE = 500      # Rows deleted per transaction, keeps the write lock short
+INCREMENTAL_VACUUM_PAGES = 1000     # Free pages returned to the filesystem per sweep
+
+# Status of an Outbox entry
+OUTBOX_PENDING = "pending"
+OUTBOX_DONE = "done"
+OUTBOX_DEAD = "dead"                # Gave up after too many attempts, or a permanent error
+OUTBOX_RETENTION = 60 * 60 * 24 * 7 # Done entries are kept this long, so their idempotency keys keep deduplicating
+
 TABLE_LINK_INFO_NAME = "LinkInfo"
 CREATE_TABLE_LINK_INFO = f"""
     CREATE TABLE IF NOT EXISTS {TABLE_LINK_INFO_NAME} (
@@ -23,128 +55,774 @@ CREATE_TABLE_USER_SESSIONS = f"""
         session_id TEXT NOT NULL
     )
 """
+TABLE_INVITE_POOL_NAME = "InvitePool"
+CREATE_TABLE_INVITE_POOL = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_INVITE_POOL_NAME} (
+        row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invite_link TEXT NOT NULL UNIQUE,
+        created_at INTEGER NOT NULL
+    )
+"""
+TABLE_SCHEDULED_TASK_NAME = "ScheduledTask"
+CREATE_TABLE_SCHEDULED_TASK = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_SCHEDULED_TASK_NAME} (
+        row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        run_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )
+"""
+TABLE_OUTBOX_NAME = "Outbox"
+CREATE_TABLE_OUTBOX = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_OUTBOX_NAME} (
+        row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        method TEXT NOT NULL,
+        arguments TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT '{OUTBOX_PENDING}',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at INTEGER NOT NULL
+    )
+"""
+TABLE_MEMBER_IDENTITY_NAME = "MemberIdentity"
+CREATE_TABLE_MEMBER_IDENTITY = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_MEMBER_IDENTITY_NAME} (
+        row_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_user_id INTEGER NOT NULL,
+        platform TEXT NOT NULL,
+        platform_user_id TEXT NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+"""
+TABLE_RECONCILIATION_STATE_NAME = "ReconciliationState"
+CREATE_TABLE_RECONCILIATION_STATE = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_RECONCILIATION_STATE_NAME} (
+        job TEXT PRIMARY KEY,
+        cursor TEXT,
+        started_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+"""
+TABLE_RECONCILIATION_SEEN_NAME = "ReconciliationSeen"
+CREATE_TABLE_RECONCILIATION_SEEN = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_RECONCILIATION_SEEN_NAME} (
+        job TEXT NOT NULL,
+        platform_user_id TEXT NOT NULL,
+        PRIMARY KEY (job, platform_user_id)
+    ) WITHOUT ROWID
+"""
+TABLE_OAUTH_TOKEN_NAME = "OAuthToken"
+CREATE_TABLE_OAUTH_TOKEN = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_OAUTH_TOKEN_NAME} (
+        name TEXT PRIMARY KEY,
+        platform TEXT NOT NULL,
+        access_token TEXT NOT NULL,
+        refresh_token TEXT,
+        expires_at REAL,
+        keep_fresh INTEGER NOT NULL DEFAULT 0,
+        refreshed_at REAL,
+        updated_at INTEGER NOT NULL
+    )
+"""
+TABLE_PROVIDER_REGISTRATION_NAME = "ProviderRegistration"
+CREATE_TABLE_PROVIDER_REGISTRATION = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_PROVIDER_REGISTRATION_NAME} (
+        provider TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        registered_at INTEGER NOT NULL
+    )
+"""
+TABLE_GROUP_ROSTER_NAME = "GroupRoster"
+CREATE_TABLE_GROUP_ROSTER = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_GROUP_ROSTER_NAME} (
+        chat_id INTEGER NOT NULL,
+        telegram_user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        verified_at INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, telegram_user_id)
+    ) WITHOUT ROWID
+"""
+TABLE_WEBHOOK_SECRET_NAME = "WebhookSecret"
+CREATE_TABLE_WEBHOOK_SECRET = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_WEBHOOK_SECRET_NAME} (
+        provider TEXT PRIMARY KEY,
+        secret TEXT NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+"""
+TABLE_SCHEMA_VERSION_NAME = "SchemaVersion"
+CREATE_TABLE_SCHEMA_VERSION = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_SCHEMA_VERSION_NAME} (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at INTEGER NOT NULL
+    )
+"""
+
+# Schema migrations, applied in order by apply_migrations().
+# Never edit or reorder a migration that has been released: append a new one instead.
+# Version 1 uses "IF NOT EXISTS" so databases created before migrations existed are adopted as-is.
+MIGRATIONS = [
+    (1, "Initial schema", [
+        CREATE_TABLE_LINK_INFO,
+        CREATE_TABLE_USER_SESSIONS,
+    ]),
+    (2, "Secondary indexes on lookup columns", [
+        f"CREATE INDEX IF NOT EXISTS idx_link_info_telegram_user_id ON {TABLE_LINK_INFO_NAME} (telegram_user_id)",
+        f"CREATE INDEX IF NOT EXISTS idx_link_info_invite_link ON {TABLE_LINK_INFO_NAME} (invite_link)",
+        f"CREATE INDEX IF NOT EXISTS idx_link_info_twitch_user_id ON {TABLE_LINK_INFO_NAME} (twitch_user_id)",
+        f"CREATE INDEX IF NOT EXISTS idx_link_info_patreon_user_id ON {TABLE_LINK_INFO_NAME} (patreon_user_id)",
+        f"CREATE INDEX IF NOT EXISTS idx_user_session_session_id ON {TABLE_USER_SESSION_NAME} (session_id)",
+        f"CREATE INDEX IF NOT EXISTS idx_user_session_telegram_user_id ON {TABLE_USER_SESSION_NAME} (telegram_user_id)",
+    ]),
+    (3, "One expiring session per user and platform", [
+        f"ALTER TABLE {TABLE_USER_SESSION_NAME} ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0",
+        f"UPDATE {TABLE_USER_SESSION_NAME} SET created_at = CAST(strftime('%s', 'now') AS INTEGER)",
+        # Keep only the most recent session of each user for each platform before enforcing uniqueness
+        f"""DELETE FROM {TABLE_USER_SESSION_NAME} WHERE row_id NOT IN (
+            SELECT MAX(row_id) FROM {TABLE_USER_SESSION_NAME} GROUP BY telegram_user_id, platform
+        )""",
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_user_session_user_platform ON {TABLE_USER_SESSION_NAME} (telegram_user_id, platform)",
+        f"CREATE INDEX IF NOT EXISTS idx_user_session_created_at ON {TABLE_USER_SESSION_NAME} (created_at)",
+    ]),
+    (4, "Pool of pre-created invite links", [
+        CREATE_TABLE_INVITE_POOL,
+        f"CREATE INDEX IF NOT EXISTS idx_invite_pool_created_at ON {TABLE_INVITE_POOL_NAME} (created_at)",
+    ]),
+    (5, "Persisted scheduled tasks", [
+        CREATE_TABLE_SCHEDULED_TASK,
+    ]),
+    (6, "Outbox of Telegram side effects", [
+        CREATE_TABLE_OUTBOX,
+        f"CREATE INDEX IF NOT EXISTS idx_outbox_status_next_attempt_at ON {TABLE_OUTBOX_NAME} (status, next_attempt_at)",
+    ]),
+    (7, "Platform user to Telegram user mapping", [
+        CREATE_TABLE_MEMBER_IDENTITY,
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_member_identity_platform_user ON {TABLE_MEMBER_IDENTITY_NAME} (platform, platform_user_id)",
+        f"CREATE INDEX IF NOT EXISTS idx_member_identity_telegram_user_id ON {TABLE_MEMBER_IDENTITY_NAME} (telegram_user_id)",
+        # Keep the mappings of the invite links still in the database
+        f"""INSERT OR IGNORE INTO {TABLE_MEMBER_IDENTITY_NAME} (telegram_user_id, platform, platform_user_id, updated_at)
+            SELECT telegram_user_id, 'platform-twitch', CAST(twitch_user_id AS TEXT), CAST(strftime('%s', 'now') AS INTEGER)
+            FROM {TABLE_LINK_INFO_NAME} WHERE twitch_user_id IS NOT NULL""",
+        f"""INSERT OR IGNORE INTO {TABLE_MEMBER_IDENTITY_NAME} (telegram_user_id, platform, platform_user_id, updated_at)
+            SELECT telegram_user_id, 'platform-patreon', CAST(patreon_user_id AS TEXT), CAST(strftime('%s', 'now') AS INTEGER)
+            FROM {TABLE_LINK_INFO_NAME} WHERE patreon_user_id IS NOT NULL""",
+    ]),
+    (8, "Resumable reconciliation state", [
+        CREATE_TABLE_RECONCILIATION_STATE,
+        CREATE_TABLE_RECONCILIATION_SEEN,
+    ]),
+    (9, "OAuth token vault", [
+        CREATE_TABLE_OAUTH_TOKEN,
+        f"CREATE INDEX IF NOT EXISTS idx_oauth_token_expires_at ON {TABLE_OAUTH_TOKEN_NAME} (expires_at)",
+    ]),
+    (10, "Cached provider webhook registrations", [
+        CREATE_TABLE_PROVIDER_REGISTRATION,
+    ]),
+    (11, "Local roster of the group members", [
+        CREATE_TABLE_GROUP_ROSTER,
+        f"CREATE INDEX IF NOT EXISTS idx_group_roster_verified_at ON {TABLE_GROUP_ROSTER_NAME} (chat_id, verified_at)",
+    ]),
+    (12, "Secrets signing the provider webhooks", [
+        CREATE_TABLE_WEBHOOK_SECRET,
+    ]),
+    (13, "Group chat of the pool invite links", [
+        # The links already in the pool get no chat: they are revoked by the next rotation, see take_stale_pool_links()
+        f"ALTER TABLE {TABLE_INVITE_POOL_NAME} ADD COLUMN chat_id INTEGER",
+        f"DROP INDEX IF EXISTS idx_invite_pool_created_at",
+        f"CREATE INDEX IF NOT EXISTS idx_invite_pool_chat_id_created_at ON {TABLE_INVITE_POOL_NAME} (chat_id, created_at)",
+    ]),
+]
+
+""" Small pool of long-lived SQLite connections shared by all threads """
+class ConnectionPool():
+
+    def __init__(self, db_name, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self._db_name = db_name
+        self._size = size
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    """ Open a new connection and apply the tuning pragmas """
+    def _open(self):
+        # check_same_thread is disabled because a connection may be handed to a
+        # different thread once returned to the pool; the pool never shares it concurrently.
+        conn = sqlite3.connect(self._db_name, cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    """ Take an idle connection, opening a new one if the pool is not full yet """
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all) < self._size:
+                conn = self._open()
+                self._all.append(conn)
+                return conn
+
+        try:
+            return self._idle.get(timeout=self._timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f'No database connection available after {self._timeout}s')
 
-# Check if the database exists
+    """ Give a connection back to the pool, dropping any unfinished transaction """
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    """ Borrow a connection for the duration of a `with` block """
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    """ Close every connection owned by the pool """
+    def close_all(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+            self._idle = queue.LifoQueue()
+
+_pool = ConnectionPool(DB_NAME)
+
+# Borrow a connection to run read-only queries
+def connection():
+    return _pool.connection()
+
+# Borrow a connection and run the block in a single transaction (commit on success, rollback on error)
+@contextlib.contextmanager
+def transaction():
+    with _pool.connection() as conn:
+        with conn:
+            yield conn
+
+# Record the duration of a database function in the metrics, labelled with its name, waiting for the pool included.
+# For a generator, the whole iteration is timed: it holds its connection until then.
+def timed(function):
+    name = function.__name__
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def timed_generator(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                yield from function(*args, **kwargs)
+            finally:
+                metrics.db_query_duration.observe(time.perf_counter() - started_at, name)
+        return timed_generator
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.db_query_duration.observe(time.perf_counter() - started_at, name)
+    return timed_function
+
+# Close all the pooled connections (e.g. on shutdown, or before replacing the database file)
+def close_all_connections():
+    _pool.close_all()
+
+# Check if the database exists, and bring its schema up to date
 def check_or_create_db():
     db_exists = os.path.exists(DB_NAME)
     if not db_exists:
         print(f"Database '{DB_NAME}' not found. Creating a new one...")
-        initialize_db()
     else:
         print(f"Database '{DB_NAME}' already exists.")
+    initialize_db()
 
 # Database initialization
 def initialize_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(CREATE_TABLE_LINK_INFO)
-    cursor.execute(CREATE_TABLE_USER_SESSIONS)
-    conn.commit()
-    conn.close()
-
-# Store an object in the database
-def store_link(telegram_user_id, twitch_user_id, patreon_user_id, invite_link):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"INSERT INTO {TABLE_LINK_INFO_NAME} (telegram_user_id, twitch_user_id, patreon_user_id, invite_link) VALUES (?, ?, ?, ?)", (telegram_user_id, twitch_user_id, patreon_user_id, invite_link))
-    conn.commit()
-    conn.close()
+    applied = apply_migrations()
+    if applied:
+        print(f"Database '{DB_NAME}' migrated to schema version {applied[-1]}.")
+    enable_incremental_vacuum()
+
+# Switch the database to incremental auto-vacuum, so deleted rows can give space back to the filesystem.
+# Changing this on an existing database needs a full VACUUM, which only happens once.
+@timed
+def enable_incremental_vacuum():
+    with connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        print(f"Database '{DB_NAME}' switching to incremental auto-vacuum...")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+# Release up to `pages` free pages back to the filesystem
+@timed
+def incremental_vacuum(pages=INCREMENTAL_VACUUM_PAGES):
+    with connection() as conn:
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+
+# Get the current schema version (0 if no migration has been applied yet)
+@timed
+def get_schema_version():
+    with connection() as conn:
+        conn.execute(CREATE_TABLE_SCHEMA_VERSION)
+        return conn.execute(f"SELECT COALESCE(MAX(version), 0) FROM {TABLE_SCHEMA_VERSION_NAME}").fetchone()[0]
+
+# Apply all the pending migrations, each one in its own transaction. Return the versions applied.
+@timed
+def apply_migrations(migrations=MIGRATIONS):
+    applied = []
+    for version, description, statements in sorted(migrations, key=lambda m: m[0]):
+        with connection() as conn:
+            conn.execute(CREATE_TABLE_SCHEMA_VERSION)
+            # BEGIN IMMEDIATE takes the write lock, so concurrent workers starting up
+            # wait here and then see the migration as already applied.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = conn.execute(f"SELECT COALESCE(MAX(version), 0) FROM {TABLE_SCHEMA_VERSION_NAME}").fetchone()[0]
+                if version <= current:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"INSERT INTO {TABLE_SCHEMA_VERSION_NAME} (version, description, applied_at) VALUES (?, ?, ?)", (version, description, int(time.time())))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        applied.append(version)
+    return applied
+
+# Store an object in the database, and queue the outbox messages sending it in the same transaction
+@timed
+def store_link(telegram_user_id, twitch_user_id, patreon_user_id, invite_link, messages=()):
+    with transaction() as conn:
+        conn.execute(f"INSERT INTO {TABLE_LINK_INFO_NAME} (telegram_user_id, twitch_user_id, patreon_user_id, invite_link) VALUES (?, ?, ?, ?)", (telegram_user_id, twitch_user_id, patreon_user_id, invite_link))
+        _insert_outbox_messages(conn, messages)
 
 # Retrieve all objects from the database
+@timed
 def retrieve_all_links():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT * FROM {TABLE_LINK_INFO_NAME}")
-    records = cursor.fetchall()
-    conn.close()
-    return records
+    with connection() as conn:
+        return conn.execute(f"SELECT * FROM {TABLE_LINK_INFO_NAME}").fetchall()
 
 # Find links by telegram ID (return only the links)
+@timed
 def find_links_by_telegram_id(telegram_user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT invite_link FROM {TABLE_LINK_INFO_NAME} WHERE telegram_user_id = ?", (telegram_user_id,))
-    records = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return records
+    with connection() as conn:
+        cursor = conn.execute(f"SELECT invite_link FROM {TABLE_LINK_INFO_NAME} WHERE telegram_user_id = ?", (telegram_user_id,))
+        return [row[0] for row in cursor.fetchall()]
 
 # Find links by twitch ID (return only the links)
+@timed
 def find_links_by_twitch_id(twitch_user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT invite_link FROM {TABLE_LINK_INFO_NAME} WHERE twitch_user_id = ?", (twitch_user_id,))
-    records = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return records
+    with connection() as conn:
+        cursor = conn.execute(f"SELECT invite_link FROM {TABLE_LINK_INFO_NAME} WHERE twitch_user_id = ?", (twitch_user_id,))
+        return [row[0] for row in cursor.fetchall()]
 
 # Find links by patreon ID (return only the links)
+@timed
 def find_links_by_patreon_id(patreon_user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT invite_link FROM {TABLE_LINK_INFO_NAME} WHERE patreon_user_id = ?", (patreon_user_id,))
-    records = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return records
+    with connection() as conn:
+        cursor = conn.execute(f"SELECT invite_link FROM {TABLE_LINK_INFO_NAME} WHERE patreon_user_id = ?", (patreon_user_id,))
+        return [row[0] for row in cursor.fetchall()]
 
 # Find links by user_id (return only the links)
+@timed
 def user_owns_link(telegram_user_id, invite_link):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT * FROM {TABLE_LINK_INFO_NAME} WHERE telegram_user_id = ? AND invite_link = ?", (telegram_user_id, invite_link, ))
-    records = len([row[0] for row in cursor.fetchall()])
-    conn.close()
-    return True if records > 0 else False
+    with connection() as conn:
+        cursor = conn.execute(f"SELECT 1 FROM {TABLE_LINK_INFO_NAME} WHERE telegram_user_id = ? AND invite_link = ? LIMIT 1", (telegram_user_id, invite_link, ))
+        return cursor.fetchone() is not None
 
 # Remove the entry with a used invite link
+@timed
 def remove_link(invite_link):
 
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(f"DELETE FROM {TABLE_LINK_INFO_NAME} WHERE invite_link = ?", (invite_link,))
-            conn.commit()
+        with transaction() as conn:
+            conn.execute(f"DELETE FROM {TABLE_LINK_INFO_NAME} WHERE invite_link = ?", (invite_link,))
             return True
     except sqlite3.OperationalError as e:
         print(e)
         return False
 
+# Remove several invite links in a single transaction. Return the number of rows deleted.
+@timed
+def remove_links(invite_links, chunk_size=500):
+    invite_links = list(invite_links)
+    deleted = 0
+    with transaction() as conn:
+        # Chunked to stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(invite_links), chunk_size):
+            chunk = invite_links[start:start + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            deleted += conn.execute(f"DELETE FROM {TABLE_LINK_INFO_NAME} WHERE invite_link IN ({placeholders})", chunk).rowcount
+    return deleted
 
 
-# Store an object in the database
+
+# Store the session of a user for a platform, replacing any previous one
+@timed
 def store_session(telegram_user_id, telegram_chat_from_id, platform, session_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"INSERT INTO {TABLE_USER_SESSION_NAME} (telegram_user_id, telegram_chat_from_id, platform, session_id) VALUES (?, ?, ?, ?)", (telegram_user_id, telegram_chat_from_id, platform, session_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO {TABLE_USER_SESSION_NAME} (telegram_user_id, telegram_chat_from_id, platform, session_id, created_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (telegram_user_id, platform) DO UPDATE SET
+                telegram_chat_from_id = excluded.telegram_chat_from_id,
+                session_id = excluded.session_id,
+                created_at = excluded.created_at
+            """, (telegram_user_id, telegram_chat_from_id, platform, session_id, int(time.time())))
 
 # Retrieve all objects from the database
+@timed
 def retrieve_all_sessions():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT * FROM {TABLE_USER_SESSION_NAME}")
-    records = cursor.fetchall()
-    conn.close()
-    return records
+    with connection() as conn:
+        return conn.execute(f"SELECT * FROM {TABLE_USER_SESSION_NAME}").fetchall()
 
-# Retrieve all objects from the database
-def find_user_info_from_session(session_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT telegram_user_id, telegram_chat_from_id, platform FROM {TABLE_USER_SESSION_NAME} WHERE session_id = ?", (session_id,))
-    records = cursor.fetchall()
-    conn.close()
-    return records[0]
+# Retrieve the user info of a session that has not expired yet (None if not found or expired)
+@timed
+def find_user_info_from_session(session_id, ttl=SESSION_TTL):
+    with connection() as conn:
+        cursor = conn.execute(f"SELECT telegram_user_id, telegram_chat_from_id, platform FROM {TABLE_USER_SESSION_NAME} WHERE session_id = ? AND created_at >= ?", (session_id, int(time.time()) - ttl))
+        return cursor.fetchone()
 
 # Remove the entry with a used invite link
+@timed
 def remove_user_session(telegram_user_id):
 
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(f"DELETE FROM {TABLE_USER_SESSION_NAME} WHERE telegram_user_id = ?", (telegram_user_id,))
-            conn.commit()
+        with transaction() as conn:
+            conn.execute(f"DELETE FROM {TABLE_USER_SESSION_NAME} WHERE telegram_user_id = ?", (telegram_user_id,))
             return True
     except sqlite3.OperationalError as e:
         print(e)
-        return False
\ No newline at end of file
+        return False
+
+# Delete expired sessions in bounded batches, then give the freed space back. Return the number of rows deleted.
+@timed
+def delete_expired_sessions(ttl=SESSION_TTL, batch_size=SESSION_SWEEP_BATCH_SIZE):
+    expired_before = int(time.time()) - ttl
+    deleted = 0
+    while True:
+        with transaction() as conn:
+            cursor = conn.execute(f"""
+                DELETE FROM {TABLE_USER_SESSION_NAME} WHERE row_id IN (
+                    SELECT row_id FROM {TABLE_USER_SESSION_NAME} WHERE created_at < ? LIMIT ?
+                )""", (expired_before, batch_size))
+            deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            break
+
+    if deleted:
+        incremental_vacuum()
+    return deleted
+
+
+
+# Add pre-created invite links of a group chat to the pool
+@timed
+def store_pool_links(chat_id, invite_links):
+    now = int(time.time())
+    with transaction() as conn:
+        conn.executemany(f"INSERT OR IGNORE INTO {TABLE_INVITE_POOL_NAME} (chat_id, invite_link, created_at) VALUES (?, ?, ?)", [(chat_id, link, now) for link in invite_links])
+
+# Count the pool links of a group chat created after min_created_at
+@timed
+def count_pool_links(chat_id, min_created_at=0):
+    with connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {TABLE_INVITE_POOL_NAME} WHERE chat_id = ? AND created_at >= ?", (chat_id, min_created_at)).fetchone()[0]
+
+# Atomically take the oldest pool link of a group chat created after min_created_at and assign it to a user.
+# `messages(invite_link)` returns the outbox messages sending the link, queued in the same transaction.
+# Return the invite link, or None if the pool is empty.
+@timed
+def claim_pool_link(chat_id, telegram_user_id, twitch_user_id, patreon_user_id, min_created_at=0, messages=None):
+    with transaction() as conn:
+        row = conn.execute(f"""
+            DELETE FROM {TABLE_INVITE_POOL_NAME} WHERE row_id = (
+                SELECT row_id FROM {TABLE_INVITE_POOL_NAME} WHERE chat_id = ? AND created_at >= ? ORDER BY created_at, row_id LIMIT 1
+            ) RETURNING invite_link""", (chat_id, min_created_at)).fetchone()
+        if not row:
+            return None
+        conn.execute(f"INSERT INTO {TABLE_LINK_INFO_NAME} (telegram_user_id, twitch_user_id, patreon_user_id, invite_link) VALUES (?, ?, ?, ?)", (telegram_user_id, twitch_user_id, patreon_user_id, row[0]))
+        if messages:
+            _insert_outbox_messages(conn, messages(row[0]))
+        return row[0]
+
+# Remove the pool links of a group chat created before created_before, and the ones stored without a chat
+# (before schema version 13), and return them so they can be revoked
+@timed
+def take_stale_pool_links(chat_id, created_before):
+    with transaction() as conn:
+        return [row[0] for row in conn.execute(f"DELETE FROM {TABLE_INVITE_POOL_NAME} WHERE (chat_id = ? AND created_at < ?) OR chat_id IS NULL RETURNING invite_link", (chat_id, created_before)).fetchall()]
+
+
+
+# Store a task to run at run_at (epoch seconds), return its ID
+@timed
+def store_scheduled_task(action, payload, run_at):
+    with transaction() as conn:
+        return conn.execute(f"INSERT INTO {TABLE_SCHEDULED_TASK_NAME} (action, payload, run_at) VALUES (?, ?, ?)", (action, payload, run_at)).lastrowid
+
+# Retrieve all the pending tasks as (row_id, action, payload, run_at, attempts)
+@timed
+def retrieve_scheduled_tasks():
+    with connection() as conn:
+        return conn.execute(f"SELECT row_id, action, payload, run_at, attempts FROM {TABLE_SCHEDULED_TASK_NAME}").fetchall()
+
+# Move a task to a new time after a failed attempt
+@timed
+def reschedule_task(task_id, run_at, attempts):
+    with transaction() as conn:
+        conn.execute(f"UPDATE {TABLE_SCHEDULED_TASK_NAME} SET run_at = ?, attempts = ? WHERE row_id = ?", (run_at, attempts, task_id))
+
+# Remove a task once done
+@timed
+def remove_scheduled_task(task_id):
+    with transaction() as conn:
+        conn.execute(f"DELETE FROM {TABLE_SCHEDULED_TASK_NAME} WHERE row_id = ?", (task_id,))
+
+
+
+def _insert_outbox_messages(conn, messages):
+    now = time.time()
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {TABLE_OUTBOX_NAME} (idempotency_key, method, arguments, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(key, method, arguments, now, int(now)) for key, method, arguments in messages])
+
+# Queue Telegram calls as (idempotency_key, method, arguments). A key already queued is ignored.
+@timed
+def store_outbox_messages(messages):
+    with transaction() as conn:
+        _insert_outbox_messages(conn, messages)
+
+# Remove a used invite link and the user's sessions, and queue the Telegram calls of the join, in one transaction
+@timed
+def complete_join(telegram_user_id, invite_link, messages):
+    with transaction() as conn:
+        conn.execute(f"DELETE FROM {TABLE_LINK_INFO_NAME} WHERE invite_link = ?", (invite_link,))
+        conn.execute(f"DELETE FROM {TABLE_USER_SESSION_NAME} WHERE telegram_user_id = ?", (telegram_user_id,))
+        _insert_outbox_messages(conn, messages)
+
+# Take up to `limit` due outbox entries, hiding them from other workers for `lease` seconds.
+# Return them as (row_id, method, arguments, attempts).
+@timed
+def claim_outbox_messages(limit, lease):
+    now = time.time()
+    with transaction() as conn:
+        return conn.execute(f"""
+            UPDATE {TABLE_OUTBOX_NAME} SET next_attempt_at = ? WHERE row_id IN (
+                SELECT row_id FROM {TABLE_OUTBOX_NAME} WHERE status = '{OUTBOX_PENDING}' AND next_attempt_at <= ? ORDER BY next_attempt_at, row_id LIMIT ?
+            ) RETURNING row_id, method, arguments, attempts""", (now + lease, now, limit)).fetchall()
+
+# Mark an outbox entry as done
+@timed
+def complete_outbox_message(row_id):
+    with transaction() as conn:
+        conn.execute(f"UPDATE {TABLE_OUTBOX_NAME} SET status = '{OUTBOX_DONE}', attempts = attempts + 1, last_error = NULL WHERE row_id = ?", (row_id,))
+
+# Put a claimed outbox entry back in the queue, to be sent at next_attempt_at
+@timed
+def reschedule_outbox_message(row_id, next_attempt_at):
+    with transaction() as conn:
+        conn.execute(f"UPDATE {TABLE_OUTBOX_NAME} SET next_attempt_at = ? WHERE row_id = ?", (next_attempt_at, row_id))
+
+# Record a failed attempt: retry at next_attempt_at, or dead-letter the entry if next_attempt_at is None
+@timed
+def fail_outbox_message(row_id, error, next_attempt_at=None):
+    with transaction() as conn:
+        if next_attempt_at is None:
+            conn.execute(f"UPDATE {TABLE_OUTBOX_NAME} SET status = '{OUTBOX_DEAD}', attempts = attempts + 1, last_error = ? WHERE row_id = ?", (error, row_id))
+        else:
+            conn.execute(f"UPDATE {TABLE_OUTBOX_NAME} SET attempts = attempts + 1, last_error = ?, next_attempt_at = ? WHERE row_id = ?", (error, next_attempt_at, row_id))
+
+# Count the outbox entries by status
+@timed
+def count_outbox_messages():
+    with connection() as conn:
+        return dict(conn.execute(f"SELECT status, COUNT(*) FROM {TABLE_OUTBOX_NAME} GROUP BY status").fetchall())
+
+# Delete the done outbox entries older than the retention period. Return the number of rows deleted.
+@timed
+def delete_done_outbox_messages(retention=OUTBOX_RETENTION):
+    with transaction() as conn:
+        return conn.execute(f"DELETE FROM {TABLE_OUTBOX_NAME} WHERE status = '{OUTBOX_DONE}' AND created_at < ?", (int(time.time()) - retention,)).rowcount
+
+
+
+# Remember which Telegram user a platform (Twitch, Patreon) user is
+@timed
+def store_member_identity(telegram_user_id, platform, platform_user_id):
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO {TABLE_MEMBER_IDENTITY_NAME} (telegram_user_id, platform, platform_user_id, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (platform, platform_user_id) DO UPDATE SET
+                telegram_user_id = excluded.telegram_user_id,
+                updated_at = excluded.updated_at
+            """, (telegram_user_id, platform, str(platform_user_id), int(time.time())))
+
+# Find the Telegram user ID of a platform user (None if unknown)
+@timed
+def find_telegram_user_id(platform, platform_user_id):
+    with connection() as conn:
+        row = conn.execute(f"SELECT telegram_user_id FROM {TABLE_MEMBER_IDENTITY_NAME} WHERE platform = ? AND platform_user_id = ?", (platform, str(platform_user_id))).fetchone()
+        return row[0] if row else None
+
+# Retrieve the set of known user IDs of a platform
+@timed
+def retrieve_platform_user_ids(platform):
+    with connection() as conn:
+        return {row[0] for row in conn.execute(f"SELECT platform_user_id FROM {TABLE_MEMBER_IDENTITY_NAME} WHERE platform = ?", (platform,))}
+
+# Forget platform users, e.g. once they have been removed from the group. Return the number of rows deleted.
+@timed
+def remove_member_identities(platform, platform_user_ids, chunk_size=500):
+    platform_user_ids = [str(platform_user_id) for platform_user_id in platform_user_ids]
+    deleted = 0
+    with transaction() as conn:
+        for start in range(0, len(platform_user_ids), chunk_size):
+            chunk = platform_user_ids[start:start + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            deleted += conn.execute(f"DELETE FROM {TABLE_MEMBER_IDENTITY_NAME} WHERE platform = ? AND platform_user_id IN ({placeholders})", [platform, *chunk]).rowcount
+    return deleted
+
+# Get the state of an interrupted reconciliation as (cursor, updated_at), or None if none is in progress
+@timed
+def get_reconciliation_state(job):
+    with connection() as conn:
+        return conn.execute(f"SELECT cursor, updated_at FROM {TABLE_RECONCILIATION_STATE_NAME} WHERE job = ?", (job,)).fetchone()
+
+# Record a page of a reconciliation: the active user IDs found in it and the cursor of the next page, in one transaction
+@timed
+def store_reconciliation_page(job, platform_user_ids, cursor):
+    now = int(time.time())
+    with transaction() as conn:
+        conn.executemany(f"INSERT OR IGNORE INTO {TABLE_RECONCILIATION_SEEN_NAME} (job, platform_user_id) VALUES (?, ?)", [(job, str(platform_user_id)) for platform_user_id in platform_user_ids])
+        conn.execute(f"""
+            INSERT INTO {TABLE_RECONCILIATION_STATE_NAME} (job, cursor, started_at, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (job) DO UPDATE SET cursor = excluded.cursor, updated_at = excluded.updated_at
+        """, (job, cursor, now, now))
+
+# Iterate over the active user IDs recorded so far by a reconciliation
+@timed
+def iter_reconciliation_user_ids(job):
+    with connection() as conn:
+        for row in conn.execute(f"SELECT platform_user_id FROM {TABLE_RECONCILIATION_SEEN_NAME} WHERE job = ?", (job,)):
+            yield row[0]
+
+# Forget the state of a reconciliation, once finished or to start it over
+@timed
+def clear_reconciliation(job):
+    with transaction() as conn:
+        conn.execute(f"DELETE FROM {TABLE_RECONCILIATION_SEEN_NAME} WHERE job = ?", (job,))
+        conn.execute(f"DELETE FROM {TABLE_RECONCILIATION_STATE_NAME} WHERE job = ?", (job,))
+
+# Store an OAuth token, replacing the one with the same name.
+# With only_if_missing, a token already stored is kept (e.g. a refreshed one over the one from the configuration).
+@timed
+def store_token(name, platform, access_token, refresh_token, expires_at=None, keep_fresh=False, refreshed_at=None, only_if_missing=False):
+    conflict = "DO NOTHING" if only_if_missing else """DO UPDATE SET
+        platform = excluded.platform,
+        access_token = excluded.access_token,
+        refresh_token = COALESCE(excluded.refresh_token, refresh_token),
+        expires_at = excluded.expires_at,
+        keep_fresh = excluded.keep_fresh,
+        refreshed_at = excluded.refreshed_at,
+        updated_at = excluded.updated_at"""
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO {TABLE_OAUTH_TOKEN_NAME} (name, platform, access_token, refresh_token, expires_at, keep_fresh, refreshed_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name) {conflict}
+        """, (name, platform, access_token, refresh_token, expires_at, int(keep_fresh), refreshed_at, int(time.time())))
+
+# Get a token as (platform, access_token, refresh_token, expires_at, keep_fresh, refreshed_at), or None if unknown
+@timed
+def get_token(name):
+    with connection() as conn:
+        return conn.execute(f"SELECT platform, access_token, refresh_token, expires_at, keep_fresh, refreshed_at FROM {TABLE_OAUTH_TOKEN_NAME} WHERE name = ?", (name,)).fetchone()
+
+# Names of the tokens kept fresh that expire between expires_after and expires_before
+@timed
+def find_expiring_tokens(expires_before, expires_after):
+    with connection() as conn:
+        return [row[0] for row in conn.execute(f"SELECT name FROM {TABLE_OAUTH_TOKEN_NAME} WHERE keep_fresh = 1 AND expires_at BETWEEN ? AND ?", (expires_after, expires_before))]
+
+# Delete the tokens not kept fresh that expired before expired_before. Return the number of rows deleted.
+@timed
+def delete_expired_tokens(expired_before):
+    with transaction() as conn:
+        return conn.execute(f"DELETE FROM {TABLE_OAUTH_TOKEN_NAME} WHERE keep_fresh = 0 AND expires_at < ?", (expired_before,)).rowcount
+
+# Get the last successful registration with a provider as (fingerprint, registered_at), or None
+@timed
+def get_provider_registration(provider):
+    with connection() as conn:
+        return conn.execute(f"SELECT fingerprint, registered_at FROM {TABLE_PROVIDER_REGISTRATION_NAME} WHERE provider = ?", (provider,)).fetchone()
+
+# Record a successful registration with a provider
+@timed
+def store_provider_registration(provider, fingerprint):
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO {TABLE_PROVIDER_REGISTRATION_NAME} (provider, fingerprint, registered_at) VALUES (?, ?, ?)
+            ON CONFLICT (provider) DO UPDATE SET fingerprint = excluded.fingerprint, registered_at = excluded.registered_at
+        """, (provider, fingerprint, int(time.time())))
+
+# Forget the registration with a provider
+@timed
+def remove_provider_registration(provider):
+    with transaction() as conn:
+        conn.execute(f"DELETE FROM {TABLE_PROVIDER_REGISTRATION_NAME} WHERE provider = ?", (provider,))
+
+# Get the secret a provider signs its webhook requests with, or None
+@timed
+def get_webhook_secret(provider):
+    with connection() as conn:
+        row = conn.execute(f"SELECT secret FROM {TABLE_WEBHOOK_SECRET_NAME} WHERE provider = ?", (provider,)).fetchone()
+        return row[0] if row else None
+
+# Store the secret a provider signs its webhook requests with
+@timed
+def store_webhook_secret(provider, secret):
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO {TABLE_WEBHOOK_SECRET_NAME} (provider, secret, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (provider) DO UPDATE SET secret = excluded.secret, updated_at = excluded.updated_at
+        """, (provider, secret, int(time.time())))
+
+# Record the membership status of a user in a chat ('member', 'left', 'kicked'...), as of now
+@timed
+def store_roster_status(chat_id, telegram_user_id, status):
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO {TABLE_GROUP_ROSTER_NAME} (chat_id, telegram_user_id, status, verified_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (chat_id, telegram_user_id) DO UPDATE SET status = excluded.status, verified_at = excluded.verified_at
+        """, (chat_id, telegram_user_id, status, int(time.time())))
+
+# Get the recorded membership status of a user in a chat, or None if unknown
+@timed
+def find_roster_status(chat_id, telegram_user_id):
+    with connection() as conn:
+        row = conn.execute(f"SELECT status FROM {TABLE_GROUP_ROSTER_NAME} WHERE chat_id = ? AND telegram_user_id = ?", (chat_id, telegram_user_id)).fetchone()
+        return row[0] if row else None
+
+# Users of a chat whose status was last verified before verified_before, oldest first, as (telegram_user_id, status)
+@timed
+def retrieve_unverified_roster(chat_id, verified_before, limit):
+    with connection() as conn:
+        return conn.execute(f"""
+            SELECT telegram_user_id, status FROM {TABLE_GROUP_ROSTER_NAME}
+            WHERE chat_id = ? AND verified_at < ? ORDER BY verified_at LIMIT ?
+        """, (chat_id, verified_before, limit)).fetchall()
@@ -0,0 +1,104 @@
+import re
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+HTTP_TIMEOUT = (3.05, 10)           # (connect, read) seconds, so a hung provider can't pin a worker forever
+HTTP_POOL_SIZE = 10                 # Keep-alive connections kept per host
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5           # 0.5s, 1s, 2s, ... between retries
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+NON_IDEMPOTENT_METHODS = frozenset(['POST'])    # Only retried when the server turned them away, see RateLimitRetry.is_retry()
+
+""" Retry policy that also honors the rate-limit reset headers sent by Twitch """
+class RateLimitRetry(Retry):
+
+    MAX_RETRY_AFTER = 30            # Never sleep longer than this on a provider's request
+
+    """ A POST answered with a 5xx may have been processed already (e.g. an OAuth code exchanged, a webhook created):
+    replay it only on 429, or on 503 with Retry-After, where the server tells it did not handle the request """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() in NON_IDEMPOTENT_METHODS and not (status_code == 429 or (status_code == 503 and has_retry_after)):
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+
+        # Twitch answers 429 with "Ratelimit-Reset" (epoch seconds) instead of "Retry-After"
+        if retry_after is None:
+            reset = response.headers.get('Ratelimit-Reset')
+            if reset and reset.isdigit():
+                retry_after = max(0, int(reset) - time.time())
+
+        if retry_after is not None:
+            retry_after = min(retry_after, self.MAX_RETRY_AFTER)
+        return retry_after
+
+""" Endpoint of a URL for the metrics, e.g. "GET /api/oauth2/v2/campaigns/{id}/members" """
+def endpoint(method, url):
+    return f'{method.upper()} {re.sub(r"/[0-9]+(?=/|$)", "/{id}", urllib.parse.urlsplit(url).path)}'
+
+""" requests.Session applying a default timeout to every request.
+With a provider name, the time of every request is recorded by endpoint and status. """
+class TimeoutSession(requests.Session):
+
+    def __init__(self, timeout=HTTP_TIMEOUT, provider=None):
+        super().__init__()
+        self.timeout = timeout
+        self.provider = provider
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if not self.provider:
+            return super().request(method, url, **kwargs)
+
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            metrics.provider_request_duration.observe(time.perf_counter() - started_at, self.provider, endpoint(method, url), status)
+
+""" Send a request with a bearer token. If the token is rejected (401), ask `refresh(rejected_token)` for a new one
+and send the request once more. `refresh` returns None if no new token could be had, then the 401 is returned. """
+def send_authorized(session, method, url, token, refresh, headers=None, **kwargs):
+    headers = dict(headers or {})
+    headers['Authorization'] = f'Bearer {token}'
+    response = session.request(method, url, headers=headers, **kwargs)
+    if response.status_code != 401:
+        return response
+
+    token = refresh(token)
+    if not token:
+        return response
+    headers['Authorization'] = f'Bearer {token}'
+    return session.request(method, url, headers=headers, **kwargs)
+
+""" Create a session with keep-alive connection pooling, default timeouts and a retry/backoff policy.
+The provider name (e.g. "twitch") labels the request times in the metrics. """
+def create_session(timeout=HTTP_TIMEOUT, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR, provider=None):
+    retry = RateLimitRetry(
+        total=retries,
+        connect=retries,
+        read=0,                     # The request may have been processed already, don't replay it
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'POST', 'DELETE']),
+        respect_retry_after_header=True,
+        raise_on_status=False,      # Return the last response, callers already check the payload
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = TimeoutSession(timeout=timeout, provider=provider)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
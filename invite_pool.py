@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+import concurrent.futures
+
+from telebot.apihelper import ApiTelegramException
+
+import background
+import database
+
+REVOKE_CONCURRENCY = 4              # Revocations in flight at once, to stay clear of Telegram's rate limits
+
+_revoke_executor = concurrent.futures.ThreadPoolExecutor(max_workers=REVOKE_CONCURRENCY, thread_name_prefix='invite-revoke')
+logger = logging.getLogger(__name__)
+
+""" Revoke invite links concurrently, then delete all the revoked ones from the database in one transaction.
+Return (revoked, failed): the failed links are kept in the database so they can be retried. """
+def revoke_invite_links(bot, chat_id, invite_links):
+    futures = {link: _revoke_executor.submit(bot.revoke_chat_invite_link, chat_id, link) for link in invite_links or []}
+
+    revoked, failed = [], []
+    for link, future in futures.items():
+        try:
+            result = future.result()
+        except Exception as e:
+            # Telegram errors, but also connection errors and timeouts: the other links must still be handled
+            logger.error('Could not revoke invite link %s: %s', link, e)
+            failed.append(link)
+            continue
+        if result.is_revoked:
+            revoked.append(link)
+        else:
+            failed.append(link)
+
+    if revoked:
+        database.remove_links(revoked)
+    return revoked, failed
+
+""" Pool of pre-created join-request invite links of a group chat, so verified users never wait for Telegram.
+Links of another group chat (e.g. created before BOT_MODE changed) are left alone. """
+class InvitePool():
+
+    def __init__(self, bot, chat_id, low_watermark=5, high_watermark=20, max_age=60 * 60 * 24, interval=60):
+        self._bot = bot
+        self._chat_id = chat_id
+        # Below low_watermark the pool is refilled up to high_watermark
+        self._low_watermark = low_watermark
+        self._high_watermark = high_watermark
+        # Links older than max_age are revoked and replaced, so the pool never goes stale
+        self._max_age = max_age
+        self._replenish_lock = threading.Lock()
+        self._task = background.PeriodicTask('invite-pool', interval, self.replenish)
+        self.__logger = logging.getLogger(__name__)
+
+    """ Start the background replenishment, with a first fill right away """
+    def start(self):
+        self._task.start()
+        self.replenish_async()
+        return self
+
+    def stop(self, timeout=None):
+        self._task.stop(timeout)
+
+    """ Assign a pool link to a user, queuing the outbox messages returned by `messages(invite_link)` along with it.
+    Return None if the pool is empty. """
+    def claim(self, telegram_user_id, twitch_user_id=None, patreon_user_id=None, messages=None):
+        invite_link = database.claim_pool_link(
+            chat_id=self._chat_id,
+            telegram_user_id=telegram_user_id,
+            twitch_user_id=twitch_user_id,
+            patreon_user_id=patreon_user_id,
+            min_created_at=self._min_created_at(),
+            messages=messages
+        )
+        if not invite_link:
+            self.__logger.warning('Invite link pool is empty')
+
+        if not invite_link or self.size() < self._low_watermark:
+            self.replenish_async()
+        return invite_link
+
+    """ Number of usable links in the pool """
+    def size(self):
+        return database.count_pool_links(self._chat_id, self._min_created_at())
+
+    """ Replenish the pool on a separate thread """
+    def replenish_async(self):
+        threading.Thread(target=self.replenish, name='invite-pool-replenish', daemon=True).start()
+
+    """ Revoke stale links, then refill the pool if it is below the low watermark """
+    def replenish(self):
+        # A replenishment is already running, it will do the work
+        if not self._replenish_lock.acquire(blocking=False):
+            return
+        try:
+            self._rotate()
+
+            size = self.size()
+            if size >= self._low_watermark:
+                return
+
+            created = []
+            try:
+                for _ in range(self._high_watermark - size):
+                    invite = self._bot.create_chat_invite_link(chat_id=self._chat_id, creates_join_request=True)
+                    created.append(invite.invite_link)
+            except ApiTelegramException as e:
+                self.__logger.error('Could not create invite link for the pool: %s', e)
+            finally:
+                # Store what has been created, even if Telegram failed halfway
+                database.store_pool_links(self._chat_id, created)
+            self.__logger.info('Invite link pool replenished with %s links', len(created))
+        finally:
+            self._replenish_lock.release()
+
+    def _rotate(self):
+        stale_links = database.take_stale_pool_links(self._chat_id, self._min_created_at())
+        # A link that fails to revoke (e.g. one stored without a chat, created for the other group) is out of the pool
+        # and owned by nobody, so a join request with it is declined anyway
+        _, failed = revoke_invite_links(self._bot, self._chat_id, stale_links)
+        if failed:
+            self.__logger.error('Could not revoke %s stale pool invite links', len(failed))
+
+    def _min_created_at(self):
+        return int(time.time()) - self._max_age
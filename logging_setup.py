@@ -0,0 +1,108 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+LOG_FORMAT = "{asctime}# {levelname} - {name}.{funcName} - {message}"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M"
+LOG_MAX_BYTES = 10 * 1024 * 1024    # Size-based rotation: the file is rotated when it reaches this size
+LOG_BACKUP_COUNT = 5                # Rotated files kept
+LOG_QUEUE_SIZE = 10000              # Records waiting for the writer thread, the next ones are dropped instead of blocking a request
+
+PAYLOAD_SAMPLE_RATE = 1.0           # Share of the payloads logged (0 to 1)
+PAYLOAD_MAX_LENGTH = 2048           # Payloads are truncated to this many characters
+
+_listener = None
+_handler = None
+
+""" QueueHandler handing the records to the writer thread as they are: the message is only formatted there.
+Arguments must not be mutated after the call, as with any lazy %-style logging. """
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+""" QueueListener waiting for room in a full queue to tell the writer thread to stop """
+class _Listener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+""" Payload converted to text and truncated only when the record is formatted, on the writer thread """
+class _Truncated():
+
+    __slots__ = ('payload', 'max_length')
+
+    def __init__(self, payload, max_length):
+        self.payload = payload
+        self.max_length = max_length
+
+    def __str__(self):
+        payload = self.payload
+        if isinstance(payload, (bytes, bytearray)):
+            text = payload[:self.max_length].decode('utf-8', 'replace')
+        else:
+            payload = str(payload)
+            text = payload[:self.max_length]
+        if len(payload) > self.max_length:
+            text += f'... ({len(payload)} total)'
+        return text
+
+""" Set up the logging of the whole process: the records go through a queue to a writer thread,
+which appends them to a file rotated by size, or by time if `when` is set (see TimedRotatingFileHandler).
+Calling it again does nothing. Return the handler, whose `dropped` counts the records lost to a full queue. """
+def configure(path, level=logging.DEBUG, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, when=None,
+              queue_size=LOG_QUEUE_SIZE, payload_sample_rate=PAYLOAD_SAMPLE_RATE, payload_max_length=PAYLOAD_MAX_LENGTH):
+    global _listener, _handler, PAYLOAD_SAMPLE_RATE, PAYLOAD_MAX_LENGTH
+
+    if _listener:
+        return _handler
+
+    if when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT, style='{'))
+
+    _handler = DeferredQueueHandler(queue.Queue(queue_size))
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    PAYLOAD_SAMPLE_RATE = payload_sample_rate
+    PAYLOAD_MAX_LENGTH = payload_max_length
+
+    _listener = _Listener(_handler.queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    # Write what is still queued before the process exits
+    atexit.register(stop)
+    return _handler
+
+""" Stop the writer thread, once the queued records are written """
+def stop():
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+""" Log a request or response payload at debug level, for a sample of the calls and truncated to the maximum length.
+Nothing is converted to text when debug is off or the call is not sampled. """
+def log_payload(logger, label, payload, sample_rate=None, max_length=None):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if random.random() >= (PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate):
+        return
+    logger.debug('%s - %s', label, _Truncated(payload, max_length or PAYLOAD_MAX_LENGTH), stacklevel=2)
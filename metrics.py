@@ -0,0 +1,134 @@
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+STARTED_AT_KEY = 'metrics.started_at'    # WSGI environ key holding the perf_counter() at which the request arrived
+
+# Histogram buckets (upper bounds, seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels_text(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+""" Counter, one value per combination of label values """
+class Counter():
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {} if labelnames else {(): 0}
+        self._lock = threading.Lock()
+
+    """ Add `amount` to the counter of these label values (in the order of labelnames) """
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels_text(self.labelnames, labels)} {value}'
+
+""" Histogram of observed values, one per combination of label values """
+class Histogram():
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._buckets = tuple(sorted(buckets))
+        self._series = {}               # label values -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    """ Record a value for these label values (in the order of labelnames) """
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self._buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            all_series = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in all_series:
+            cumulative = 0
+            for bound, count in zip(self._buckets + ('+Inf',), series):
+                cumulative += count
+                bound_text = f'le="{bound}"'
+                yield f'{self.name}_bucket{_labels_text(self.labelnames, labels, bound_text)} {cumulative}'
+            labels_text = _labels_text(self.labelnames, labels)
+            yield f'{self.name}_sum{labels_text} {series[-1]}'
+            yield f'{self.name}_count{labels_text} {cumulative}'
+
+""" Metrics of the process, rendered in the Prometheus text format """
+class Registry():
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {_escape(metric.help)}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+""" WSGI middleware recording when each request arrived, under STARTED_AT_KEY in its environ """
+class RequestTimer():
+
+    def __init__(self, app):
+        self._app = app
+
+    def __call__(self, environ, start_response):
+        environ[STARTED_AT_KEY] = time.perf_counter()
+        return self._app(environ, start_response)
+
+_registry = Registry()
+
+def counter(name, help, labelnames=()):
+    return _registry.counter(name, help, labelnames)
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return _registry.histogram(name, help, labelnames, buckets)
+
+def render():
+    return _registry.render()
+
+# Shared by the modules making the calls
+http_request_duration = histogram('http_request_duration_seconds', 'Time to answer an HTTP request', ('route', 'method', 'status'))
+provider_request_duration = histogram('provider_request_duration_seconds', 'Time of a call to Twitch, Patreon or Telegram', ('provider', 'method', 'status'))
+db_query_duration = histogram('db_query_duration_seconds', 'Time of a call to a database function, waiting for a pooled connection included', ('query',), DB_LATENCY_BUCKETS)
@@ -0,0 +1,128 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+from telebot.apihelper import ApiTelegramException
+
+import database
+import rate_limiter
+
+# Bot methods that can go through the outbox
+METHODS = (
+    'send_message',
+    'approve_chat_join_request',
+    'decline_chat_join_request',
+    'revoke_chat_invite_link',
+    'ban_chat_member',
+    'unban_chat_member',
+)
+
+# Telegram errors that will fail again no matter how many times they are retried
+PERMANENT_ERROR_CODES = (400, 403)
+
+""" Build an outbox message (idempotency_key, method, arguments) for a bot method call.
+Calls sharing the same idempotency key are sent only once. """
+def message(method, idempotency_key=None, **kwargs):
+    if method not in METHODS:
+        raise ValueError(f'Method not allowed in the outbox: {method}')
+    return (idempotency_key or str(uuid.uuid4()), method, json.dumps(kwargs))
+
+""" Durable queue of Telegram calls, stored in the database and sent by a pool of worker threads """
+class Outbox():
+
+    def __init__(self, bot, workers=2, batch_size=10, max_attempts=8, retry_delay=2, lease=60, send_margin=20, poll_interval=5, name='outbox'):
+        self._bot = bot
+        self._workers = workers
+        self._batch_size = batch_size
+        # A failing call is retried after retry_delay, 2*retry_delay, 4*retry_delay... then dead-lettered
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        # Seconds a claimed message is hidden from the other workers, in case its worker dies.
+        # A message must be sent send_margin seconds before its lease ends (leaving time for the call itself),
+        # one that would wait longer for the rate limits is put back in the queue: another worker would send it twice.
+        self._lease = lease
+        self._send_margin = send_margin
+        self._poll_interval = poll_interval
+        self._name = name
+        self._wake_up = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self.__logger = logging.getLogger(__name__)
+
+    def start(self):
+        self._stopping.clear()
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, name=f'{self._name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wake_up.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    """ Queue a bot method call """
+    def send(self, method, idempotency_key=None, **kwargs):
+        self.send_all([message(method, idempotency_key, **kwargs)])
+
+    """ Queue several messages built with message() """
+    def send_all(self, messages):
+        database.store_outbox_messages(messages)
+        self.notify()
+
+    """ Wake the workers up, e.g. after messages have been queued within another transaction """
+    def notify(self):
+        self._wake_up.set()
+
+    """ Number of messages by status """
+    def stats(self):
+        return database.count_outbox_messages()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            send_deadline = time.monotonic() + self._lease - self._send_margin
+            messages = database.claim_outbox_messages(self._batch_size, self._lease)
+            if not messages:
+                self._wake_up.wait(self._poll_interval)
+                self._wake_up.clear()
+                continue
+            for row_id, method, arguments, attempts in messages:
+                self._deliver(row_id, method, arguments, attempts, send_deadline)
+
+    def _deliver(self, row_id, method, arguments, attempts, send_deadline):
+        try:
+            with rate_limiter.wait_limit(max(0, send_deadline - time.monotonic())):
+                getattr(self._bot, method)(**json.loads(arguments))
+        except rate_limiter.RateLimitExceeded as e:
+            # Not a failure: sent once the limits allow it, without counting an attempt
+            database.reschedule_outbox_message(row_id, time.time() + e.wait)
+            return
+        except ApiTelegramException as e:
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after')
+            if e.error_code in PERMANENT_ERROR_CODES:
+                self._dead_letter(row_id, method, e)
+            else:
+                self._retry(row_id, method, attempts, e, retry_after)
+            return
+        except Exception as e:
+            self._retry(row_id, method, attempts, e)
+            return
+
+        database.complete_outbox_message(row_id)
+
+    def _retry(self, row_id, method, attempts, error, retry_after=None):
+        if attempts + 1 >= self._max_attempts:
+            self._dead_letter(row_id, method, error)
+            return
+        delay = retry_after if retry_after else self._retry_delay * 2 ** attempts
+        self.__logger.warning('Outbox message %s (%s) failed, retrying in %ss: %s', row_id, method, delay, error)
+        database.fail_outbox_message(row_id, str(error), next_attempt_at=time.time() + delay)
+
+    def _dead_letter(self, row_id, method, error):
+        self.__logger.error('Outbox message %s (%s) dead-lettered: %s', row_id, method, error)
+        database.fail_outbox_message(row_id, str(error))
@@ -0,0 +1,84 @@
+import concurrent.futures
+import hashlib
+import logging
+import threading
+import time
+
+import database
+
+REGISTRATION_MAX_AGE = 60 * 60 * 24     # Seconds a cached registration is trusted before being checked with the provider again
+
+""" Fingerprint of the configuration a registration depends on (callback URL, IDs, secrets...).
+Secrets only go into the hash, never into the database. """
+def fingerprint(*parts):
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode()).hexdigest()
+
+""" Webhook registrations with the providers, run concurrently in the background.
+The fingerprint of each successful registration is stored, so a restart with the same configuration skips the remote calls. """
+class ProviderRegistry():
+
+    def __init__(self, max_age=REGISTRATION_MAX_AGE):
+        self._max_age = max_age
+        self._registrations = {}        # name -> (fingerprint, register, force)
+        self._status = {}
+        self._futures = []
+        self._lock = threading.Lock()
+        self.__logger = logging.getLogger(__name__)
+
+    """ Add a registration. `register(changed)` makes the remote calls and returns True on success, `changed` being
+    True when no registration is stored or it was made with another fingerprint (e.g. a new secret).
+    With force, the cached state is ignored. """
+    def add(self, name, fingerprint, register, force=False):
+        self._registrations[name] = (fingerprint, register, force)
+        self._status[name] = 'pending'
+
+    """ Run all the registrations in the background (no-op if already started) """
+    def start(self):
+        with self._lock:
+            if self._futures:
+                return self
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self._registrations)), thread_name_prefix='registration')
+            self._futures = [executor.submit(self._run, name) for name in self._registrations]
+            executor.shutdown(wait=False)
+        return self
+
+    """ Wait for the registrations to finish. Return True if they all did within the timeout. """
+    def wait(self, timeout=None):
+        _, not_done = concurrent.futures.wait(self._futures, timeout)
+        return not not_done
+
+    """ State of each registration: pending, cached, registered or failed """
+    def status(self):
+        with self._lock:
+            return dict(self._status)
+
+    """ Forget the cached state of a registration, e.g. after the provider revoked it """
+    def invalidate(self, name):
+        database.remove_provider_registration(name)
+
+    def _run(self, name):
+        fingerprint, register, force = self._registrations[name]
+        cached = database.get_provider_registration(name)
+        if not force and cached and cached[0] == fingerprint and time.time() - cached[1] < self._max_age:
+            self.__logger.info('Registration with %s is cached, skipped', name)
+            self._set_status(name, 'cached')
+            return
+
+        started_at = time.monotonic()
+        try:
+            registered = register(not cached or cached[0] != fingerprint)
+        except Exception as e:
+            self.__logger.exception('Registration with %s failed: %s', name, e)
+            registered = False
+
+        if registered:
+            database.store_provider_registration(name, fingerprint)
+            self.__logger.info('Registration with %s done in %.2fs', name, time.monotonic() - started_at)
+            self._set_status(name, 'registered')
+        else:
+            database.remove_provider_registration(name)
+            self._set_status(name, 'failed')
+
+    def _set_status(self, name, status):
+        with self._lock:
+            self._status[name] = status
@@ -0,0 +1,202 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+# Telegram limits, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30                    # API calls per second, all chats together
+PRIVATE_CHAT_RATE = 1               # Messages per second in a single private chat
+GROUP_CHAT_RATE = 20 / 60           # Messages per second in a group (20 per minute)
+GROUP_CHAT_BURST = 20
+
+MAX_CHAT_BUCKETS = 10000            # Buckets of private chats kept in memory, least recently used are dropped
+MAX_RETRIES = 2                     # Retries of a call answered with 429, after waiting retry_after
+
+# Bot methods sending a message to a chat (global and per-chat limits)
+MESSAGE_METHODS = ('send_message', 'reply_to')
+# Other bot methods acting on a chat (global limit only)
+CHAT_METHODS = (
+    'delete_message',
+    'create_chat_invite_link',
+    'revoke_chat_invite_link',
+    'approve_chat_join_request',
+    'decline_chat_join_request',
+    'ban_chat_member',
+    'unban_chat_member',
+    'get_chat_member',
+    'answer_callback_query',
+)
+# Bot methods not limited, only timed
+TIMED_METHODS = ('set_webhook', 'get_webhook_info', 'remove_webhook')
+
+# Longest wait allowed to the calls of the current thread, see wait_limit()
+_local = threading.local()
+
+""" Raised instead of waiting when a call would wait longer than the limit set with wait_limit() """
+class RateLimitExceeded(Exception):
+
+    def __init__(self, wait):
+        super().__init__(f'Rate limited for {wait:.1f}s')
+        self.wait = wait
+
+""" Within this block, a call of the current thread that would wait longer than `seconds` for the limits
+raises RateLimitExceeded instead, without using the limits, so the caller can try again later """
+@contextlib.contextmanager
+def wait_limit(seconds):
+    previous = getattr(_local, 'wait_limit', None)
+    _local.wait_limit = seconds
+    try:
+        yield
+    finally:
+        _local.wait_limit = previous
+
+""" Token bucket: `rate` tokens per second, up to `capacity` """
+class TokenBucket():
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    """ Take a token and return how long to wait before using it (0 if available right away) """
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            # Tokens can go negative: later callers queue up behind the earlier reservations
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+            return max(wait, self._paused_until - now)
+
+    """ Give back a reserved token that will not be used """
+    def refund(self):
+        with self._lock:
+            self._tokens += 1
+
+    """ Hand out no token for the next `seconds` (e.g. Telegram's retry_after) """
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def is_idle(self):
+        with self._lock:
+            return self._tokens + (time.monotonic() - self._updated_at) * self._rate >= self._capacity
+
+""" TeleBot wrapper waiting for the global and per-chat rate limits before every API call.
+The time of every call is recorded by method and status (the Telegram error code, or ok). """
+class RateLimitedBot():
+
+    def __init__(self, bot, group_chat_ids=()):
+        self._bot = bot
+        self._group_chat_ids = set(group_chat_ids)
+        self._global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._chat_buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._throttled = 0
+        self.__logger = logging.getLogger(__name__)
+
+    """ Waits spent in the limiter and 429 answers received """
+    def stats(self):
+        with self._lock:
+            return {
+                'waits': self._waits,
+                'wait_seconds_total': round(self._wait_seconds, 3),
+                'wait_seconds_max': round(self._max_wait, 3),
+                'throttled': self._throttled,
+                'chat_buckets': len(self._chat_buckets),
+            }
+
+    def __getattr__(self, name):
+        attribute = getattr(self._bot, name)
+        if name in MESSAGE_METHODS or name in CHAT_METHODS:
+            def limited(*args, **kwargs):
+                return self._call(name, attribute, args, kwargs)
+            return limited
+        if name in TIMED_METHODS:
+            def timed(*args, **kwargs):
+                return self._timed_call(name, attribute, args, kwargs)
+            return timed
+        return attribute
+
+    def _call(self, name, method, args, kwargs):
+        chat_bucket = self._chat_bucket(self._chat_id(name, args, kwargs)) if name in MESSAGE_METHODS else None
+        for attempt in range(MAX_RETRIES + 1):
+            self._wait(self._global_bucket, chat_bucket)
+            try:
+                return self._timed_call(name, method, args, kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == MAX_RETRIES:
+                    raise
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                self.__logger.warning('Telegram throttled %s, retrying in %ss', name, retry_after)
+                with self._lock:
+                    self._throttled += 1
+                (chat_bucket or self._global_bucket).pause(retry_after)
+
+    def _timed_call(self, name, method, args, kwargs):
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            result = method(*args, **kwargs)
+            status = 'ok'
+            return result
+        except ApiTelegramException as e:
+            status = e.error_code
+            raise
+        finally:
+            metrics.provider_request_duration.observe(time.perf_counter() - started_at, 'telegram', name, status)
+
+    def _wait(self, *buckets):
+        buckets = [bucket for bucket in buckets if bucket]
+        wait = max(bucket.reserve() for bucket in buckets)
+        if wait <= 0:
+            return
+        limit = getattr(_local, 'wait_limit', None)
+        if limit is not None and wait > limit:
+            for bucket in buckets:
+                bucket.refund()
+            raise RateLimitExceeded(wait)
+        with self._lock:
+            self._waits += 1
+            self._wait_seconds += wait
+            self._max_wait = max(self._max_wait, wait)
+        time.sleep(wait)
+
+    def _chat_id(self, name, args, kwargs):
+        if name == 'reply_to':
+            message = args[0] if args else kwargs.get('message')
+            return message.chat.id
+        return args[0] if args else kwargs.get('chat_id')
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket:
+                self._chat_buckets.move_to_end(chat_id)
+                return bucket
+
+            if chat_id in self._group_chat_ids:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_RATE)
+            self._chat_buckets[chat_id] = bucket
+
+            # Drop the least recently used buckets, but only the idle ones: a busy one still holds its limit
+            while len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                if not oldest.is_idle():
+                    break
+                del self._chat_buckets[oldest_id]
+            return bucket
@@ -0,0 +1,87 @@
+import logging
+import time
+
+import database
+import PatreonHelper
+import TwitchHelper
+
+REMOVAL_SPACING = 1                 # Seconds between two queued removals, so a large reconciliation trickles out
+RESUME_MAX_AGE = 60 * 60 * 24       # An interrupted walk idle for longer than this is started over, its results are stale
+
+logger = logging.getLogger(__name__)
+
+""" Diff the platform user IDs we hold against a stream of active user IDs, in one pass.
+Only the IDs we hold are kept in memory: the stream is consumed as it comes. Return the set of lapsed IDs. """
+def find_lapsed_user_ids(platform, active_user_ids):
+    lapsed = database.retrieve_platform_user_ids(platform)
+    for user_id in active_user_ids:
+        lapsed.discard(str(user_id))
+    return lapsed
+
+""" Queue the removal of the Telegram users linked to lapsed platform user IDs, then forget those IDs.
+Return the number of removals queued. """
+def queue_removals(member_scheduler, platform, lapsed_user_ids, spacing=REMOVAL_SPACING):
+    queued = 0
+    for user_id in lapsed_user_ids:
+        telegram_user_id = database.find_telegram_user_id(platform, user_id)
+        if not telegram_user_id:
+            continue
+        member_scheduler.schedule('remove_member', delay=queued * spacing, telegram_user_id=telegram_user_id, username=f'{platform}:{user_id}')
+        queued += 1
+
+    # Forgotten IDs are not queued again by the next reconciliation, a new verification stores them back
+    database.remove_member_identities(platform, lapsed_user_ids)
+    return queued
+
+""" Remove the group members whose Patreon membership lapsed without the webhook reaching us.
+Nothing is removed if the campaign members cannot all be listed. """
+def reconcile_patreon(patreon_info, campaign_id, member_scheduler):
+    started_at = time.monotonic()
+    members = patreon_info.iter_campaign_members(campaign_id)
+    active_user_ids = (user_id for user_id, patron_status in members if user_id and patron_status in PatreonHelper.PATRON_STATUS_ACTIVE)
+    try:
+        lapsed = find_lapsed_user_ids(PatreonHelper.PLATFORM, active_user_ids)
+    except Exception as e:
+        logger.error('Patreon reconciliation aborted, no member removed: %s', e)
+        return None
+
+    queued = queue_removals(member_scheduler, PatreonHelper.PLATFORM, lapsed)
+    logger.info('Patreon reconciliation done in %.1fs: %s lapsed, %s removals queued', time.monotonic() - started_at, len(lapsed), queued)
+    return queued
+
+""" Remove the group members whose Twitch subscription ended without the EventSub notification reaching us.
+The channel subscribers are walked page by page, each page is recorded with its cursor, so an interrupted walk
+resumes where it stopped. With max_pages, a run stops after that many pages and the next run carries on.
+Return the number of removals queued, or None if the walk is not finished. """
+def reconcile_twitch(twitch_info, member_scheduler, max_pages=None):
+    if not twitch_info.has_broadcaster_token():
+        logger.warning('Twitch reconciliation skipped, no broadcaster token')
+        return None
+
+    job = TwitchHelper.PLATFORM
+    started_at = time.monotonic()
+    cursor = None
+    state = database.get_reconciliation_state(job)
+    if state and state[0] and time.time() - state[1] < RESUME_MAX_AGE:
+        cursor = state[0]
+        logger.info('Twitch reconciliation resumed from its last cursor')
+    else:
+        database.clear_reconciliation(job)
+
+    pages = 0
+    try:
+        for subscriber_user_ids, cursor in twitch_info.iter_subscription_pages(cursor):
+            database.store_reconciliation_page(job, subscriber_user_ids, cursor)
+            pages += 1
+            if cursor and max_pages and pages >= max_pages:
+                logger.info('Twitch reconciliation paused after %s pages', pages)
+                return None
+    except Exception as e:
+        logger.error('Twitch reconciliation interrupted after %s pages, no member removed: %s', pages, e)
+        return None
+
+    lapsed = find_lapsed_user_ids(job, database.iter_reconciliation_user_ids(job))
+    queued = queue_removals(member_scheduler, job, lapsed)
+    database.clear_reconciliation(job)
+    logger.info('Twitch reconciliation done in %.1fs: %s lapsed, %s removals queued', time.monotonic() - started_at, len(lapsed), queued)
+    return queued
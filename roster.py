@@ -0,0 +1,75 @@
+import logging
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import background
+import cache
+import database
+
+MEMBER_STATUSES = ('member', 'restricted', 'administrator', 'creator')
+
+""" Membership of the group kept locally, from the chat_member updates, the users leaving and the approved joins.
+Reads go through a TTL cache, then the database, and only ask Telegram for users never seen before.
+A periodic pass verifies the oldest entries with Telegram, in case an update was missed. """
+class GroupRoster():
+
+    def __init__(self, bot, chat_id, cache_ttl=300, cache_size=10000, verify_age=60 * 60 * 24, verify_interval=60 * 10, verify_batch=50):
+        self._bot = bot
+        self._chat_id = chat_id
+        self._cache = cache.TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Each pass verifies up to verify_batch entries not verified for verify_age seconds
+        self._verify_age = verify_age
+        self._verify_batch = verify_batch
+        self._task = background.PeriodicTask('roster-verify', verify_interval, self.verify)
+        self.__logger = logging.getLogger(__name__)
+
+    def start(self):
+        self._task.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._task.stop(timeout)
+
+    """ Check if a user is a member of the group """
+    def is_member(self, telegram_user_id):
+        return self.status(telegram_user_id) in MEMBER_STATUSES
+
+    """ Membership status of a user, asking Telegram only if the user is unknown """
+    def status(self, telegram_user_id):
+        status = self._cache.get(telegram_user_id)
+        if status is None:
+            status = database.find_roster_status(self._chat_id, telegram_user_id)
+            if status is None:
+                status = self._fetch_status(telegram_user_id)
+                database.store_roster_status(self._chat_id, telegram_user_id, status)
+            self._cache.set(telegram_user_id, status)
+        return status
+
+    """ Record the new status of a user """
+    def update(self, telegram_user_id, status):
+        database.store_roster_status(self._chat_id, telegram_user_id, status)
+        self._cache.set(telegram_user_id, status)
+
+    """ Check the oldest entries with Telegram and fix the ones that drifted. Return the number fixed. """
+    def verify(self):
+        fixed = 0
+        for telegram_user_id, status in database.retrieve_unverified_roster(self._chat_id, self._verified_before(), self._verify_batch):
+            current_status = self._fetch_status(telegram_user_id)
+            if current_status != status:
+                self.__logger.info('Roster entry of %s drifted: %s -> %s', telegram_user_id, status, current_status)
+                fixed += 1
+            self.update(telegram_user_id, current_status)
+        return fixed
+
+    def _fetch_status(self, telegram_user_id):
+        try:
+            return self._bot.get_chat_member(self._chat_id, telegram_user_id).status
+        except ApiTelegramException as e:
+            # Telegram answers 400 for a user it does not know in this chat
+            if e.error_code == 400:
+                return 'left'
+            raise
+
+    def _verified_before(self):
+        return int(time.time()) - self._verify_age
@@ -0,0 +1,92 @@
+import heapq
+import json
+import logging
+import threading
+import time
+
+import database
+
+""" Run named actions at a given time on a background thread.
+Tasks are persisted in the database, so the ones still pending survive a restart. """
+class Scheduler():
+
+    def __init__(self, max_attempts=5, retry_delay=5, name='scheduler'):
+        self._actions = {}
+        self._heap = []                 # (run_at, task_id, action, payload, attempts)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._name = name
+        # A failing task is retried after retry_delay, 2*retry_delay, 4*retry_delay... up to max_attempts times
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self.__logger = logging.getLogger(__name__)
+
+    """ Register the function run for an action. It is called with the payload as keyword arguments. """
+    def register(self, action, function):
+        self._actions[action] = function
+
+    """ Load the pending tasks from the database and start the background thread """
+    def start(self):
+        with self._condition:
+            for task_id, action, payload, run_at, attempts in database.retrieve_scheduled_tasks():
+                heapq.heappush(self._heap, (run_at, task_id, action, payload, attempts))
+            self.__logger.info('Scheduler started with %s pending tasks', len(self._heap))
+            self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    """ Persist a task and schedule it `delay` seconds from now. Return the task ID. """
+    def schedule(self, action, delay=0, **payload):
+        if action not in self._actions:
+            raise ValueError(f'Unknown scheduler action: {action}')
+
+        run_at = time.time() + delay
+        payload = json.dumps(payload)
+        task_id = database.store_scheduled_task(action, payload, run_at)
+        with self._condition:
+            heapq.heappush(self._heap, (run_at, task_id, action, payload, 0))
+            self._condition.notify()
+        return task_id
+
+    """ Number of tasks waiting to run """
+    def pending(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    delay = self._heap[0][0] - time.time() if self._heap else None
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopping:
+                    return
+                task = heapq.heappop(self._heap)
+            self._execute(*task)
+
+    def _execute(self, run_at, task_id, action, payload, attempts):
+        try:
+            self._actions[action](**json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            if action in self._actions and attempts < self._max_attempts:
+                retry_at = time.time() + self._retry_delay * 2 ** (attempts - 1)
+                self.__logger.warning('Task %s (%s) failed, retry %s scheduled: %s', task_id, action, attempts, e)
+                database.reschedule_task(task_id, retry_at, attempts)
+                with self._condition:
+                    heapq.heappush(self._heap, (retry_at, task_id, action, payload, attempts))
+                return
+            self.__logger.exception('Task %s (%s) failed, giving up: %s', task_id, action, e)
+
+        database.remove_scheduled_task(task_id)
@@ -0,0 +1,56 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+# Signed OAuth "state" tokens.
+# The token carries the Telegram context of a verification (user, chat, platform) and an expiry,
+# authenticated with HMAC-SHA256, so the OAuth callbacks can trust it without a database lookup.
+# Format: base64url(payload) "." base64url(signature)
+
+DEFAULT_TTL = 60 * 30
+
+class InvalidStateToken(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(secret, payload):
+    return hmac.new(secret.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).digest()
+
+""" Create a token for the given Telegram user, chat and platform, valid for `ttl` seconds """
+def encode(secret, telegram_user_id, telegram_chat_id, platform, ttl=DEFAULT_TTL):
+    payload = _b64encode(json.dumps(
+        [telegram_user_id, telegram_chat_id, platform, int(time.time()) + ttl],
+        separators=(',', ':')
+    ).encode('utf-8'))
+    return f'{payload}.{_b64encode(_sign(secret, payload))}'
+
+""" Verify a token and return (telegram_user_id, telegram_chat_id, platform), raise InvalidStateToken otherwise """
+def decode(secret, token):
+    try:
+        payload, signature = token.split('.')
+        signature = _b64decode(signature)
+        # A non-ASCII payload raises UnicodeEncodeError, a ValueError
+        expected_signature = _sign(secret, payload)
+    except (ValueError, AttributeError):
+        raise InvalidStateToken('Malformed state token')
+
+    if not hmac.compare_digest(signature, expected_signature):
+        raise InvalidStateToken('Invalid state token signature')
+
+    try:
+        telegram_user_id, telegram_chat_id, platform, expires_at = json.loads(_b64decode(payload))
+    except ValueError:
+        raise InvalidStateToken('Malformed state token payload')
+
+    if expires_at < time.time():
+        raise InvalidStateToken('Expired state token')
+
+    return telegram_user_id, telegram_chat_id, platform
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+
+import background
+import database
+
+REFRESH_MARGIN = 60 * 15            # Tokens are refreshed when they expire in less than this
+REFRESH_INTERVAL = 60 * 5           # Seconds between two passes refreshing the expiring tokens kept fresh
+MIN_REFRESH_INTERVAL = 60           # A token refreshed less than this ago is not refreshed again, e.g. on a burst of 401
+USER_TOKEN_RETENTION = 60 * 60 * 24 * 30    # User tokens expired for longer than this are deleted
+
+class TokenRefreshError(Exception):
+    pass
+
+""" Name of the token of a platform user """
+def user_token_name(platform, platform_user_id):
+    return f'{platform}:{platform_user_id}'
+
+""" OAuth tokens stored in the database and refreshed before they expire.
+Tokens kept fresh (creator, broadcaster) are refreshed in the background, the others when they are read.
+Concurrent refreshes of the same token wait for a single request to the provider. """
+class TokenVault():
+
+    def __init__(self, refresh_margin=REFRESH_MARGIN, interval=REFRESH_INTERVAL, name='token-vault'):
+        self._refresh_margin = refresh_margin
+        self._refreshers = {}           # platform -> function(refresh_token) returning (access_token, refresh_token, expires_in)
+        self._locks = {}                # token name -> lock held while it is refreshed
+        self._locks_lock = threading.Lock()
+        self._task = background.PeriodicTask(name, interval, self.refresh_expiring)
+        self.__logger = logging.getLogger(__name__)
+
+    """ Register the function refreshing the tokens of a platform """
+    def register(self, platform, function):
+        self._refreshers[platform] = function
+
+    """ Start refreshing the expiring tokens in the background """
+    def start(self):
+        self._task.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._task.stop(timeout)
+
+    """ Store a token. expires_in (seconds) is None if unknown: the token is then only refreshed once rejected. """
+    def store(self, name, platform, access_token, refresh_token, expires_in=None, keep_fresh=False):
+        database.store_token(name, platform, access_token, refresh_token, self._expires_at(expires_in), keep_fresh)
+
+    """ Store a token only if none is stored under that name yet, e.g. the initial one from the configuration """
+    def seed(self, name, platform, access_token, refresh_token, expires_in=None, keep_fresh=True):
+        database.store_token(name, platform, access_token, refresh_token, self._expires_at(expires_in), keep_fresh, only_if_missing=True)
+
+    """ Get the access token stored under a name, refreshed first if it is about to expire. None if unknown. """
+    def get(self, name):
+        token = database.get_token(name)
+        if not token:
+            return None
+        _, access_token, _, expires_at, _, _ = token
+        if expires_at is not None and expires_at - time.time() < self._refresh_margin:
+            try:
+                return self.refresh(name, stale_token=access_token)
+            except TokenRefreshError as e:
+                self.__logger.error('Could not refresh token %s: %s', name, e)
+        return access_token
+
+    """ Refresh a token and return the new access token.
+    With stale_token, the token is only refreshed if it is still that one: another thread may have done it already. """
+    def refresh(self, name, stale_token=None):
+        with self._lock(name):
+            token = database.get_token(name)
+            if not token:
+                raise TokenRefreshError(f'Unknown token {name}')
+            platform, access_token, refresh_token, _, keep_fresh, refreshed_at = token
+
+            if stale_token is not None and access_token != stale_token:
+                return access_token
+            if refreshed_at and time.time() - refreshed_at < MIN_REFRESH_INTERVAL:
+                return access_token
+            if platform not in self._refreshers:
+                raise TokenRefreshError(f'No refresher for platform {platform}')
+            if not refresh_token:
+                raise TokenRefreshError(f'No refresh token for {name}')
+
+            access_token, refresh_token, expires_in = self._refreshers[platform](refresh_token)
+            if not access_token:
+                raise TokenRefreshError(f'The provider refused to refresh {name}')
+
+            database.store_token(name, platform, access_token, refresh_token, self._expires_at(expires_in), keep_fresh, refreshed_at=time.time())
+            self.__logger.info('Token %s refreshed', name)
+            return access_token
+
+    """ Refresh the tokens kept fresh that are about to expire, and delete the user tokens expired long ago.
+    Return the number of tokens refreshed. """
+    def refresh_expiring(self):
+        now = time.time()
+        refreshed = 0
+        # A token expired for longer than the retention has a refresh token that likely expired too
+        for name in database.find_expiring_tokens(now + self._refresh_margin, now - USER_TOKEN_RETENTION):
+            try:
+                self.refresh(name)
+                refreshed += 1
+            except Exception as e:
+                self.__logger.error('Could not refresh token %s: %s', name, e)
+
+        deleted = database.delete_expired_tokens(now - USER_TOKEN_RETENTION)
+        if deleted:
+            self.__logger.info('Deleted %s expired user tokens', deleted)
+        return refreshed
+
+    def _lock(self, name):
+        with self._locks_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _expires_at(self, expires_in):
+        return time.time() + expires_in if expires_in else None
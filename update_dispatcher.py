@@ -0,0 +1,161 @@
+import logging
+import queue
+import threading
+import time
+
+""" Fixed-size window of recently seen keys (ring buffer + dict), O(1) membership, insertion and removal """
+class SeenWindow():
+
+    def __init__(self, size=10000):
+        self._ring = [None] * size
+        self._index = 0
+        self._seen = {}                 # key -> its slot in the ring
+        self._lock = threading.Lock()
+
+    """ Record a key. Return False if it is already in the window (i.e. a duplicate). """
+    def add(self, key):
+        with self._lock:
+            if key in self._seen:
+                return False
+            # Evict the oldest key to make room
+            evicted = self._ring[self._index]
+            if evicted is not None:
+                del self._seen[evicted]
+            self._ring[self._index] = key
+            self._seen[key] = self._index
+            self._index = (self._index + 1) % len(self._ring)
+            return True
+
+    """ Forget a key, so that a redelivery of it is accepted again """
+    def discard(self, key):
+        with self._lock:
+            index = self._seen.pop(key, None)
+            # Free its slot too, or evicting the slot later would forget the key once added again
+            if index is not None:
+                self._ring[index] = None
+
+    def __contains__(self, key):
+        return key in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+""" Bounded in-process queue of Telegram updates, drained by a pool of worker threads.
+`process_updates` gets a batch at a time, so a failing update must not raise (e.g. TeleBot with an exception_handler). """
+class UpdateDispatcher():
+
+    __stop = object()
+
+    def __init__(self, process_updates, workers=4, max_queue_size=1000, batch_size=1, batch_window=0.05, name='telegram-worker'):
+        self._process_updates = process_updates
+        self._workers = workers
+        # Updates arriving within batch_window seconds of each other are taken from the queue together, up to batch_size
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+        self._name = name
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        self.__logger = logging.getLogger(__name__)
+
+    """ Start the worker threads """
+    def start(self):
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, name=f'{self._name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    """ Let the workers finish the updates already queued, then stop them """
+    def stop(self, timeout=None):
+        for _ in self._threads:
+            self._queue.put(self.__stop)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    """ Queue an update without waiting. Return False if the queue is full. """
+    def submit(self, update):
+        try:
+            self._queue.put_nowait((time.monotonic(), update))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+    """ Queue depth, lag and counters for monitoring """
+    def stats(self):
+        now = time.monotonic()
+        with self._queue.mutex:
+            pending = self._queue.queue
+            oldest_age = now - pending[0][0] if pending and pending[0] is not self.__stop else 0.0
+            depth = len(pending)
+        with self._lock:
+            return {
+                'queue_depth': depth,
+                'queue_capacity': self._queue.maxsize,
+                'workers': len(self._threads),
+                'oldest_pending_seconds': round(oldest_age, 3),
+                'last_lag_seconds': round(self._last_lag, 3),
+                'max_lag_seconds': round(self._max_lag, 3),
+                'processed': self._processed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+            }
+
+    """ Wait for an update, then gather the ones arriving shortly after it (up to batch_size) """
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        if batch[0] is self.__stop:
+            return batch
+        deadline = time.monotonic() + self._batch_window
+        while len(batch) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is self.__stop:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            stopping = batch[-1] is self.__stop
+            items = batch[:-1] if stopping else batch
+            try:
+                if items:
+                    self._dispatch(items)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                return
+
+    def _dispatch(self, items):
+        now = time.monotonic()
+        lag = now - items[0][0]
+        failed = 0
+        # One call for the whole batch: the bot's exception handler logs a failing handler without
+        # re-raising, so the other updates are still processed (they were already acknowledged to Telegram)
+        try:
+            self._process_updates([update for _, update in items])
+        except Exception as e:
+            # A failing batch must not kill the worker
+            self.__logger.exception('Error processing %s updates: %s', len(items), e)
+            failed = len(items)
+        with self._lock:
+            self._processed += len(items)
+            self._failed += failed
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
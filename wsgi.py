@@ -0,0 +1,4 @@
+# WSGI entry point, e.g. in the pythonanywhere WSGI configuration file: `from wsgi import application`
+from custom_webhook_telegram_bot import create_app
+
+application = create_app()